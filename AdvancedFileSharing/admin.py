@@ -1,21 +1,27 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import socket, os, threading, hashlib, sqlite3
+from tkinter import filedialog, messagebox, ttk
+import os, threading
+import time
 from datetime import datetime
 
+from utils.fileshare import FileShareClient, NotAuthorized
+from utils.logger import get_logger
+
 HOST = 'localhost'
 PORT = 5002
 DOWNLOAD = 'downloaded'
 LOG_FILE = 'logs/client_log.txt'
+STATS_INTERVAL = 2000  # Milliseconds between refreshes of the server stats panel
 
 os.makedirs(DOWNLOAD, exist_ok=True)
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
+logger = get_logger(LOG_FILE)
+
 def log(message, gui_log_widget=None):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, 'a') as f:
-        f.write(f"[{timestamp}] {message}\n")
+    logger.log(message)
     if gui_log_widget:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         gui_log_widget.insert(tk.END, f"[{timestamp}] {message}\n")
         gui_log_widget.see(tk.END)
 
@@ -39,32 +45,36 @@ class LoginWindow:
         tk.Button(root, text="Login", bg="#28a745", fg="white", font=("Segoe UI", 10, "bold"),
                   relief="groove", command=self.try_login).pack(pady=15)
 
+    # The server checks the password and hands out a session token, which
+    # the app's own client then logs in with
     def try_login(self):
         username = self.username_entry.get()
         password = self.password_entry.get()
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute('SELECT password_hash, role FROM users WHERE username=?', (username,))
-        row = c.fetchone()
-        conn.close()
-
-        if row and hashlib.sha256(password.encode()).hexdigest() == row[0]:
-            self.root.destroy()
-            self.on_success(username, row[1])
-        else:
+        try:
+            with FileShareClient(HOST, PORT, pool_size=1, keepalive=0) as client:
+                role = client.login(username, password)
+                token = client.token
+        except NotAuthorized:
             messagebox.showerror("Login Failed", "Invalid username or password.")
+            return
+        except Exception as e:
+            messagebox.showerror("Connection Error", str(e))
+            return
+        self.root.destroy()
+        self.on_success(username, role, token)
 
 class FileClientApp:
-    def __init__(self, root, username, role):
+    def __init__(self, root, username, role, token):
         self.root = root
         self.username = username
         self.role = role.strip().lower()
+        self.token = token  # Login session from LoginWindow; the server checks the role, not this app
         self.root.title(f"File Sharing Client - {self.username} ({self.role})")
         self.root.geometry("500x500")
         self.root.resizable(False, False)
         self.root.configure(bg="#f0f4f7")
-        self.sock = None
+        self.client = None
 
         btn_style = {
             "font": ("Segoe UI", 9, "bold"),
@@ -107,7 +117,20 @@ class FileClientApp:
             self.delete_btn.pack(fill="x", padx=20, pady=(5, 0))
 
             self.view_logs_btn = tk.Button(root, text="View Logs", bg="#6c757d", font=("Segoe UI", 9, "bold"), command=self.view_logs)
-            self.view_logs_btn.pack(fill="x", padx=20, pady=(5, 10))
+            self.view_logs_btn.pack(fill="x", padx=20, pady=(5, 0))
+
+            self.stats_btn = tk.Button(root, text="Server Stats", bg="#17a2b8", font=("Segoe UI", 9, "bold"), state="disabled", command=self.show_stats)
+            self.stats_btn.pack(fill="x", padx=20, pady=(5, 10))
+
+    # Tk widgets may only be touched from the main loop; worker threads go through here
+    def ui(self, func, *args):
+        self.root.after(0, func, *args)
+
+    def report(self, message):
+        self.ui(log, message, self.log_text)
+
+    def show_progress(self, done, total):
+        self.ui(self.progress.set, int(done * 100 / total) if total else 100)
 
     def delete_file(self):
         selected = self.file_listbox.curselection()
@@ -115,152 +138,196 @@ class FileClientApp:
             messagebox.showwarning("Warning", "No file selected to delete.")
             return
         filename = self.file_listbox.get(selected[0])
+        threading.Thread(target=self._delete_file_thread, args=(filename,), daemon=True).start()
+
+    def _delete_file_thread(self, filename):
         try:
-            self.sock.send(f"DELETE {filename}\n".encode())
-            response = self.recv_line()
-            if response == "DELETED":
-                messagebox.showinfo("Success", f"File '{filename}' deleted successfully.")
-                log(f"Deleted file '{filename}' successfully", self.log_text)
+            if self.client.delete(filename):
+                self.ui(messagebox.showinfo, "Success", f"File '{filename}' deleted successfully.")
+                self.report(f"Deleted file '{filename}' successfully")
                 self.list_files()
             else:
-                messagebox.showerror("Error", "Failed to delete file.")
-                log(f"Failed to delete file '{filename}'", self.log_text)
+                self.ui(messagebox.showerror, "Error", "Failed to delete file.")
+                self.report(f"Failed to delete file '{filename}'")
         except Exception as e:
-            messagebox.showerror("Error", str(e))
-            log(f"Delete failed: {e}", self.log_text)
+            self.ui(messagebox.showerror, "Error", str(e))
+            self.report(f"Delete failed: {e}")
 
     def view_logs(self):
         os.system(f"notepad {LOG_FILE}")
 
+    def show_stats(self):
+        StatsPanel(tk.Toplevel(self.root), self.client)
+
     def connect_to_server(self):
         try:
-            if self.sock:
-                self.sock.close()
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((HOST, PORT))
+            if self.client:
+                self.client.close()
+            self.client = FileShareClient(HOST, PORT, download_dir=DOWNLOAD, notify=self.report, token=self.token)
+            self.client.connect()
             self.upload_btn.config(state="normal")
             self.download_btn.config(state="normal")
             self.refresh_btn.config(state="normal")
+            if self.role == "admin":
+                self.stats_btn.config(state="normal")
             log(f"Connected to server as {self.username}", self.log_text)
             self.list_files()
         except Exception as e:
             messagebox.showerror("Connection Error", str(e))
             log(f"Connection failed: {e}", self.log_text)
 
-    def recv_line(self):
-        buffer = ''
-        while True:
-            data = self.sock.recv(1024).decode()
-            if not data:
-                break
-            buffer += data
-            if '\n' in buffer:
-                line, _ = buffer.split('\n', 1)
-                return line.strip()
-        return buffer.strip()
-
     def list_files(self):
+        threading.Thread(target=self._list_files_thread, daemon=True).start()
+
+    def _list_files_thread(self):
         try:
-            self.sock.send("LIST\n".encode())
-            files = self.sock.recv(4096).decode().split('\n')
-            self.file_listbox.delete(0, tk.END)
-            for f in files:
-                if f.strip():
-                    self.file_listbox.insert(tk.END, f)
-            log("Listed files from server", self.log_text)
+            names = [entry.name for entry in self.client.list()]
+            self.ui(self.show_files, names)
+            self.report("Listed files from server")
         except Exception as e:
-            log(f"Failed to list files: {e}", self.log_text)
+            self.report(f"Failed to list files: {e}")
+
+    def show_files(self, names):
+        self.file_listbox.delete(0, tk.END)
+        for name in names:
+            self.file_listbox.insert(tk.END, name)
 
     def upload_file(self):
         filepath = filedialog.askopenfilename()
         if not filepath:
             return
-        threading.Thread(target=self._upload_file_thread, args=(filepath,)).start()
+        threading.Thread(target=self._upload_file_thread, args=(filepath,), daemon=True).start()
 
     def _upload_file_thread(self, filepath):
+        filename = os.path.basename(filepath)
         try:
-            filename = os.path.basename(filepath)
-            size = os.path.getsize(filepath)
-            self.sock.send(f"UPLOAD {filename} {size}\n".encode())
-            response = self.recv_line()
-
-            if response == "READY":
-                hasher = hashlib.sha256()
-                sent = 0
-                with open(filepath, 'rb') as f:
-                    while chunk := f.read(1024):
-                        self.sock.send(chunk)
-                        hasher.update(chunk)
-                        sent += len(chunk)
-                        self.progress.set(int((sent / size) * 100))
-
-                server_hash = self.recv_line()
-                if server_hash == hasher.hexdigest():
-                    messagebox.showinfo("Success", "Upload complete and verified.")
-                    log(f"Uploaded {filename} successfully", self.log_text)
-                else:
-                    messagebox.showwarning("Warning", "Hash mismatch after upload.")
-            else:
-                messagebox.showerror("Error", "Server did not respond with READY.")
-            self.progress.set(0)
+            self.client.upload(filepath, progress=self.show_progress)
+            self.ui(messagebox.showinfo, "Success", "Upload complete and verified.")
+            self.report(f"Uploaded {filename} successfully")
             self.list_files()
         except Exception as e:
-            log(f"Upload failed: {e}", self.log_text)
-            messagebox.showerror("Upload Error", str(e))
+            self.report(f"Upload failed: {e}")
+            self.ui(messagebox.showerror, "Upload Error", str(e))
+        self.ui(self.progress.set, 0)
 
     def download_file(self):
         selected = self.file_listbox.curselection()
         if not selected:
             return
         filename = self.file_listbox.get(selected[0])
-        threading.Thread(target=self._download_file_thread, args=(filename,)).start()
+        threading.Thread(target=self._download_file_thread, args=(filename,), daemon=True).start()
 
     def double_click_download(self, event):
         selection = event.widget.curselection()
         if selection:
             filename = event.widget.get(selection[0])
-            threading.Thread(target=self._download_file_thread, args=(filename,)).start()
+            threading.Thread(target=self._download_file_thread, args=(filename,), daemon=True).start()
 
     def _download_file_thread(self, filename):
         try:
-            self.sock.send(f"DOWNLOAD {filename}\n".encode())
-            size_data = self.recv_line()
-            if size_data == "ERROR":
-                messagebox.showerror("Error", "File not found on server.")
-                return
-            size = int(size_data)
-            self.sock.send("READY\n".encode())
-            filepath = os.path.join(DOWNLOAD, filename)
-
-            received = 0
-            with open(filepath, 'wb') as f:
-                while received < size:
-                    chunk = self.sock.recv(1024)
-                    f.write(chunk)
-                    received += len(chunk)
-                    self.progress.set(int((received / size) * 100))
-
-            server_hash = self.recv_line()
-            hasher = hashlib.sha256()
-            with open(filepath, 'rb') as f:
-                while chunk := f.read(1024):
-                    hasher.update(chunk)
-
-            if hasher.hexdigest() == server_hash:
-                messagebox.showinfo("Download", f"Download of '{filename}' completed and verified.")
-                log(f"Downloaded {filename} successfully", self.log_text)
-            else:
-                log(f"Hash mismatch after downloading {filename}", self.log_text)
-                messagebox.showwarning("Download", "Hash mismatch after download, but file was saved.")
-            self.progress.set(0)
+            self.client.download(filename, progress=self.show_progress)
+            self.ui(messagebox.showinfo, "Download", f"Download of '{filename}' completed and verified.")
+            self.report(f"Downloaded {filename} successfully")
         except Exception as e:
-            log(f"Download failed: {e}", self.log_text)
-            messagebox.showerror("Download Error", str(e))
+            self.report(f"Download failed: {e}")
+            self.ui(messagebox.showerror, "Download Error", str(e))
+        self.ui(self.progress.set, 0)
+
+# Live view of the server's metrics (STATS), polled every STATS_INTERVAL ms.
+# Rates are worked out from the difference between two polls.
+class StatsPanel:
+    COLUMNS = ("count", "rate", "errors", "p50", "p95", "p99", "in", "out")
+    HEADINGS = ("Requests", "Req/s", "Errors", "p50 ms", "p95 ms", "p99 ms", "In", "Out")
+
+    def __init__(self, window, client):
+        self.window = window
+        self.client = client
+        self.previous = None  # (time, stats) of the last poll
+        self.window.title("Server Stats")
+        self.window.geometry("720x360")
+        self.window.configure(bg="#f0f4f7")
+
+        self.summary = tk.Label(window, text="Waiting for the server...", font=("Segoe UI", 9), bg="#f0f4f7",
+                                justify="left", anchor="w")
+        self.summary.pack(fill="x", padx=10, pady=(10, 5))
+        self.table = ttk.Treeview(window, columns=self.COLUMNS, height=12)
+        self.table.heading("#0", text="Command")
+        self.table.column("#0", width=100)
+        for column, heading in zip(self.COLUMNS, self.HEADINGS):
+            self.table.heading(column, text=heading)
+            self.table.column(column, width=75, anchor="e")
+        self.table.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+        self.poll()
+
+    def poll(self):
+        if self.window.winfo_exists():
+            threading.Thread(target=self._poll_thread, daemon=True).start()
+
+    def _poll_thread(self):
+        try:
+            stats = self.client.stats()
+        except Exception as e:
+            stats = e
+        self.window.after(0, self.show, stats)
 
-def start_app(username, role):
+    def show(self, stats):
+        if not self.window.winfo_exists():
+            return
+        self.window.after(STATS_INTERVAL, self.poll)
+        if isinstance(stats, Exception):
+            self.summary.config(text=f"Could not read server stats: {stats}")
+            return
+        now = time.monotonic()
+        elapsed, before = (now - self.previous[0], self.previous[1]) if self.previous else (0, {})
+        self.previous = (now, stats)
+
+        def rate(name, key):
+            if not elapsed or name not in before:
+                return 0.0
+            return (stats[name][key] - before[name][key]) / elapsed
+
+        server, throughput = stats.get("server", {}), stats.get("throughput", {})
+        admission = stats.get("admission", {})
+        busy = sum(v for k, v in admission.items() if k.startswith("busy_"))
+        reaped = sum(v for k, v in admission.items() if k.startswith("reaped_"))
+        limits = {name[4:]: row for name, row in stats.items() if name.startswith("qos:")}
+        cache = stats.get("cache", {})
+        self.summary.config(text=(
+            f"Connections: {server.get('connections', 0):.0f} open, {server.get('connections_total', 0):.0f} total, "
+            f"{server.get('connection_errors', 0):.0f} dropped    "
+            f"Requests: {rate('server', 'requests'):.1f}/s    "
+            f"In: {rate('server', 'bytes_in') / 1e6:.2f} MB/s    Out: {rate('server', 'bytes_out') / 1e6:.2f} MB/s\n"
+            f"Transfers: {throughput.get('count', 0):.0f}, mean {throughput.get('mean', 0):.2f} MB/s, "
+            f"p50 {throughput.get('p50', 0):.2f} MB/s, p95 {throughput.get('p95', 0):.2f} MB/s    "
+            f"Uptime: {server.get('uptime', 0) / 3600:.1f} h\n"
+            f"Load: {admission.get('transfers', 0):.0f} transfers running, "
+            f"{admission.get('upload_bytes_in_flight', 0) / 1e6:.1f} MB of uploads in flight, "
+            f"{busy:.0f} turned away (BUSY), {reaped:.0f} idle or stalled connections closed"
+            + (f"\nFile cache: {cache['files']:.0f} files, {cache['bytes'] / 1e6:.1f} MB, "
+               f"{rate('cache', 'hits'):.1f} hits/s, {rate('cache', 'misses'):.1f} misses/s, "
+               f"{cache['evictions']:.0f} evicted" if cache else "")
+            + ''.join(f"\nRate limit {name}: {row.get('rate', 0) / 1e6:.2f} of {row['limit'] / 1e6:.2f} MB/s, "
+                      f"transfers held back {rate('qos:' + name, 'throttled'):.2f} s/s"
+                      for name, row in limits.items())))
+        self.table.delete(*self.table.get_children())
+        for name, row in stats.items():
+            if name in ("server", "throughput", "admission", "cache") or name.startswith("qos:"):
+                continue
+            self.table.insert("", tk.END, text=name, values=(
+                f"{row['count']:.0f}", f"{rate(name, 'count'):.1f}", f"{row['errors']:.0f}",
+                f"{row['p50']:.2f}", f"{row['p95']:.2f}", f"{row['p99']:.2f}",
+                f"{row['bytes_in'] / 1e6:.1f} MB", f"{row['bytes_out'] / 1e6:.1f} MB"))
+
+def start_app(username, role, token):
     main_root = tk.Tk()
-    app = FileClientApp(main_root, username, role)
+    app = FileClientApp(main_root, username, role, token)
     main_root.mainloop()
+    if app.client:
+        try:
+            app.client.logout()
+        except Exception as e:
+            log(f"Logout failed: {e}")  # The session expires on its own
+        app.client.close()
 
 if __name__ == "__main__":
     login_root = tk.Tk()
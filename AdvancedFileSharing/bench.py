@@ -0,0 +1,515 @@
+import os
+import sys
+import json
+import time
+import random
+import secrets
+import shutil
+import socket
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+from utils.fileshare import FileShareClient, FileShareError
+from utils.protocol import ProtocolError
+from utils.auth import create_tables, hash_password
+
+# Load generator for the file server. It starts server.py in a scratch
+# directory (or uses a running server with --server) and runs each scenario
+# with N concurrent clients, every one a FileShareClient on its own
+# connection, for a fixed time:
+#
+#   python bench.py                                 # every scenario, threaded server
+#   python bench.py --mode async --clients 32 --duration 20
+#   python bench.py --scenarios small-uploads list-storm --compare bench_results/before.json
+#
+# Each scenario reports ops/s, MB/s and latency percentiles, overall and per
+# kind of operation. The results are written as JSON, and --compare checks
+# them against an earlier run, exiting with status 1 when something got
+# worse by more than --threshold.
+#
+# A started server gets a users.db with one admin account for the bench.
+# The bench logs in once and every client presents the session token, so
+# password checks stay out of the measurements.
+
+HOST = 'localhost'
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+RESULTS_DIR = 'bench_results'  # Where results go unless --output says otherwise
+CLIENTS = 8  # Concurrent synthetic clients
+DURATION = 10.0  # Seconds each scenario runs
+SMALL_SIZE = 4 * 1024  # Bytes per file in small uploads
+MEDIUM_SIZE = 1024 * 1024  # Bytes of the file downloaded in the mixed workload
+LARGE_SIZE = 64 * 1024 * 1024  # Bytes of the file streamed by large downloads
+RESUME_SIZE = 16 * 1024 * 1024  # Bytes of the files transfers are interrupted and resumed on
+LIST_FILES = 2000  # Files the LIST storm lists
+THRESHOLD = 0.10  # Relative change --compare counts as a regression
+STARTUP_TIMEOUT = 30.0  # Seconds to wait for a started server to accept connections
+
+# Failures counted against an operation rather than ending the run
+OP_ERRORS = (FileShareError, OSError, ProtocolError, ValueError)
+
+
+class Interrupted(Exception):
+    """Raised from a progress callback to cut a transfer off halfway."""
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+# Latency summary in milliseconds
+def latency_summary(latencies):
+    values = sorted(latencies)
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50": round(percentile(values, 0.50) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+        "p99": round(percentile(values, 0.99) * 1000, 3),
+        "max": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+class Recorder:
+    """Latencies, payload bytes and errors of one scenario's operations, from every client thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # Operation kind -> seconds per completed operation
+        self.bytes = {}  # Operation kind -> payload bytes moved
+        self.errors = {}  # Operation kind -> failed operations
+        self.error_samples = []  # First few error messages, to see what went wrong
+
+    def record(self, kind, seconds, nbytes=0):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            self.bytes[kind] = self.bytes.get(kind, 0) + nbytes
+
+    def error(self, kind, exc):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            if len(self.error_samples) < 10:
+                self.error_samples.append(f"{kind}: {type(exc).__name__}: {exc}")
+
+    # Runs fn(*args) and records it as one operation of kind moving nbytes
+    def measure(self, kind, nbytes, fn, *args):
+        started = time.perf_counter()
+        try:
+            fn(*args)
+        except OP_ERRORS as e:
+            self.error(kind, e)
+            return False
+        self.record(kind, time.perf_counter() - started, nbytes)
+        return True
+
+    def report(self, elapsed):
+        def summary(latencies, nbytes, errors):
+            return {
+                "ops": len(latencies),
+                "errors": errors,
+                "ops_per_sec": round(len(latencies) / elapsed, 2),
+                "mb_per_sec": round(nbytes / elapsed / 1e6, 2),
+                "latency_ms": latency_summary(latencies),
+            }
+
+        kinds = sorted(set(self.latencies) | set(self.errors))
+        result = summary([s for values in self.latencies.values() for s in values],
+                         sum(self.bytes.values()), sum(self.errors.values()))
+        result["elapsed"] = round(elapsed, 3)
+        result["by_op"] = {kind: summary(self.latencies.get(kind, []), self.bytes.get(kind, 0),
+                                         self.errors.get(kind, 0)) for kind in kinds}
+        if self.error_samples:
+            result["error_samples"] = self.error_samples
+        return result
+
+
+class Bench:
+    """The server under test, a scratch directory and the files scenarios share."""
+
+    def __init__(self, host, port, workdir, token=None):
+        self.host = host
+        self.port = port
+        self.workdir = workdir
+        self.token = token  # Session token every client logs in with, None for anonymous clients
+        self.prepared = set()  # Setups done so far, each runs once per bench
+        self.lock = threading.Lock()
+
+    # A client of its own for one synthetic user, with its own checkpoints
+    def client(self, index, pool_size=1):
+        return FileShareClient(self.host, self.port, pool_size=pool_size, client_id=f"bench-{index}",
+                               checkpoint_db=os.path.join(self.workdir, f"checkpoints-{index}.db"),
+                               download_dir=self.client_dir(index), token=self.token)
+
+    def client_dir(self, index):
+        path = os.path.join(self.workdir, f"client-{index}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # A local file of size random bytes (random so neither compression nor
+    # deduplication makes it cheaper than real data)
+    def make_file(self, name, size):
+        path = os.path.join(self.workdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(os.urandom(min(remaining, 1024 * 1024)))
+                remaining -= min(remaining, 1024 * 1024)
+        return path
+
+    # Runs setup(bench) the first time it is asked for
+    def prepare(self, setup):
+        with self.lock:
+            if setup.__name__ not in self.prepared:
+                started = time.monotonic()
+                setup(self)
+                self.prepared.add(setup.__name__)
+                print(f"  {setup.__name__.replace('_', ' ')} took {time.monotonic() - started:.1f}s")
+
+    # Runs op(bench, client, worker, iteration, recorder) on clients threads
+    # until duration is up and returns the scenario's report
+    def run(self, op, clients, duration):
+        recorder = Recorder()
+        ready = threading.Barrier(clients + 1)
+        go = threading.Event()
+        deadline = 0.0
+
+        def worker(index):
+            client = self.client(index)
+            try:
+                client.connect()
+            except OP_ERRORS as e:
+                recorder.error("connect", e)
+            ready.wait()
+            go.wait()
+            iteration = 0
+            try:
+                while time.monotonic() < deadline:
+                    op(self, client, index, iteration, recorder)
+                    iteration += 1
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+        for t in threads:
+            t.start()
+        # Connections are made before the clock starts
+        ready.wait()
+        started = time.monotonic()
+        deadline = started + duration
+        go.set()
+        for t in threads:
+            t.join()
+        return recorder.report(time.monotonic() - started)
+
+
+# --- scenario setups ---
+
+def large_file(bench):
+    with bench.client("setup") as client:
+        client.upload(bench.make_file("source/large.bin", LARGE_SIZE), "bench/large.bin")
+
+
+def medium_file(bench):
+    with bench.client("setup") as client:
+        client.upload(bench.make_file("source/medium.bin", MEDIUM_SIZE), "bench/medium.bin")
+
+
+def resume_file(bench):
+    bench.make_file("source/resume.bin", RESUME_SIZE)
+    with bench.client("setup") as client:
+        client.upload(os.path.join(bench.workdir, "source/resume.bin"), "bench/resume.bin")
+
+
+def listed_files(bench):
+    root = os.path.join(bench.workdir, "source", "list")
+    os.makedirs(root, exist_ok=True)
+    for i in range(LIST_FILES):
+        with open(os.path.join(root, f"{i:06d}.txt"), 'w') as f:
+            f.write(f"{i}\n")
+    with bench.client("setup", pool_size=16) as client:
+        results = client.upload_tree(root, "bench/list", workers=16)
+    failed = sum(isinstance(r, Exception) for r in results.values())
+    if failed:
+        print(f"  {failed} of {LIST_FILES} files for the LIST storm failed to upload")
+
+
+# --- operations, one call is one unit of work of a synthetic client ---
+
+def op_small_upload(bench, client, worker, iteration, recorder):
+    path = os.path.join(bench.client_dir(worker), "small.bin")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(SMALL_SIZE))
+    recorder.measure("upload", SMALL_SIZE, client.upload, path, f"bench/small/{worker}/{iteration}.bin")
+
+
+def op_large_download(bench, client, worker, iteration, recorder):
+    recorder.measure("download", LARGE_SIZE, client.download, "bench/large.bin")
+
+
+def op_list(bench, client, worker, iteration, recorder):
+    recorder.measure("list", 0, client.list, "bench/list/")
+
+
+def op_stat(bench, client, worker, iteration, recorder):
+    recorder.measure("stat", 0, client.stat, [f"bench/list/{random.randrange(LIST_FILES):06d}.txt"])
+
+
+def op_medium_download(bench, client, worker, iteration, recorder):
+    recorder.measure("download", MEDIUM_SIZE, client.download, "bench/medium.bin")
+
+
+# A download that a crashed client left half done: the first half is on
+# disk with a checkpoint, and only the rest is fetched
+def op_resume_download(bench, client, worker, iteration, recorder):
+    path = os.path.join(bench.client_dir(worker), "bench", "resume.bin")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    half = RESUME_SIZE // 2
+    with open(os.path.join(bench.workdir, "source", "resume.bin"), 'rb') as src, open(path, 'wb') as dst:
+        dst.write(src.read(half))
+    client.checkpoints.put(client.owner, "bench/resume.bin", {"bytes_received": half})
+    recorder.measure("resume-download", RESUME_SIZE - half, client.download, "bench/resume.bin")
+
+
+# An upload cut off halfway and then resumed; only the resumed part is timed
+def op_resume_upload(bench, client, worker, iteration, recorder):
+    source = os.path.join(bench.workdir, "source", "resume.bin")
+    name = f"bench/resume-up/{worker}-{iteration}.bin"
+
+    def interrupt(done, total):
+        if done >= total // 2:
+            raise Interrupted()
+
+    try:
+        client.upload(source, name, progress=interrupt)
+    except Interrupted:
+        pass
+    except OP_ERRORS as e:
+        recorder.error("resume-upload", e)
+        return
+    if recorder.measure("resume-upload", RESUME_SIZE // 2, client.upload, source, name):
+        try:
+            client.delete(name)
+        except OP_ERRORS:
+            pass
+
+
+def op_resume(bench, client, worker, iteration, recorder):
+    if iteration % 2:
+        op_resume_upload(bench, client, worker, iteration, recorder)
+    else:
+        op_resume_download(bench, client, worker, iteration, recorder)
+
+
+MIXED = ((op_small_upload, 40), (op_medium_download, 30), (op_list, 10), (op_stat, 20))
+
+
+def op_mixed(bench, client, worker, iteration, recorder):
+    op = random.choices([op for op, _ in MIXED], weights=[weight for _, weight in MIXED])[0]
+    op(bench, client, worker, iteration, recorder)
+
+
+# Scenario name -> (setups, operation)
+SCENARIOS = {
+    "small-uploads": ((), op_small_upload),
+    "large-downloads": ((large_file,), op_large_download),
+    "list-storm": ((listed_files,), op_list),
+    "resume": ((resume_file,), op_resume),
+    "mixed": ((medium_file, listed_files), op_mixed),
+}
+
+
+# --- server process ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+# Creates users.db in directory with an admin account for the bench, returns (username, password)
+def create_bench_user(directory):
+    os.makedirs(directory, exist_ok=True)
+    username, password = "bench", secrets.token_urlsafe(16)
+    db = sqlite3.connect(os.path.join(directory, "users.db"))
+    try:
+        create_tables(db)
+        db.execute('INSERT OR REPLACE INTO users (username, password_hash, role) VALUES (?, ?, ?)',
+                   (username, hash_password(password), "admin"))
+        db.commit()
+    finally:
+        db.close()
+    return username, password
+
+
+# Session token for username on the server at host:port
+def login(host, port, username, password):
+    with FileShareClient(host, port, pool_size=1, keepalive=0) as client:
+        client.login(username, password)
+        return client.token
+
+
+# Starts server.py in directory and waits until it accepts connections
+def start_server(directory, port, mode, extra_args):
+    os.makedirs(directory, exist_ok=True)
+    log_file = open(os.path.join(directory, "server.out"), 'w')
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, "--host", HOST, "--port", str(port),
+                                "--mode", mode] + extra_args,
+                               cwd=directory, stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}, "
+                               f"see {os.path.join(directory, 'server.out')}")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start in time")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# --- results ---
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    print(f"  {result['ops']} ops, {result['errors']} errors, {result['ops_per_sec']} ops/s, "
+          f"{result['mb_per_sec']} MB/s, latency ms p50 {latency['p50']} p95 {latency['p95']} "
+          f"p99 {latency['p99']} max {latency['max']}")
+    if len(result["by_op"]) > 1:
+        for kind, row in result["by_op"].items():
+            print(f"    {kind:<16}{row['ops']:>7} ops{row['ops_per_sec']:>10} ops/s{row['mb_per_sec']:>10} MB/s"
+                  f"   p50 {row['latency_ms']['p50']} p95 {row['latency_ms']['p95']} p99 {row['latency_ms']['p99']}")
+    for sample in result.get("error_samples", [])[:3]:
+        print(f"    ! {sample}")
+
+
+# Metrics where a higher value is better, and where lower is
+HIGHER_BETTER = ("ops_per_sec", "mb_per_sec")
+LOWER_BETTER = ("p50", "p95", "p99")
+
+
+# Prints the change of every metric against an earlier run and returns the
+# regressions beyond threshold
+def compare(baseline, results, threshold):
+    regressions = []
+    print(f"\nCompared with {baseline.get('started', 'baseline')}:")
+    for name, result in results["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            continue
+        rows = [(metric, old[metric], result[metric], True) for metric in HIGHER_BETTER]
+        rows += [(f"{metric} ms", old["latency_ms"][metric], result["latency_ms"][metric], False)
+                 for metric in LOWER_BETTER]
+        for metric, before, after, higher_better in rows:
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = change < -threshold if higher_better else change > threshold
+            print(f"  {name:<16}{metric:<13}{before:>12}{after:>12}{change:>+9.1%}{'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the file sharing server")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--clients", type=int, default=CLIENTS, help="concurrent synthetic clients")
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds per scenario")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded",
+                        help="server engine to start (ignored with --server)")
+    parser.add_argument("--server-arg", action="append", default=[], metavar="ARG",
+                        help="extra argument for the started server, e.g. --server-arg=--storage=chunked")
+    parser.add_argument("--server", metavar="HOST:PORT", help="benchmark a running server instead of starting one")
+    parser.add_argument("--user", help="account to log in to --server with (default: anonymous)")
+    parser.add_argument("--password", help="password of --user")
+    parser.add_argument("--output", help=f"results file (default: {RESULTS_DIR}/<time>-<mode>.json)")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="relative change counted as a regression by --compare")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    opts = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fileshare-bench-")
+    process = None
+    username, password = opts.user, opts.password
+    if opts.server:
+        host, port = opts.server.rsplit(':', 1)
+        port = int(port)
+        mode = "external"
+    else:
+        host, port, mode = HOST, free_port(), opts.mode
+        username, password = create_bench_user(os.path.join(workdir, "server"))
+        process = start_server(os.path.join(workdir, "server"), port, mode, opts.server_arg)
+    try:
+        token = login(host, port, username, password or "") if username else None
+    except BaseException:
+        if process:
+            stop_server(process)
+        raise
+    bench = Bench(host, port, workdir, token)
+    started = datetime.now()
+    results = {
+        "started": started.isoformat(timespec="seconds"),
+        "config": {"clients": opts.clients, "duration": opts.duration, "mode": mode,
+                   "server_args": opts.server_arg, "small_size": SMALL_SIZE, "medium_size": MEDIUM_SIZE,
+                   "large_size": LARGE_SIZE, "resume_size": RESUME_SIZE, "list_files": LIST_FILES},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "scenarios": {},
+    }
+    print(f"Benchmarking {host}:{port} ({mode}) with {opts.clients} clients, {opts.duration:g}s per scenario")
+    try:
+        for name in opts.scenarios:
+            setups, op = SCENARIOS[name]
+            print(f"{name}:")
+            for setup in setups:
+                bench.prepare(setup)
+            results["scenarios"][name] = bench.run(op, opts.clients, opts.duration)
+            print_result(name, results["scenarios"][name])
+        try:
+            with bench.client("stats") as client:
+                results["server_stats"] = client.stats()
+        except OP_ERRORS:
+            pass  # Servers without STATS
+    finally:
+        if process:
+            stop_server(process)
+        if opts.keep:
+            print(f"Scratch directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = opts.output or os.path.join(RESULTS_DIR, f"{started:%Y%m%d-%H%M%S}-{mode}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            regressions = compare(json.load(f), results, opts.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {opts.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,282 +1,319 @@
-import socket
 import os
-import hashlib
-from datetime import datetime
 import sys
+import getpass
 import math
 import time
-import json
+from datetime import datetime
+
+from utils.fileshare import FileShareClient, FileShareError
+from utils.logger import get_logger
+from utils.protocol import ProtocolError
+
+# Command line front end; the protocol work is done by utils/fileshare.py
 
 # server configuration
 HOST = 'localhost'
 PORT = 5002
-DOWNLOAD = 'downloaded'  # directory to save downloaded files
 LOG_FILE = 'logs/client_log.txt'  # log file for clients
-CHECKPOINT_FILE = 'logs/client_checkpoints.json'  # File to store download progress
+PARALLEL_CONNECTIONS = 4  # Default number of connections for PDOWNLOAD
+UPLOAD_WORKERS = 8  # Default number of concurrent uploads for UPLOADDIR (and connections kept)
 
-# function to log events
-def log(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, 'a') as f:
-        f.write(f"[{timestamp}] {message}\n")
+# function to log events, written out in the background
+logger = get_logger(LOG_FILE)
 
-# helper to read a full line ending with '\n'
-def recv_line(sock, expect_binary=False):
-    buffer = b'' if expect_binary else ''
-    while True:
-        data = sock.recv(1024)
-        if not data:
-            break
-        if expect_binary:
-            buffer += data
+def log(message, **fields):
+    logger.log(message, **fields)
+
+def format_size(size):
+    """Convert bytes to human-readable format"""
+    if size == 0:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB")
+    i = int(math.floor(math.log(size, 1024)))
+    p = math.pow(1024, i)
+    s = round(size / p, 2)
+    return f"{s} {size_name[i]}"
+
+def format_time(seconds):
+    """Convert seconds to MM:SS format"""
+    minutes = int(seconds // 60)
+    seconds = int(seconds % 60)
+    return f"{minutes:02d}:{seconds:02d}"
+
+# console progress bar, as a progress(done, total) callback for the client.
+# It starts over for the next transfer once one has finished.
+def progress_bar(label):
+    state = {}
+
+    def draw(done, total):
+        current_time = time.time()
+        if not state or state["finished"]:
+            # Bytes present at the start (a resumed transfer) don't count towards the speed
+            state.update(start=current_time, first=done, last_update=0, finished=False)
+        finished = done >= total
+        # Update progress every 100ms or when the transfer completes
+        if current_time - state["last_update"] <= 0.1 and not finished:
+            return
+        state["last_update"] = current_time
+        state["finished"] = finished
+
+        elapsed = current_time - state["start"]
+        progress = done / total if total else 1.0
+        speed = (done - state["first"]) / elapsed / 1024 if elapsed > 0 else 0.0  # KB/s
+        bar_length = 50
+        filled_length = int(round(bar_length * progress))
+        bar = '█' * filled_length + '-' * (bar_length - filled_length)
+
+        # Calculate estimated time remaining
+        if progress > 0 and speed > 0:
+            eta_str = format_time((total - done) / 1024 / speed)
         else:
-            buffer += data.decode()
-        if b'\n' in buffer if expect_binary else '\n' in buffer:
-            line, _ = buffer.split(b'\n' if expect_binary else '\n', 1)
-            return line
-    return buffer
+            eta_str = "--:--"
 
-# list files on server
-def list_files(sock):
-    sock.send("LIST\n".encode())
-    files = sock.recv(4096).decode()
-    print("Files on Server:\n", files)
-    log("Requested list of files from server.")
+        sys.stdout.write(
+            f"\r{label}: |{bar}| {round(progress * 100, 1)}% "
+            f"{format_size(done)}/{format_size(total)} "
+            f"[{speed:.2f} KB/s, ETA: {eta_str}, Elapsed: {format_time(elapsed)}]"
+            + ("\n" if finished else "")
+        )
+        sys.stdout.flush()
+
+    return draw
+
+# list files on server, optionally filtered by a glob pattern (or name
+# prefix) and sorted by name, size or mtime
+def list_files(client, pattern=None, sort="name", descending=False):
+    entries = client.list(pattern, sort, descending)
+    print("Files on Server:")
+    for entry in entries:
+        print(" " + entry.name)
+
+# size, mtime and hash of server files
+def stat_files(client, filenames):
+    for name, stat in client.stat(filenames).items():
+        if stat is None:
+            print(f"{name}: not found on server")
+            continue
+        size, mtime, file_hash = stat
+        modified = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{name}: {size} bytes, modified {modified}, sha256 {file_hash}")
+
+# server metrics: totals, then one row per command
+def show_stats(client):
+    stats = client.stats()
+    server, throughput = stats.pop("server", {}), stats.pop("throughput", {})
+    admission = stats.pop("admission", {})
+    limits = {name[4:]: stats.pop(name) for name in list(stats) if name.startswith("qos:")}
+    cache = stats.pop("cache", None)
+    print(f"Uptime {format_time(server.get('uptime', 0))}, {server.get('connections', 0):.0f} connection(s) open, "
+          f"{server.get('requests', 0):.0f} requests, {server.get('errors', 0):.0f} errors, "
+          f"{format_size(server.get('bytes_in', 0))} in, {format_size(server.get('bytes_out', 0))} out"
+          + (f" (worker {server['worker']:.0f} only)" if "worker" in server else ""))
+    if throughput.get("count"):
+        print(f"Transfers: {throughput['count']:.0f}, mean {throughput['mean']:.2f} MB/s, "
+              f"p50 {throughput['p50']:.2f} MB/s, p95 {throughput['p95']:.2f} MB/s")
+    busy = {k[5:]: v for k, v in admission.items() if k.startswith("busy_")}
+    reaped = {k[7:]: v for k, v in admission.items() if k.startswith("reaped_")}
+    print(f"Load: {admission.get('transfers', 0):.0f} transfers running, "
+          f"{format_size(admission.get('upload_bytes_in_flight', 0))} of uploads in flight; "
+          f"BUSY {', '.join(f'{k} {v:.0f}' for k, v in busy.items()) or 'never'}; "
+          f"closed {', '.join(f'{k} {v:.0f}' for k, v in reaped.items()) or 'none'}")
+    if cache is not None:
+        lookups = cache['hits'] + cache['misses']
+        print(f"File cache: {cache['files']:.0f} files, {format_size(cache['bytes'])} of {format_size(cache['budget'])}, "
+              f"{cache['hits'] / lookups if lookups else 0:.0%} hits, {cache['evictions']:.0f} evicted, "
+              f"{cache['invalidations']:.0f} invalidated")
+    for name, row in limits.items():
+        print(f"Rate limit {name}: {format_size(row.get('rate', 0))}/s of {format_size(row['limit'])}/s, "
+              f"throttled {row['throttled']:.1f}s")
+    print(f"{'command':<11}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in stats.items():
+        print(f"{name:<11}{row['count']:>8.0f}{row['errors']:>8.0f}{row['p50']:>10.2f}{row['p95']:>10.2f}"
+              f"{row['p99']:>10.2f}{row['max']:>10.2f}")
 
 # upload file
-def upload_file(sock, path):
-    filename = os.path.basename(path)
-    if not os.path.exists(path):
+def upload_file(client, path):
+    if not os.path.isfile(path):
         print("File does not exist.")
         log(f"Upload failed: File '{path}' does not exist.")
         return
-
     size = os.path.getsize(path)
-    print(f"File size: {size} bytes")
+    print(f"Uploading {os.path.basename(path)} (size: {size})")
+    client.upload(path, progress=progress_bar("Upload progress"))
+    print("Upload successful [Hash verified]")
 
-    # Compute SHA-256 hash
-    hasher = hashlib.sha256()
-    with open(path, 'rb') as f:
-        while chunk := f.read(1024):
-            hasher.update(chunk)
-    sha256_hash = hasher.hexdigest()
+# upload every file under a directory, keeping relative paths (under prefix,
+# by default the directory's name) and skipping files the server already has
+def upload_tree(client, path, prefix=None, workers=UPLOAD_WORKERS):
+    if not os.path.isdir(path):
+        print("Directory does not exist.")
+        log(f"Upload failed: Directory '{path}' does not exist.")
+        return
+    bar = progress_bar(f"Upload progress ({workers} connections)")
+    sent = 0
 
-    print(f"Uploading {filename} (size: {size}, hash: {sha256_hash[:8]}...)")
+    def progress(done, total):
+        nonlocal sent
+        sent = done
+        bar(done, total)
 
-    try:
-        # Send command with newline
-        sock.send(f"UPLOAD {filename} {size}\n".encode())
+    started = time.time()
+    results = client.upload_tree(path, prefix, workers, progress=progress)
+    elapsed = time.time() - started
+    failed = {name: result for name, result in results.items() if isinstance(result, Exception)}
+    for name, error in failed.items():
+        print(f"{name}: {error}")
+    uploaded = sum(1 for result in results.values() if result == "uploaded")
+    print(f"{uploaded} uploaded, {len(results) - uploaded - len(failed)} unchanged, {len(failed)} failed; "
+          f"{format_size(sent)} in {elapsed:.1f}s ({sent / elapsed / 1024 / 1024 if elapsed else 0:.2f} MB/s)")
 
-        # Wait for server's response
-        response = recv_line(sock)
-        if response != "READY":
-            print("Server not ready for upload")
-            return
+# every version the server keeps of a file, newest first
+def list_versions(client, filename):
+    rows = client.versions(filename)
+    if not rows:
+        print(f"No versions of {filename} on server.")
+        return
+    print(f"Versions of {filename}:")
+    for version, size, created, file_hash, current in rows:
+        created = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"  v{version}: {size} bytes, {created}, sha256 {(file_hash or '-')[:16]}... "
+              f"({'current' if current else 'archived'})")
 
-        # Send file in chunks with progress
-        uploaded = 0
-        chunk_size = 4096  # Increased chunk size
-        with open(path, 'rb') as f:
-            while chunk := f.read(chunk_size):
-                try:
-                    sock.sendall(chunk)  # sendall ensures complete transmission
-                    uploaded += len(chunk)
-                    # Show progress
-                    progress = (uploaded / size) * 100
-                    print(f"\rUpload progress: {progress:.1f}%", end='', flush=True)
-                except (ConnectionResetError, BrokenPipeError) as e:
-                    print(f"\nUpload interrupted: {e}")
-                    log(f"Upload interrupted for '{filename}' at {uploaded} bytes")
-                    return
+# download file, or one version of it (saved as <name>_v<version><ext>)
+def download_file(client, filename, version=None):
+    path = client.download(filename, version, progress=progress_bar("Downloading"))
+    print(f"Downloaded {os.path.basename(path)} [Hash verified]")
 
-        print("\nWaiting for hash verification...")
-        # Receive hash from server
-        received_hash = recv_line(sock)
-        if received_hash == sha256_hash:
-            print(f"Upload successful [Hash verified]")
-            log(f"Uploaded file '{filename}' ({size} bytes)")
+# download several files over one pipelined connection
+def download_files(client, filenames):
+    results = client.download_many(filenames, progress=progress_bar("Downloading"))
+    for filename in filenames:
+        result = results.get(filename)
+        if isinstance(result, Exception):
+            print(f"{filename}: {result}")
         else:
-            print("Hash mismatch after upload.")
-            log(f"Hash mismatch for '{filename}'. Expected: {sha256_hash}, Received: {received_hash}")
+            print(f"Downloaded {filename} [Hash verified]")
 
-    except ConnectionResetError as e:
-        print(f"\nConnection lost during upload: {e}")
-        log(f"Connection lost during upload of '{filename}': {e}")
-    except Exception as e:
-        print(f"\nUpload error: {e}")
-        log(f"Error uploading '{filename}': {e}")
+# download many files as one streamed archive, extracted as it arrives
+def download_batch(client, patterns):
+    results = client.download_batch(patterns, progress=progress_bar("Downloading"))
+    failed = {name: result for name, result in results.items() if isinstance(result, Exception)}
+    for name, error in failed.items():
+        print(f"{name}: {error}")
+    print(f"Downloaded {len(results) - len(failed)} file(s) [Hashes verified]")
 
-# download file
+# download one file over several connections at once
+def parallel_download(client, filename, connections):
+    client.parallel_download(filename, connections,
+                             progress=progress_bar(f"Parallel download ({connections} connections)"))
+    print(f"Downloaded {filename} [Hash verified]")
 
-def download_file(sock, filename):
-    # Check for existing partial download
-    checkpoints = {}
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as f:
-            try:
-                checkpoints = json.load(f)
-            except json.JSONDecodeError:
-                checkpoints = {}
-    
-    resume_from = 0
-    partial_file = os.path.join(DOWNLOAD, filename)
-    if filename in checkpoints and os.path.exists(partial_file):
-        resume_from = checkpoints[filename]["bytes_received"]
-        print(f"Resuming download from byte {resume_from}")
-        actual_size = os.path.getsize(partial_file)
-        if actual_size != resume_from:
-            print(f"Warning: Partial file size ({actual_size}) doesn't match checkpoint ({resume_from}). Adjusting.")
-            resume_from = actual_size
-        print(f"Resuming download from byte {resume_from}")
-    
-    sock.send(f"DOWNLOAD {filename}\n".encode())
-    size_data = recv_line(sock)
-    if size_data == "ERROR":
-        print("File not found on server.")
-        log(f"Download failed: File '{filename}' not found on server.")
-        return
-    
-    total_size = int(size_data)
-    if resume_from > 0:
-        sock.send(f"RESUME {resume_from}\n".encode())
-    else:
-        sock.send("READY\n".encode())
-    
-    mode = 'ab' if resume_from > 0 else 'wb'
-    
-    # Initialize progress bar
-    start_time = time.time()
-    bytes_received = resume_from
-    last_update_time = start_time
-
-    
-    def format_size(size):
-        """Convert bytes to human-readable format"""
-        if size == 0:
-            return "0B"
-        size_name = ("B", "KB", "MB", "GB", "TB")
-        i = int(math.floor(math.log(size, 1024)))
-        p = math.pow(1024, i)
-        s = round(size / p, 2)
-        return f"{s} {size_name[i]}"
-    
-    def format_time(seconds):
-        """Convert seconds to MM:SS format"""
-        minutes = int(seconds // 60)
-        seconds = int(seconds % 60)
-        return f"{minutes:02d}:{seconds:02d}"
-    
-    def draw_progress_bar(progress, speed, elapsed):
-        """Draw a progress bar in the console"""
-        bar_length = 50
-        filled_length = int(round(bar_length * progress))
-        bar = '█' * filled_length + '-' * (bar_length - filled_length)
-        percent = round(progress * 100, 1)
-        
-        # Calculate estimated time remaining
-        if progress > 0 and speed > 0:
-            remaining_bytes = total_size - bytes_received
-            eta = remaining_bytes / speed
-            eta_str = format_time(eta)
+# runs one command line; returns False when the session should end
+def run_command(client, cmd):
+    if cmd.upper().startswith("LIST"):
+        parts = cmd.split()[1:]
+        sort = next((p.split('=', 1)[1] for p in parts if p.startswith("sort=")), "name")
+        descending = "desc" in parts
+        pattern = next((p for p in parts if not p.startswith("sort=") and p != "desc"), None)
+        list_files(client, pattern, sort, descending)
+    elif cmd.upper() == "STATS":
+        show_stats(client)
+    elif cmd.upper().startswith("STAT"):
+        parts = cmd.split()
+        if len(parts) < 2:
+            print("Invalid STAT command format. Use: STAT filename [filename ...]")
         else:
-            eta_str = "--:--"
-        
-        sys.stdout.write(
-            f"\rDownloading: |{bar}| {percent}% "
-            f"{format_size(bytes_received)}/{format_size(total_size)} "
-            f"[{speed:.2f} KB/s, ETA: {eta_str}, Elapsed: {format_time(elapsed)}]"
-)
-        sys.stdout.flush()
-    
-    with open(partial_file, mode) as f:
-        while bytes_received < total_size:
-            chunk = sock.recv(1024)
-            if not chunk:
-                break
-            f.write(chunk)
-            bytes_received += len(chunk)
-            
-            # Update progress every 100ms or when download completes
-            current_time = time.time()
-            if current_time - last_update_time > 0.1 or bytes_received == total_size:
-                elapsed_time = current_time - start_time
-                progress = bytes_received / total_size
-                speed = (bytes_received - resume_from) / elapsed_time / 1024  # KB/s
-                draw_progress_bar(progress, speed, elapsed_time)
-                last_update_time = current_time
-            
-            # Save checkpoint every 1MB
-            if bytes_received % (1024 * 1024) == 0:
-                checkpoints[filename] = {
-                    "bytes_received": bytes_received,
-                    "timestamp": datetime.now().isoformat()
-                }
-                with open(CHECKPOINT_FILE, 'w') as cp_file:
-                    json.dump(checkpoints, cp_file)
-                
-    
-    # Print new line after progress bar completes
-    print()
-    
-    # Receive hash of downloaded file
-    server_hash = recv_line(sock)
-
-    # Compute local hash
-    hasher = hashlib.sha256()
-    with open(partial_file, 'rb') as f:
-        while chunk := f.read(1024):
-            hasher.update(chunk)
-    local_hash = hasher.hexdigest()
-
-    if local_hash == server_hash:
-        print(f"Downloaded {filename} [Hash verified]")
-        log(f"Downloaded '{filename}' ({total_size} bytes) with matching hash.")
-        # Remove checkpoint if download completed successfully
-        if filename in checkpoints:
-            del checkpoints[filename]
-            with open(CHECKPOINT_FILE, 'w') as cp_file:
-                json.dump(checkpoints, cp_file)
+            stat_files(client, parts[1:])
+    elif cmd.upper().startswith("UPLOADDIR"):
+        parts = cmd.split()[1:]
+        options = {}
+        while parts and parts[-1].split('=', 1)[0] in ("prefix", "workers"):
+            key, value = parts.pop().split('=', 1)
+            options[key] = value
+        if not parts or not options.get("workers", "1").isdigit():
+            print("Invalid UPLOADDIR command format. Use: UPLOADDIR directory [prefix=name] [workers=N]")
+        else:
+            upload_tree(client, ' '.join(parts), options.get("prefix"),
+                        int(options.get("workers", UPLOAD_WORKERS)) or 1)
+    elif cmd.upper().startswith("UPLOAD"):
+        try:
+            _, path = cmd.split(maxsplit=1)
+        except ValueError:
+            print("Invalid UPLOAD command format.")
+            log("UPLOAD command failed: Invalid format.")
+            return True
+        upload_file(client, path)
+    elif cmd.upper().startswith("PDOWNLOAD"):
+        parts = cmd.split()
+        if len(parts) not in (2, 3) or (len(parts) == 3 and not parts[2].isdigit()):
+            print("Invalid PDOWNLOAD command format. Use: PDOWNLOAD filename [connections]")
+        else:
+            connections = int(parts[2]) if len(parts) == 3 else PARALLEL_CONNECTIONS
+            parallel_download(client, parts[1], connections)
+    elif cmd.upper().startswith("BATCH"):
+        parts = cmd.split()
+        if len(parts) < 2:
+            print("Invalid BATCH command format. Use: BATCH name|pattern [name|pattern ...]")
+        else:
+            download_batch(client, parts[1:])
+    elif cmd.upper().startswith("VERSIONS"):
+        parts = cmd.split()
+        if len(parts) != 2:
+            print("Invalid VERSIONS command format. Use: VERSIONS filename")
+        else:
+            list_versions(client, parts[1])
+    elif cmd.upper().startswith("DOWNLOAD"):
+        parts = cmd.split()
+        if len(parts) == 3 and parts[2].startswith("version=") and parts[2][8:].isdigit():
+            download_file(client, parts[1], int(parts[2][8:]))
+        elif len(parts) < 2:
+            print("Invalid DOWNLOAD command format. Use: DOWNLOAD filename [filename ...] or DOWNLOAD filename version=N")
+            log("DOWNLOAD command failed: Invalid format.")
+        elif len(parts) == 2:
+            download_file(client, parts[1])
+        else:
+            download_files(client, parts[1:])
+    elif cmd.upper() == "EXIT":
+        log("Client exited session.")
+        return False
     else:
-        print("Hash mismatch after download.")
-        log(f"Hash mismatch for '{filename}': local {local_hash}, server {server_hash}")
+        print("Unknown command.")
+        log(f"Unknown command entered: '{cmd}'")
+    return True
 
 def main():
+    # The server checks the password once and the connections after the first log in with its token
+    username = input("Username (blank to connect without logging in): ").strip() or None
+    password = getpass.getpass("Password: ") if username else None
+    client = FileShareClient(HOST, PORT, pool_size=UPLOAD_WORKERS, notify=print, username=username,
+                             password=password)
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((HOST, PORT))
-        log(f"Connected to server at {HOST}:{PORT}")
-    except Exception as e:
+        version = client.connect()
+        log(f"Connected to server at {HOST}:{PORT} (protocol v{version})"
+            + (f" as {username} ({client.role})" if username else ""))
+    except (OSError, ProtocolError, FileShareError) as e:
         log(f"Connection failed: {e}")
-        print("Failed to connect to server.")
+        print(f"Failed to connect to server: {e}" if isinstance(e, FileShareError) else "Failed to connect to server.")
+        client.close()
         return
 
     while True:
-        cmd = input("Enter command (LIST, UPLOAD x, DOWNLOAD x, EXIT): ").strip()
-        if cmd.upper() == "LIST":
-            list_files(sock)
-        elif cmd.upper().startswith("UPLOAD"):
-            try:
-                _, path = cmd.split(maxsplit=1)
-                upload_file(sock, path)
-            except ValueError:
-                print("Invalid UPLOAD command format.")
-                log("UPLOAD command failed: Invalid format.")
-        elif cmd.upper().startswith("DOWNLOAD"):
-            parts = cmd.split()
-            if len(parts) != 2:
-                print("Invalid DOWNLOAD command format. Use: DOWNLOAD filename")
-                log("DOWNLOAD command failed: Invalid format.")
-            else:
-                filename = parts[1]
-                download_file(sock, filename)
-        elif cmd.upper() == "EXIT":
-            log("Client exited session.")
-            break
-        else:
-            print("Unknown command.")
-            log(f"Unknown command entered: '{cmd}'")
-    sock.close()
-    log("Socket closed.")
+        cmd = input("Enter command (LIST [pattern] [sort=name|size|mtime] [desc], STAT x [y ...], STATS, UPLOAD x, UPLOADDIR dir [prefix=p] [workers=n], DOWNLOAD x [y ...|version=N], VERSIONS x, PDOWNLOAD x [n], BATCH x|pattern [...], EXIT): ").strip()
+        try:
+            if not run_command(client, cmd):
+                break
+        except FileShareError as e:
+            print(f"Error: {e}")
+        except (OSError, ProtocolError) as e:
+            # The client already retried; the server is unreachable for now
+            print(f"\nConnection problem: {e}. Run the command again to resume.")
+            log(f"Command '{cmd}' failed: {e}")
+    try:
+        client.logout()
+    except (OSError, ProtocolError, FileShareError):
+        pass  # The session expires on its own
+    client.close()
+    log("Connections closed.")
 
 if __name__ == "__main__":
     main()
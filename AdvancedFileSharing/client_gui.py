@@ -1,8 +1,11 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import socket, os, threading, hashlib
+from tkinter import filedialog, messagebox, simpledialog
+import os, threading
 from datetime import datetime
 
+from utils.fileshare import FileShareClient
+from utils.logger import get_logger
+
 HOST = 'localhost'
 PORT = 5002
 DOWNLOAD = 'downloaded'
@@ -11,11 +14,12 @@ LOG_FILE = 'logs/client_log.txt'
 os.makedirs(DOWNLOAD, exist_ok=True)
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
+logger = get_logger(LOG_FILE)
+
 def log(message, gui_log_widget=None):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, 'a') as f:
-        f.write(f"[{timestamp}] {message}\n")
+    logger.log(message)
     if gui_log_widget:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         gui_log_widget.insert(tk.END, f"[{timestamp}] {message}\n")
         gui_log_widget.see(tk.END)
 
@@ -26,7 +30,7 @@ class FileClientApp:
         self.root.geometry("500x460")
         self.root.resizable(False, False)
         self.root.configure(bg="#f0f4f7")
-        self.sock = None
+        self.client = None
 
         #this for the button format
         btn_style = {
@@ -70,132 +74,96 @@ class FileClientApp:
         self.log_text = tk.Text(root, height=6, font=("Consolas", 9), bg="white")
         self.log_text.pack(fill="both", padx=20, pady=(0, 10))
 
+    # Tk widgets may only be touched from the main loop; worker threads go through here
+    def ui(self, func, *args):
+        self.root.after(0, func, *args)
+
+    def report(self, message):
+        self.ui(log, message, self.log_text)
+
+    def show_progress(self, done, total):
+        self.ui(self.progress.set, int(done * 100 / total) if total else 100)
+
     def connect_to_server(self):
         try:
-            if self.sock:
-                self.sock.close()
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((HOST, PORT))
+            if self.client:
+                self.client.close()
+            # No name (or Cancel) connects without logging in, if the server allows that
+            username = simpledialog.askstring("Login", "Username:", parent=self.root) or None
+            password = simpledialog.askstring("Login", "Password:", show="*", parent=self.root) if username else None
+            self.client = FileShareClient(HOST, PORT, download_dir=DOWNLOAD, notify=self.report,
+                                          username=username, password=password or "")
+            self.client.connect()
             self.upload_btn.config(state="normal")
             self.download_btn.config(state="normal")
             self.refresh_btn.config(state="normal")
-            log("Connected to server", self.log_text)
+            log(f"Connected to server as {username} ({self.client.role})" if username else "Connected to server",
+                self.log_text)
             self.list_files()
         except Exception as e:
             messagebox.showerror("Connection Error", str(e))
             log(f"Connection failed: {e}", self.log_text)
 
-    def recv_line(self):
-        buffer = ''
-        while True:
-            data = self.sock.recv(1024).decode()
-            if not data:
-                break
-            buffer += data
-            if '\n' in buffer:
-                line, _ = buffer.split('\n', 1)
-                return line.strip()
-        return buffer.strip()
-
     def list_files(self):
+        threading.Thread(target=self._list_files_thread, daemon=True).start()
+
+    def _list_files_thread(self):
         try:
-            self.sock.send("LIST\n".encode())
-            files = self.sock.recv(4096).decode().split('\n')
-            self.file_listbox.delete(0, tk.END)
-            for f in files:
-                if f.strip():
-                    self.file_listbox.insert(tk.END, f)
-            log("Listed files from server", self.log_text)
+            names = [entry.name for entry in self.client.list()]
+            self.ui(self.show_files, names)
+            self.report("Listed files from server")
         except Exception as e:
-            log(f"Failed to list files: {e}", self.log_text)
+            self.report(f"Failed to list files: {e}")
+
+    def show_files(self, names):
+        self.file_listbox.delete(0, tk.END)
+        for name in names:
+            self.file_listbox.insert(tk.END, name)
 
     def upload_file(self):
         filepath = filedialog.askopenfilename()
         if not filepath:
             return
-        threading.Thread(target=self._upload_file_thread, args=(filepath,)).start()
+        threading.Thread(target=self._upload_file_thread, args=(filepath,), daemon=True).start()
 
     def _upload_file_thread(self, filepath):
+        filename = os.path.basename(filepath)
         try:
-            filename = os.path.basename(filepath)
-            size = os.path.getsize(filepath)
-            self.sock.send(f"UPLOAD {filename} {size}\n".encode())
-            response = self.recv_line()
-
-            if response == "READY":
-                hasher = hashlib.sha256()
-                sent = 0
-                with open(filepath, 'rb') as f:
-                    while chunk := f.read(1024):
-                        self.sock.send(chunk)
-                        hasher.update(chunk)
-                        sent += len(chunk)
-                        self.progress.set(int((sent / size) * 100))
-
-                server_hash = self.recv_line()
-                if server_hash == hasher.hexdigest():
-                    messagebox.showinfo("Success", "Upload complete and verified.")
-                    log(f"Uploaded {filename} successfully", self.log_text)
-                else:
-                    messagebox.showwarning("Warning", "Hash mismatch after upload.")
-            else:
-                messagebox.showerror("Error", "Server did not respond with READY.")
-            self.progress.set(0)
+            self.client.upload(filepath, progress=self.show_progress)
+            self.ui(messagebox.showinfo, "Success", "Upload complete and verified.")
+            self.report(f"Uploaded {filename} successfully")
             self.list_files()
         except Exception as e:
-            log(f"Upload failed: {e}", self.log_text)
-            messagebox.showerror("Upload Error", str(e))
+            self.report(f"Upload failed: {e}")
+            self.ui(messagebox.showerror, "Upload Error", str(e))
+        self.ui(self.progress.set, 0)
 
     def download_file(self):
         selected = self.file_listbox.curselection()
         if not selected:
             return
         filename = self.file_listbox.get(selected[0])
-        threading.Thread(target=self._download_file_thread, args=(filename,)).start()
+        threading.Thread(target=self._download_file_thread, args=(filename,), daemon=True).start()
 
     def double_click_download(self, event):
         selection = event.widget.curselection()
         if selection:
             filename = event.widget.get(selection[0])
-            threading.Thread(target=self._download_file_thread, args=(filename,)).start()
+            threading.Thread(target=self._download_file_thread, args=(filename,), daemon=True).start()
 
     def _download_file_thread(self, filename):
         try:
-            self.sock.send(f"DOWNLOAD {filename}\n".encode())
-            size_data = self.recv_line()
-            if size_data == "ERROR":
-                messagebox.showerror("Error", "File not found on server.")
-                return
-            size = int(size_data)
-            self.sock.send("READY\n".encode())
-            filepath = os.path.join(DOWNLOAD, filename)
-
-            received = 0
-            with open(filepath, 'wb') as f:
-                while received < size:
-                    chunk = self.sock.recv(1024)
-                    f.write(chunk)
-                    received += len(chunk)
-                    self.progress.set(int((received / size) * 100))
-
-            server_hash = self.recv_line()
-            hasher = hashlib.sha256()
-            with open(filepath, 'rb') as f:
-                while chunk := f.read(1024):
-                    hasher.update(chunk)
-
-            if hasher.hexdigest() == server_hash:
-                messagebox.showinfo("Download", f"Download of '{filename}' completed and verified.")
-                log(f"Downloaded {filename} successfully", self.log_text)
-            else:
-                log(f"Hash mismatch after downloading {filename}", self.log_text)
-                messagebox.showwarning("Download", "Hash mismatch after download, but file was saved.")
-            self.progress.set(0)
+            self.client.download(filename, progress=self.show_progress)
+            self.ui(messagebox.showinfo, "Download", f"Download of '{filename}' completed and verified.")
+            self.report(f"Downloaded {filename} successfully")
         except Exception as e:
-            log(f"Download failed: {e}", self.log_text)
-            messagebox.showerror("Download Error", str(e))
+            self.report(f"Download failed: {e}")
+            self.ui(messagebox.showerror, "Download Error", str(e))
+        self.ui(self.progress.set, 0)
 
 if __name__== "__main__":
     root = tk.Tk()
     app = FileClientApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    if app.client:
+        app.client.close()
@@ -1,198 +1,1717 @@
 import socket
 import threading
 import os
-import hashlib
 from datetime import datetime
-import json
+import time
+import uuid
+import hashlib
+import argparse
+import asyncio
+import atexit
+import io
+import base64
+import re
+import sqlite3
+import signal
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.integrity import HashIndex, sha256_file
+from utils.merkle import MerkleIndex
+from utils.filecache import FileCache
+from utils.transfer import HashingWriter, hash_prefix
+from utils.uploads import UploadSessions
+from utils.checkpoints import CheckpointStore
+from utils.logger import get_logger
+from utils.dirindex import DirectoryIndex, ChangeLog, Entry, GLOB_CHARS, MAX_PAGE
+from utils.versions import VersionCatalog
+from utils.chunkstore import ChunkStore, read_manifest
+from utils import delta
+from utils.compression import Compressor, Decompressor, Framer, choose_codec, sample_file
+from utils.archive import member_header, member_padding, END_OF_ARCHIVE
+from utils.names import split_name, name_for
+from utils.metrics import Metrics, serve_http
+from utils.admission import ConnectionTable, FailureCounter, Limiter
+from utils.qos import QoS, parse_rate
+from utils.locking import ProcessLock
+from utils.auth import Accounts
+from utils.engine import Send, Call, Sleep, AsyncStream, run_sync, run_async
+from utils.protocol import (PROTOCOL_VERSION, Connection, ProtocolError, recv_message, send_message,
+                            send_lines, send_lines_part, end_lines, send_file_payload, send_compressed_payload, send_payload,
+                            send_buffer_payload,
+                            send_blocks,
+                            recv_payload_into, recv_payload_exact, recv_block)
 
 # Server configuration
 HOST = 'localhost'
 PORT = 5002
 UPLOAD = 'uploaded'  # Directory where uploaded files will be saved
 LOG_FILE = 'logs/server_log.txt'  # Path to the log file
-CHECKPOINT_FILE = 'logs/download_checkpoints.json'  # File to store download progress
+LOG_FORMAT = 'text'  # 'text' lines or 'json' records
+METADATA_DB = 'fileshare.db'  # SQLite database for server-side indexes (next to users.db)
+SERVER_MODE = 'threaded'  # 'threaded' (thread per client) or 'async' (event loop)
+CONN_TIMEOUT = 30.0  # Seconds a client may stay silent before it is dropped
+CHUNK_SIZE = 256 * 1024  # Per-connection buffer for received upload data
+BACKLOG = 1024  # Pending connections the listening socket will queue before they are accepted
+EXECUTOR_WORKERS = 32  # Threads for disk work in async mode
+SEND_BUFFER_SIZE = None  # SO_SNDBUF in bytes, None leaves the kernel's autotuning on
+RECV_BUFFER_SIZE = None  # SO_RCVBUF in bytes, None leaves the kernel's autotuning on
+PARTIAL_DIR = os.path.join(UPLOAD, '.partial')  # Uploads in progress, published when complete
+UPLOAD_SESSION_TTL = 24 * 3600  # Seconds an abandoned partial upload is kept
+UPLOAD_COMMIT_INTERVAL = 8 * 1024 * 1024  # Bytes between fsyncs of a resumable upload
+REAP_INTERVAL = 600  # Seconds between sweeps for expired partial uploads and checkpoints
+CHECKPOINT_TTL = 7 * 24 * 3600  # Seconds a download checkpoint is kept without updates
+CLIENT_ID_PATTERN = re.compile(r'[A-Za-z0-9_.-]{1,64}')  # Identities accepted by IDENT
+LIST_PAGE_SIZE = 1000  # Default LIST page, also the step a full listing is streamed in
+STORAGE_BACKEND = 'plain'  # 'plain' stores full copies, 'chunked' deduplicates into CHUNK_DIR
+CHUNK_DIR = os.path.join(UPLOAD, '.chunks')  # Content-addressed chunks for the chunked backend
+VERSION_DIR = os.path.join(UPLOAD, 'VersionHistory')  # Older versions of uploaded files
+KEEP_VERSIONS = 10  # Versions kept per file, current one included (None: no limit)
+MAX_VERSION_AGE = None  # Seconds an older version is kept (None: no limit)
+MAX_VERSION_BYTES = None  # Bytes of older versions kept per file (None: no limit)
+MAX_BATCH_FILES = 10000  # Most files one BATCH reply may contain
+MERKLE_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes of file per leaf of the trees MERKLE serves
+MERKLE_WORKERS = os.cpu_count() or 1  # Threads hashing the chunks of one file when its tree is built
+FILE_CACHE_SIZE = 256 * 1024 * 1024  # Bytes of popular small files DOWNLOAD serves from memory, per worker (0: no cache)
+FILE_CACHE_MAX_FILE = 4 * 1024 * 1024  # Larger files are never cached
+FILE_CACHE_ADMIT_AFTER = 2  # Downloads of a file before it is cached
+METRICS_HOST = '127.0.0.1'  # Interface the Prometheus endpoint listens on
+METRICS_PORT = None  # Port of the Prometheus endpoint (GET /metrics), None to disable it
+MAX_CONNECTIONS = 1024  # Connections served at once, more are answered BUSY (None: no limit)
+MAX_TRANSFERS = 64  # Uploads and downloads running at once (None: no limit)
+MAX_UPLOAD_BYTES = 4 * 1024 ** 3  # Upload bytes announced but not yet received, all clients together (None: no limit)
+TRANSFER_COMMANDS = {"UPLOAD", "UAPPEND", "DELTA", "DOWNLOAD", "RANGE", "BATCH", "MERKLE"}  # What MAX_TRANSFERS counts
+ADMISSION_WAIT = 2.0  # Seconds a transfer waits for room under the limits before it is answered BUSY
+ADMISSION_POLL = 0.02  # Seconds between checks for room while waiting
+RETRY_AFTER = 1  # Seconds a BUSY reply asks the client to wait before trying again
+IDLE_TIMEOUT = 600.0  # Seconds a connection may go without a command (PINGs aside) (None: forever)
+EVICT_AFTER = 10.0  # Seconds idle after which a connection gives way to a new one when the server is full
+MIN_TRANSFER_RATE = 1024  # Bytes per second a running command must move, measured over SLOW_WINDOW
+SLOW_WINDOW = 60.0  # Seconds over which MIN_TRANSFER_RATE is measured
+IDLE_CHECK_INTERVAL = 5.0  # Seconds between sweeps for idle and stalled connections
+CONNECTION_RATE = None  # Bytes per second of file data one connection may move (None: no limit)
+USER_RATE = None  # Bytes per second all connections of one user may move together (None: no limit)
+ROLE_RATES = {}  # Role -> bytes per second shared by all of its users, e.g. {'user': 50 * 1024 ** 2}
+SERVER_RATE = None  # Bytes per second of file data for the whole server (None: no limit)
+RATE_BURST = 1.0  # Seconds' worth of a rate limit that can be used at once after a quiet spell
+PRIORITY_BYTES = 1024 * 1024  # File bytes per command, and per connection each second, that never wait on the limits
+DEFAULT_ROLE = 'user'  # Role whose rate limit applies to a connection
+WORKERS = 1  # Server processes sharing the port; every limit above applies to each of them
+WORKER = None  # Which of them this process is, None when it is the only one
+LISTEN_FD = None  # Listening socket inherited from the supervisor, where SO_REUSEPORT does not balance
+RESTART_DELAY = 1.0  # Seconds before a worker that exited is started again, doubling while it keeps crashing
+MAX_RESTART_DELAY = 60.0
+STABLE_UPTIME = 60.0  # Seconds a worker must run for its restart delay to drop back to RESTART_DELAY
+DRAIN_TIMEOUT = 30.0  # Seconds commands still running at shutdown are given to finish
+INDEX_SYNC_INTERVAL = 5.0  # Seconds between catch-ups with other workers' changes to the index
+INDEX_CHANGE_TTL = 3600  # Seconds a change stays in the log for workers that have not seen it yet
+# Linux spreads connections over sockets sharing a port; elsewhere workers share one socket
+REUSEPORT_BALANCES = hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux')
+USERS_DB = 'users.db'  # Accounts and login sessions (see utils/auth.py and setupdb.py)
+ALLOW_ANONYMOUS = False  # Whether connections that never log in may run the commands any user may
+TOKEN_TTL = 24 * 3600  # Seconds a LOGIN session token stays valid
+TOKEN_CACHE_TTL = 60.0  # Seconds a checked token is trusted without looking it up in USERS_DB again
+USERS_DB_POOL = 4  # Connections to USERS_DB shared by the server's threads
+MAX_LOGINS = os.cpu_count() or 1  # Password checks running at once, more wait and then get BUSY
+LOGIN_FAILURES = 5  # Failed LOGINs after which a connection is closed
+PEER_LOGIN_FAILURES = 20  # Failed LOGINs from one address within LOGIN_WINDOW before it is turned away
+LOGIN_WINDOW = 300.0  # Seconds an address with PEER_LOGIN_FAILURES failures is turned away for
+OPEN_COMMANDS = {"HELLO", "IDENT", "COMPRESS", "LOGIN", "AUTH", "LOGOUT", "PING"}  # Allowed before logging in
+ADMIN_COMMANDS = {"DELETE", "STATS"}  # Only for users with ADMIN_ROLE
+ADMIN_ROLE = 'admin'
 
 
 os.makedirs("logs", exist_ok=True)
 os.makedirs(UPLOAD, exist_ok=True)  # Ensure upload directory exists
 
-# Load existing checkpoints
-def load_checkpoints():
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as f:
+# Digests of stored files, so transfers do not re-read files just to hash them
+hash_index = HashIndex(METADATA_DB)
+# Merkle trees of stored files, built on first request (see utils/merkle.py)
+merkle_index = MerkleIndex(METADATA_DB)
+upload_sessions = UploadSessions(PARTIAL_DIR, UPLOAD_SESSION_TTL)
+# Contents of hot small files for DOWNLOAD (see utils/filecache.py), sized in main()
+file_cache = FileCache(FILE_CACHE_SIZE, FILE_CACHE_MAX_FILE, FILE_CACHE_ADMIT_AFTER)
+# Serialises versioning of concurrent uploads, across worker processes too
+os.makedirs(os.path.join(UPLOAD, '.locks'), exist_ok=True)
+publish_lock = ProcessLock(os.path.join(UPLOAD, '.locks', 'publish.lock'))
+# Always available so manifests stay readable if the backend is switched back to plain
+chunk_store = ChunkStore(CHUNK_DIR, METADATA_DB)
+# Download progress per (client identity, file)
+checkpoint_store = CheckpointStore(METADATA_DB, CHECKPOINT_TTL)
+atexit.register(checkpoint_store.flush)
+# Every version of every file; uploaded/<name> always holds the current one
+version_catalog = VersionCatalog(METADATA_DB)
+# Name, size, mtime, hash and version of every stored file, kept current by
+# publish/delete and rebuilt from disk at startup
+dir_index = DirectoryIndex()
+# What the other worker processes publish and delete, for their copies of
+# dir_index; main() sets it up when there are several
+index_changes = None
+# Request counts, latencies, bytes and connections (STATS, /metrics)
+metrics = Metrics()
+# Admission control (see utils/admission.py); main() applies the limits given on the command line
+connection_table = ConnectionTable(MAX_CONNECTIONS, EVICT_AFTER)
+transfer_slots = Limiter(MAX_TRANSFERS)
+upload_budget = Limiter(MAX_UPLOAD_BYTES)
+# LOGIN's password checks, and the addresses that keep failing them
+login_slots = Limiter(MAX_LOGINS)
+login_failures = FailureCounter(PEER_LOGIN_FAILURES, LOGIN_WINDOW)
+metrics.gauge("transfers", lambda: transfer_slots.used)
+metrics.gauge("upload_bytes_in_flight", lambda: upload_budget.used)
+# Bandwidth limits per connection, user, role and server (see utils/qos.py), also set in main()
+qos = QoS(CONNECTION_RATE, USER_RATE, ROLE_RATES, SERVER_RATE, RATE_BURST, PRIORITY_BYTES)
+metrics.add_source(qos)
+metrics.add_source(file_cache)
+# Password logins and the session tokens later connections present (AUTH)
+accounts = Accounts(USERS_DB, TOKEN_TTL, TOKEN_CACHE_TTL, USERS_DB_POOL)
+
+# Logs a message with timestamp and optional fields (command, bytes, duration, peer, ...).
+# The write happens on the logger's own thread, so this never waits for the disk.
+logger = get_logger(LOG_FILE, fmt=LOG_FORMAT)
+
+def log(msg, **fields):
+    logger.log(msg, **fields)
+
+# Path of the stored file a client's name refers to. Names may contain
+# directories ("a/b.txt"); ValueError for names that would point outside the
+# upload directory or into the server's own state (see utils/names.py).
+def stored_path(name):
+    parts = split_name(name)
+    if os.path.join(UPLOAD, parts[0]) == VERSION_DIR:
+        raise ValueError(f"{name} is in the version history")
+    return os.path.join(UPLOAD, *parts)
+
+# Path an upload of name will be published at; ValueError as for
+# stored_path, or if a directory is in the way of the file or a file in the
+# way of one of its directories
+def upload_path(name):
+    path = stored_path(name)
+    if os.path.isdir(path):
+        raise ValueError(f"{name} is a directory")
+    parent = os.path.dirname(path)
+    while not os.path.isdir(parent):
+        if os.path.exists(parent):
+            raise ValueError(f"{name}: {name_for(UPLOAD, parent)} is a file")
+        parent = os.path.dirname(parent)
+    return path
+
+# Removes the directories above path that have become empty, up to the
+# upload or version directory itself. Called with publish_lock held, so a
+# directory is never removed while an upload is being moved into it.
+def remove_empty_parents(path):
+    parent = os.path.dirname(path)
+    while parent not in (UPLOAD, VERSION_DIR):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return  # Not empty
+        parent = os.path.dirname(parent)
+
+# Copies the current version of filename into the version history (as
+# VersionHistory/<dirs>/<base>_v<N><ext>) and returns that path, None if
+# there is no current version. The file stays in place until the new one
+# replaces it.
+def archive_current(filename):
+    original_path = stored_path(filename)
+    if not os.path.exists(original_path):
+        return None
+    current = version_catalog.current(filename)
+    if current is None:
+        # Stored before versions were catalogued, so it becomes a version now
+        # (a plain one: nothing recorded it as a manifest)
+        entry = index_entry(filename)
+        version = version_catalog.allocate(filename)
+        version_catalog.add(filename, version, original_path, entry.size, entry.sha256, entry.mtime)
+    else:
+        version = current[0]
+    base, ext = os.path.splitext(filename)
+    archive_path = os.path.join(VERSION_DIR, *split_name(f"{base}_v{version}{ext}"))
+    if os.path.exists(archive_path):
+        # Left behind by the old naming scheme, keep both
+        archive_path = os.path.join(VERSION_DIR, *split_name(f"{base}_v{version}.{uuid.uuid4().hex[:8]}{ext}"))
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    log(f"Archiving existing file: {original_path} -> {archive_path}")
+    try:
+        # A hard link keeps the current version readable until it is replaced
+        os.link(original_path, archive_path)
+    except OSError:
+        os.rename(original_path, archive_path)
+    hash_index.move(original_path, archive_path)
+    merkle_index.move(original_path, archive_path)
+    return archive_path
+
+# Moves a fully received upload into place as the next version of filename,
+# archiving the current one. With the chunked backend what gets published is
+# a manifest of deduplicated chunks.
+def publish_upload(temp_path, filename, digest):
+    size = os.path.getsize(temp_path)
+    source, manifest = temp_path, None
+    if STORAGE_BACKEND == 'chunked':
+        source = temp_path + ".manifest"
+        manifest = chunk_store.ingest(temp_path, source, digest)
+    try:
+        file_path = stored_path(filename)
+        with publish_lock:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            archive_path = archive_current(filename)
+            version = version_catalog.allocate(filename)
+            os.replace(source, file_path)
+            source = None
+            file_cache.invalidate(file_path)
+            mtime = os.stat(file_path).st_mtime
+            version_catalog.add(filename, version, file_path, size, digest, archived_path=archive_path,
+                                chunked=manifest is not None)
+            dir_index.put(Entry(filename, size, mtime, digest, version))
+            if manifest is None:
+                # Before the lock goes, so the next upload of the name cannot be recorded first
+                hash_index.record(file_path, digest)
+    except BaseException:
+        if manifest is not None and source is not None:
+            # Never published, so give back the chunk references it took
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-# Save checkpoints to file
-def save_checkpoints(checkpoints):
-    with open(CHECKPOINT_FILE, 'w') as f:
-        json.dump(checkpoints, f)
-
-# Logs a message with timestamp
-def log(msg):
-    with open(LOG_FILE, 'a') as f:
-        f.write(f"[{datetime.now()}] {msg}\n")
-
-# Helper function to read a line (until newline) from socket
-def recv_line(conn):
-    buffer = ''
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+            chunk_store.release(manifest)
+        raise
+    if manifest is not None:
+        os.remove(temp_path)
+    note_change(filename)
+    log(f"Published {file_path} as version {version}")
+    return file_path
+
+# Whether the stored file at path is a chunk manifest, as recorded when it
+# was published; never decided from the file's content, which a client wrote
+def is_manifest(path):
+    return version_catalog.is_chunked(path)
+
+# Records which backend stored each version in catalogs from before that was
+# recorded: a file counts as a manifest only if the chunk store holds every
+# chunk it lists. Returns how many manifests were found.
+def migrate_backends():
+    found = 0
+    for path in version_catalog.chunked_unknown():
+        chunked = chunk_store.owns(path)
+        version_catalog.set_chunked(path, chunked)
+        found += chunked
+    return found
+
+# Opens a stored file for reading, whichever backend wrote it: (file object, size)
+def open_stored(path):
+    if is_manifest(path):
+        f = chunk_store.open(path)
+        return f, f.size
+    f = open(path, 'rb')
+    return f, os.fstat(f.fileno()).st_size
+
+# SHA-256 of a stored file's content (manifests carry it, plain files use the index)
+def stored_digest(path):
+    if is_manifest(path):
+        return read_manifest(path)["sha256"]
+    return hash_index.digest(path)
+
+# Size, mtime and digest of a stored file's content
+def stat_stored(path):
+    st = os.stat(path)
+    if is_manifest(path):
+        manifest = read_manifest(path)
+        return manifest["size"], st.st_mtime, manifest["sha256"]
+    return st.st_size, st.st_mtime, hash_index.digest(path)
+
+# Merkle tree of a stored file, cached until the file changes
+def merkle_tree(path):
+    f, size = open_stored(path)
+    f.close()
+    return merkle_index.tree(path, lambda: open_stored(path)[0], size, lambda: stored_digest(path),
+                             MERKLE_CHUNK_SIZE, MERKLE_WORKERS)
+
+# Block size, block signatures and digest of a stored file, for delta uploads
+def build_signature(path):
+    f, size = open_stored(path)
+    with f:
+        block_size = delta.block_size_for(size)
+        sig = delta.signature(f, block_size)
+    return block_size, sig, stored_digest(path)
+
+# Names of stored files, "dir/name" for files in subdirectories (hidden
+# entries such as .partial and the version history are skipped)
+def list_uploads():
+    names = []
+    for root, dirs, files in os.walk(UPLOAD):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and os.path.join(root, d) != VERSION_DIR]
+        names.extend(name_for(UPLOAD, os.path.join(root, f)) for f in files if not f.startswith('.'))
+    return names
+
+# Index entry for a stored file; digests come from manifests or the hash
+# index only, nothing is hashed here
+def index_entry(name):
+    path = stored_path(name)
+    st = os.stat(path)
+    if is_manifest(path):
+        manifest = read_manifest(path)
+        return Entry(name, manifest["size"], st.st_mtime, manifest["sha256"])
+    return Entry(name, st.st_size, st.st_mtime, hash_index.lookup(path))
+
+# Rebuilds the directory index from the upload directory, returns the file count
+def reconcile_index():
+    versions = version_catalog.current_versions()
+    entries = []
+    for name in list_uploads():
+        try:
+            entry = index_entry(name)
+        except (FileNotFoundError, ValueError):
+            continue  # Removed or half-written while we were scanning
+        entry.version = versions.get(name, 1)
+        entries.append(entry)
+    dir_index.load(entries)
+    return len(entries)
+
+# Tells the other worker processes that filename was published or deleted
+def note_change(filename):
+    if index_changes is not None:
+        index_changes.append(filename)
+
+# Brings this process's index entry for name in line with the disk
+def refresh_entry(name):
+    try:
+        entry = index_entry(name)
+    except (FileNotFoundError, ValueError):
+        dir_index.remove(name)
+        return
+    current = version_catalog.current(name)
+    entry.version = current[0] if current else 1
+    dir_index.put(entry)
+
+# Applies what the other workers published and deleted since the last call,
+# rescanning everything if this process fell too far behind
+def sync_index():
+    if index_changes is not None and not index_changes.replay(refresh_entry):
+        count = reconcile_index()
+        log(f"Missed index changes from other workers, re-indexed {count} file(s)")
+
+# Keeps a worker's index current while nobody lists files through it, forever
+def follow_index():
     while True:
-        data = conn.recv(1024).decode()
-        if not data:
+        time.sleep(INDEX_SYNC_INTERVAL)
+        try:
+            sync_index()
+        except (OSError, sqlite3.Error) as e:
+            log(f"Index sync failed: {e}")
+
+# Deletes partial uploads and checkpoints nobody has touched within their TTLs
+# and prunes old versions, forever
+def reap_expired():
+    while True:
+        try:
+            removed = upload_sessions.cleanup()
+            if removed:
+                log(f"Removed {removed} expired partial upload file(s)")
+        except OSError as e:
+            log(f"Partial upload cleanup failed: {e}")
+        try:
+            removed = checkpoint_store.expire()
+            if removed:
+                log(f"Removed {removed} expired download checkpoint(s)")
+        except sqlite3.Error as e:
+            log(f"Checkpoint cleanup failed: {e}")
+        try:
+            removed = prune_versions()
+            if removed:
+                log(f"Pruned {removed} old file version(s)")
+        except (OSError, sqlite3.Error) as e:
+            log(f"Version pruning failed: {e}")
+        if index_changes is not None:
+            try:
+                index_changes.trim(INDEX_CHANGE_TTL)
+            except sqlite3.Error as e:
+                log(f"Index change log cleanup failed: {e}")
+        try:
+            removed = accounts.expire()
+            if removed:
+                log(f"Removed {removed} expired login session(s)")
+        except sqlite3.Error as e:
+            log(f"Login session cleanup failed: {e}")
+        time.sleep(REAP_INTERVAL)
+
+# Removes a stored file of either backend, releasing its chunks
+def remove_stored(path):
+    if is_manifest(path):
+        chunk_store.release(read_manifest(path))
+    os.remove(path)
+    hash_index.invalidate(path)
+    merkle_index.invalidate(path)
+    file_cache.invalidate(path)
+    with publish_lock:
+        remove_empty_parents(path)
+
+# Removes the current version of an uploaded file (older versions stay in the
+# history until pruned), returns False if it does not exist
+def delete_upload(filename):
+    filepath = stored_path(filename)
+    if not os.path.isfile(filepath):
+        return False
+    remove_stored(filepath)
+    version_catalog.remove_current(filename)
+    dir_index.remove(filename)
+    note_change(filename)
+    return True
+
+# Deletes older versions that fall outside the retention policy, returns how many
+def prune_versions():
+    removed = 0
+    for name, version, path in version_catalog.expired(KEEP_VERSIONS, MAX_VERSION_AGE, MAX_VERSION_BYTES):
+        try:
+            remove_stored(path)
+        except FileNotFoundError:
+            pass
+        version_catalog.remove(name, version)
+        removed += 1
+    # Forget versions whose file has been removed by hand
+    for name, version, _ in version_catalog.missing():
+        version_catalog.remove(name, version)
+    return removed
+
+# Index entries for BATCH: each argument is a file name or a glob, matches
+# in order, every file once. None if there are more than MAX_BATCH_FILES.
+def batch_entries(patterns):
+    sync_index()
+    entries, seen = [], set()
+    for pattern in patterns:
+        if any(c in pattern for c in GLOB_CHARS):
+            matches, cursor = [], None
+            while True:
+                page, cursor = dir_index.page(MAX_PAGE, cursor, glob=pattern)
+                matches.extend(page)
+                if cursor is None or len(matches) > MAX_BATCH_FILES:
+                    break
+        else:
+            entry = dir_index.get(pattern)
+            matches = [entry] if entry else []
+        for entry in matches:
+            if entry.name not in seen:
+                seen.add(entry.name)
+                entries.append(entry)
+        if len(entries) > MAX_BATCH_FILES:
             return None
-        buffer += data
-        if '\n' in buffer:
-            line, buffer = buffer.split('\n', 1)
-            return line.strip()
+    return entries
+
+# Path of a version of filename (the current one if version is None), None if unknown
+def version_path(filename, version=None):
+    if version is None:
+        return stored_path(filename)
+    return version_catalog.path(filename, int(version))
+
+# Per-connection state shared by the command handlers
+class Session:
+    def __init__(self, addr, transport):
+        self.addr = addr
+        self.transport = transport  # Connection or AsyncStream, for its byte counters
+        self.peer = f"{addr[0]}:{addr[1]}"
+        self.client_id = addr[0]  # Who checkpoints belong to; IDENT replaces the bare address
+        self.version = 1  # Wire protocol version, raised by HELLO
+        self.data_remaining = 0  # Bytes left in the current v2 DATA frame
+        self.uploads = {}  # Upload session id -> (hasher, bytes it covers)
+        self.codec = None  # Compression codec agreed with COMPRESS, if any
+        self.failed = False  # Whether the current command has answered with an error
+        self.idle_since = time.monotonic()  # End of the last command other than PING, None during one
+        self.reserved = 0  # Upload budget bytes held by the current command
+        self.working = False  # In a long server-side step, which the slow-connection reaper allows for
+        self.user = None  # Account the connection belongs to (LOGIN/AUTH); rate limits fall back to client_id
+        self.role = DEFAULT_ROLE
+        self.token = None  # Session token the connection logged in with
+        self.shaper = None  # This connection's rate limits (utils.qos.Shaper), None if it has none
+        self.login_failures = 0  # Failed LOGINs so far
+        self.closing = False  # Set by a command after which the connection is closed
+
+# Looks up a connection's rate limits again, after who it belongs to changed
+def apply_qos(session):
+    qos.close(session.shaper)
+    session.shaper = qos.open(session.peer, session.user or session.client_id, session.role)
+
+# Whether the connection may run command: "login" if it has to log in
+# first, "role" if its user's role does not allow it, None if it may
+def denial(session, command):
+    if command in OPEN_COMMANDS:
+        return None
+    if session.user is None and not ALLOW_ANONYMOUS:
+        return "login"
+    if command in ADMIN_COMMANDS and session.role != ADMIN_ROLE:
+        return "role"
+    return None
 
-# Handles communication with a single client
-def handle_client(conn, addr):
-    conn.settimeout(30.0)  # 30 second timeout
+# Error reply; marks the command as failed in the metrics
+def send_error(session, text="ERROR"):
+    session.failed = True
+    yield from send_message(session, text)
 
-    log(f"Connected by {addr}")
-    checkpoints = load_checkpoints()
+# BUSY reply in place of a command's usual one: the server is at one of its
+# limits and the client should try again after retry_after seconds
+def send_busy(session, limit, retry_after=RETRY_AFTER):
+    metrics.rejected(limit)
+    yield from send_message(session, f"BUSY {retry_after:.0f}")
 
+# Call for server-side work that can take a while, such as hashing or
+# chunking a large upload: the connection moves no bytes meanwhile, so the
+# reaper must not take it for a stalled one
+def long_call(session, fn, *args):
+    session.working = True
     try:
+        return (yield Call(fn, *args))
+    finally:
+        session.working = False
+
+# Takes amount from limiter, waiting up to ADMISSION_WAIT for it to have
+# room; False if it never did
+def admit(limiter, amount=1):
+    deadline = time.monotonic() + ADMISSION_WAIT
+    while not limiter.try_acquire(amount):
+        if time.monotonic() >= deadline:
+            return False
+        yield Sleep(ADMISSION_POLL)
+    return True
+
+# Reserves the bytes an upload is about to receive in the in-flight budget
+# until its command ends (serve() gives them back). False, after a BUSY
+# reply, if they did not fit.
+def reserve_upload(session, amount):
+    if not (yield from admit(upload_budget, amount)):
+        yield from send_busy(session, "upload_bytes")
+        return False
+    session.reserved += amount
+    return True
+
+# Decompressor for an upload that names a codec, None for a raw one
+def upload_decompressor(session, args, index):
+    if len(args) <= index:
+        return None
+    if args[index] != session.codec:
+        raise ProtocolError(f"codec {args[index]} was not negotiated")
+    return Decompressor(args[index])
+
+# Receives more of an upload into writer, raw or compressed, and returns how
+# many file bytes were added (0 when the client disconnects or stops sending)
+def recv_upload_step(session, writer, limit, decompressor):
+    if decompressor is None:
+        n = yield from recv_payload_into(session, writer.space(limit))
+        if n:
+            yield Call(writer.commit, n)
+        return n
+    while True:
+        block = yield from recv_block(session)
+        if not block:
+            return 0
+        data = yield Call(decompressor.decompress, block, limit + 1)
+        if len(data) > limit:
+            raise ProtocolError("compressed upload is longer than announced")
+        if data:
+            yield Call(writer.write, data)
+            return len(data)
+
+# Reads the end of a compressed upload once all of its bytes have arrived
+def finish_compressed_upload(session, decompressor):
+    while True:
+        block = yield from recv_block(session)
+        if not block:
+            return
+        data = yield Call(decompressor.decompress, block, 1)
+        if data:
+            raise ProtocolError("compressed upload is longer than announced")
+
+# The command handlers below are generators that yield I/O operations
+# (see utils/engine.py) so the same code runs on both server engines. Replies
+# go through utils/protocol.py so they are framed for the negotiated version.
+
+# HELLO: negotiate the wire protocol version
+def cmd_hello(session, args):
+    version = max(1, min(int(args[0]), PROTOCOL_VERSION))
+    # The reply is always a v1 line; the new framing starts after it
+    yield Send(f"HELLO {version}\n".encode())
+    session.version = version
+
+# COMPRESS codec [codec ...]: pick the first of the client's codecs we support.
+# Transfers may then be compressed with it (see utils/compression.py).
+def cmd_compress(session, args):
+    session.codec = choose_codec(args)
+    yield from send_message(session, f"COMPRESS {session.codec or 'none'}")
+
+# LIST [option=value ...]
+# Without options: every file name, streamed a page at a time. With options
+# the reply is one page: "PAGE <cursor for the next page, or ->" and then a
+# line per file. Options: limit, cursor, prefix, glob, sort (name, size or
+# mtime), order (asc or desc) and long=1 for "name size mtime sha256 version".
+def cmd_list(session, args):
+    if index_changes is not None:
+        yield Call(sync_index)
+    if not args:
+        cursor = None
         while True:
-            # Read command line until newline
-            data = recv_line(conn)
+            entries, cursor = yield Call(dir_index.page, LIST_PAGE_SIZE, cursor)
+            yield from send_lines_part(session, [e.name for e in entries])
+            if cursor is None:
+                break
+        yield from end_lines(session)
+        return
+    try:
+        opts = dict(arg.split('=', 1) for arg in args)
+        entries, cursor = yield Call(dir_index.page, int(opts.get("limit", LIST_PAGE_SIZE)),
+                                     opts.get("cursor"), opts.get("prefix"), opts.get("glob"),
+                                     opts.get("sort", "name"), opts.get("order") == "desc")
+    except ValueError:
+        session.failed = True
+        yield from send_lines(session, ["ERROR"])
+        return
+    lines = [e.line() for e in entries] if opts.get("long") == "1" else [e.name for e in entries]
+    yield from send_lines(session, [f"PAGE {cursor or '-'}"] + lines)
+
+# STAT: size, mtime and hash of one file without transferring it
+def cmd_stat(session, args):
+    try:
+        filepath = stored_path(args[0])
+        size, mtime, file_hash = yield Call(stat_stored, filepath)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+    yield from send_message(session, f"{size} {int(mtime)} {file_hash}")
+
+# UPLOAD name size [codec]
+def cmd_upload(session, args):
+    filename = args[0]
+    size = int(args[1])  # Expected size
+    decompressor = upload_decompressor(session, args, 2)
+    temp_path = os.path.join(PARTIAL_DIR, f"upload-{uuid.uuid4().hex}.tmp")
+    started = time.monotonic()
+    try:
+        yield Call(upload_path, filename)
+    except ValueError:
+        yield from send_error(session)
+        return
+    if not (yield from reserve_upload(session, size)):
+        return
+
+    # Notify client to start sending file data
+    yield from send_message(session, "READY")
+
+    # Receive file in chunks, hashing as they are written
+    f = yield Call(open, temp_path, 'wb')
+    writer = HashingWriter(f, buffer_size=CHUNK_SIZE)
+    bytes_received = 0
+    try:
+        while bytes_received < size:
+            n = yield from recv_upload_step(session, writer, size - bytes_received, decompressor)
+            if not n:
+                break
+            bytes_received += n
+        if decompressor and bytes_received == size:
+            yield from finish_compressed_upload(session, decompressor)
+    finally:
+        yield Call(f.close)
+        if bytes_received < size:
+            # Never publish a truncated file
+            yield Call(os.remove, temp_path)
+    if bytes_received < size:
+        log(f"Upload of {filename} from {session.addr} ended after {bytes_received} of {size} bytes")
+        yield from send_error(session)
+        return
+
+    received_hash = writer.hexdigest()
+    yield from long_call(session, publish_upload, temp_path, filename, received_hash)
+    log(f"Received {filename} from {session.addr}", command="UPLOAD", file=filename, bytes=size,
+        duration=round(time.monotonic() - started, 3), peer=session.peer, codec=args[2] if decompressor else None)
+
+    # Send hash back to client
+    yield from send_message(session, received_hash)
+
+# USESSION name size [id]: open (or continue) a resumable upload.
+# Replies "SESSION <id> <offset>" where offset is how much the server already has
+# (all of it for a session that was already published).
+def cmd_usession(session, args):
+    filename, size = args[0], int(args[1])
+    session_id = args[2] if len(args) > 2 else None
+    try:
+        yield Call(upload_path, filename)
+    except ValueError:
+        yield from send_error(session)
+        return
+    session_id, meta = yield Call(upload_sessions.open, filename, size, session_id)
+    yield from send_message(session, f"SESSION {session_id} {meta['committed']}")
+
+# UAPPEND id offset [codec]: the client sends the rest of the file from offset on.
+# offset must equal the committed offset, otherwise "ERROR <committed>" is
+# returned; so is appending to a session another connection is still writing.
+def cmd_uappend(session, args):
+    session_id = args[0]
+    if (yield Call(upload_sessions.get, session_id)) is None:
+        yield from send_error(session, "ERROR -1")
+        return
+    if not upload_sessions.claim(session_id):
+        meta = yield Call(upload_sessions.get, session_id)
+        yield from send_error(session, f"ERROR {meta['committed'] if meta else -1}")
+        return
+    try:
+        yield from append_upload(session, args)
+    finally:
+        upload_sessions.release(session_id)
+
+def append_upload(session, args):
+    session_id, offset = args[0], int(args[1])
+    decompressor = upload_decompressor(session, args, 2)
+    meta = yield Call(upload_sessions.get, session_id)
+    if meta is None:
+        yield from send_error(session, "ERROR -1")
+        return
+    committed = meta["committed"]
+    if offset != committed:
+        yield from send_error(session, f"ERROR {committed}")
+        return
+    if not (yield from reserve_upload(session, meta["size"] - committed)):
+        return
+
+    # Continue the running hash, or rebuild it from what is on disk after a reconnect
+    hasher, covered = session.uploads.pop(session_id, (None, -1))
+    if covered != committed:
+        hasher = hashlib.sha256()
+        yield Call(hash_prefix, upload_sessions.part_path(session_id), hasher, committed)
+
+    yield from send_message(session, "READY")
+
+    remaining = meta["size"] - committed
+    started = time.monotonic()
+    f = yield Call(open, upload_sessions.part_path(session_id), 'r+b')
+    writer = HashingWriter(f, hasher, buffer_size=CHUNK_SIZE)
+    received = since_commit = 0
+    try:
+        yield Call(f.seek, committed)
+        while received < remaining:
+            n = yield from recv_upload_step(session, writer, remaining - received, decompressor)
+            if not n:
+                break
+            received += n
+            since_commit += n
+            if since_commit >= UPLOAD_COMMIT_INTERVAL:
+                yield Call(upload_sessions.commit, session_id, f)
+                since_commit = 0
+        if decompressor and received == remaining:
+            yield from finish_compressed_upload(session, decompressor)
+    finally:
+        committed = yield Call(upload_sessions.commit, session_id, f)
+        yield Call(f.close)
+        session.uploads[session_id] = (hasher, committed)
+        log(f"Received {received} bytes of {meta['filename']} from {session.addr}", command="UAPPEND",
+            file=meta['filename'], bytes=received, duration=round(time.monotonic() - started, 3),
+            peer=session.peer, codec=args[2] if decompressor else None)
+        if received < remaining:
+            log(f"Upload session {session_id} for {meta['filename']} paused at byte {committed}")
+
+# UCOMMIT id sha256: publish a complete upload if its hash matches.
+# Replies with the hash on success, "INCOMPLETE <committed>" or "ERROR";
+# BUSY while another connection holds the session. Committing a session that
+# was already published with that hash replies with the hash again.
+def cmd_ucommit(session, args):
+    session_id, expected = args[0], args[1]
+    if (yield Call(upload_sessions.get, session_id)) is None:
+        yield from reply_published(session, session_id, expected)
+        return
+    if not upload_sessions.claim(session_id):
+        # Still being appended to or committed by another connection, or just published by one
+        if (yield Call(upload_sessions.published, session_id)) is None:
+            yield from send_busy(session, "upload_session")
+        else:
+            yield from reply_published(session, session_id, expected)
+        return
+    try:
+        yield from commit_upload(session, session_id, expected)
+    finally:
+        upload_sessions.release(session_id)
+
+# A repeated UCOMMIT of a session that is already published: the same digest
+def reply_published(session, session_id, expected):
+    done = yield Call(upload_sessions.published, session_id)
+    if done is None or done["sha256"] != expected:
+        yield from send_error(session)
+        return
+    yield from send_message(session, done["sha256"])
+
+def commit_upload(session, session_id, expected):
+    meta = yield Call(upload_sessions.get, session_id)
+    if meta is None:
+        yield from reply_published(session, session_id, expected)
+        return
+    if meta["committed"] < meta["size"]:
+        yield from send_message(session, f"INCOMPLETE {meta['committed']}")
+        return
+
+    part_path = upload_sessions.part_path(session_id)
+    hasher, covered = session.uploads.pop(session_id, (None, -1))
+    if covered == meta["size"]:
+        digest = hasher.hexdigest()
+    else:
+        digest = yield from long_call(session, sha256_file, part_path)
+
+    if digest != expected:
+        # The bytes on disk are wrong, so the upload has to start over
+        yield Call(upload_sessions.remove, session_id)
+        log(f"Upload session {session_id} for {meta['filename']} failed hash check")
+        yield from send_error(session)
+        return
+
+    yield from long_call(session, publish_upload, part_path, meta["filename"], digest)
+    yield Call(upload_sessions.finish, session_id, digest)
+    yield from send_message(session, digest)
+
+# SIGNATURE name: block signatures of the stored version, for a delta upload.
+# Replies "SIG <block size> <signature length> <sha256>" followed by the signature.
+def cmd_signature(session, args):
+    try:
+        filepath = stored_path(args[0])
+        block_size, sig, digest = yield Call(build_signature, filepath)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+    yield from send_message(session, f"SIG {block_size} {len(sig)} {digest}")
+    yield from send_payload(session, sig)
+
+# DELTA name size sha256 delta_length base_sha256: upload a new version as a delta
+# against the stored one (see utils/delta.py). READY is only sent if the stored
+# version is still the one the signature came from; the reply is the hash or ERROR.
+def cmd_delta(session, args):
+    filename, size, expected = args[0], int(args[1]), args[2]
+    delta_len, base_digest = int(args[3]), args[4]
+    try:
+        filepath = stored_path(filename)
+        base, base_size = yield Call(open_stored, filepath)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+
+    temp_path = os.path.join(PARTIAL_DIR, f"delta-{uuid.uuid4().hex}.tmp")
+    started = time.monotonic()
+    f = None
+    ok = False
+    try:
+        current = yield Call(stored_digest, filepath)
+        if current != base_digest:
+            yield from send_error(session)
+            return
+        if not (yield from reserve_upload(session, delta_len)):
+            return
+        yield from send_message(session, "READY")
+
+        block_size = delta.block_size_for(base_size)
+        f = yield Call(open, temp_path, 'wb')
+        writer = HashingWriter(f, buffer_size=CHUNK_SIZE)
+        remaining = delta_len
+        valid = True
+        while remaining > 0:
+            header = yield from recv_payload_exact(session, min(delta.OP_HEADER.size, remaining))
+            if len(header) < delta.OP_HEADER.size:
+                remaining = 0
+                break
+            remaining -= len(header)
+            kind, a, b = delta.OP_HEADER.unpack(header)
+            if kind == delta.OP_COPY and valid:
+                copied = yield Call(delta.copy_blocks, base, writer, a, b, block_size, base_size)
+                valid = writer.bytes_written <= size and copied > 0
+            elif kind == delta.OP_LITERAL and a <= remaining:
+                # Literal bytes go through the writer whether or not the delta
+                # is still valid, so the stream stays in step with the client
+                length = a
+                while length > 0:
+                    n = yield from recv_payload_into(session, writer.space(length))
+                    if not n:
+                        break
+                    if valid:
+                        yield Call(writer.commit, n)
+                    length -= n
+                    remaining -= n
+                if length:
+                    break
+                valid = valid and writer.bytes_written <= size
+            else:
+                valid = False
+        # Skip whatever is left of a delta that turned out to be malformed
+        while remaining > 0:
+            n = yield from recv_payload_into(session, writer.space(remaining))
+            if not n:
+                break
+            remaining -= n
+        yield Call(f.close)
+
+        received_hash = writer.hexdigest()
+        ok = valid and not remaining and writer.bytes_written == size and received_hash == expected
+        if not ok:
+            log(f"Delta upload of {filename} from {session.addr} failed verification")
+            yield from send_error(session)
+            return
+        yield from long_call(session, publish_upload, temp_path, filename, received_hash)
+        log(f"Rebuilt {filename} from a {delta_len} byte delta ({size} bytes)", command="DELTA",
+            file=filename, bytes=delta_len, size=size, duration=round(time.monotonic() - started, 3),
+            peer=session.peer)
+        yield from send_message(session, received_hash)
+    finally:
+        yield Call(base.close)
+        if f is not None and not f.closed:
+            yield Call(f.close)
+        if f is not None and not ok:
+            yield Call(os.remove, temp_path)
+
+# VERSIONS name: every stored version, newest first, one line each:
+# "<version> <size> <created> <sha256> current|archived"
+def cmd_versions(session, args):
+    rows = yield Call(version_catalog.list, args[0])
+    yield from send_lines(session, [f"{version} {size} {int(created)} {sha256 or '-'} "
+                                    f"{'current' if current else 'archived'}"
+                                    for version, _, size, sha256, created, current in rows])
+
+# DOWNLOAD name [offset] [version=N]
+# Without an offset the client answers the size with READY or RESUME <offset>;
+# with one the data follows the size straight away, which lets clients pipeline.
+# The size reply is "<size> <codec>" when the data is sent compressed.
+def cmd_download(session, args):
+    filename = args[0]
+    options = dict(arg.split('=', 1) for arg in args[1:] if '=' in arg)
+    args = [arg for arg in args if '=' not in arg]
+    started = time.monotonic()
+    try:
+        filepath = yield Call(version_path, filename, options.get("version"))
+        if filepath is None:
+            raise FileNotFoundError(filename)
+        cached, signature = yield Call(file_cache.get, filepath)
+        if cached is None:
+            f, size = yield Call(open_stored, filepath)
+            try:
+                cached = yield Call(file_cache.add, filepath, signature, f, size)
+            except BaseException:
+                f.close()  # Nothing below gets to close it
+                raise
+            if cached is not None:
+                yield Call(f.close)
+        if cached is not None:
+            # Served from memory; the BytesIO shares the cached bytes
+            f, size = io.BytesIO(cached.data), len(cached.data)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+
+    try:
+        if session.codec is None:
+            compress = False
+        elif cached is None:
+            compress = yield Call(sample_file, f)
+        else:
+            if cached.compressible is None:
+                cached.compressible = yield Call(sample_file, f)
+            compress = cached.compressible
+        yield from send_message(session, f"{size} {session.codec}" if compress else f"{size}")
+
+        if len(args) > 1:
+            bytes_received = int(args[1])
+        else:
+            # Wait for client to send "READY" or "RESUME"
+            ack = yield from recv_message(session)
+            if not (ack.startswith("READY") or ack.startswith("RESUME")):
+                return
+            if ack.startswith("RESUME"):
+                # Client wants to resume download
+                bytes_received = int(ack.split()[1])
+            else:
+                bytes_received = 0
+        bytes_received = min(max(bytes_received, 0), size)
+        if bytes_received:
+            log(f"Resuming download of {filename} from byte {bytes_received}")
+
+        if compress:
+            yield from send_compressed_payload(session, f, bytes_received, size - bytes_received,
+                                               Compressor(session.codec), CHUNK_SIZE)
+        elif cached is not None:
+            yield from send_buffer_payload(session, cached.data, bytes_received, size - bytes_received)
+        else:
+            yield from send_file_payload(session, f, bytes_received, size - bytes_received)
+    finally:
+        if cached is None:
+            yield Call(f.close)
+
+    # Send hash of the file: the cached copy's, or from the index unless the file changed
+    file_hash = cached.sha256 if cached is not None else (yield Call(stored_digest, filepath))
+    yield from send_message(session, file_hash)
+    log(f"Sent {filename} to {session.addr} with hash {file_hash}", command="DOWNLOAD", file=filename,
+        version=options.get("version"),
+        bytes=size - bytes_received, duration=round(time.monotonic() - started, 3), peer=session.peer,
+        codec=session.codec if compress else None, cached=True if cached is not None else None)
+
+# RANGE name offset length [version=N]: one slice of a file, used by
+# parallel downloads and to fetch chunks again that failed verification.
+# Replies with the number of bytes that follow, or ERROR.
+def cmd_range(session, args):
+    filename = args[0]
+    options = dict(arg.split('=', 1) for arg in args[1:] if '=' in arg)
+    args = [arg for arg in args if '=' not in arg]
+    try:
+        filepath = yield Call(version_path, filename, options.get("version"))
+        if filepath is None:
+            raise FileNotFoundError(filename)
+        f, size = yield Call(open_stored, filepath)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+    try:
+        offset = min(max(int(args[1]), 0), size)
+        count = min(max(int(args[2]), 0), size - offset)
+        started = time.monotonic()
+        yield from send_message(session, f"{count}")
+        yield from send_file_payload(session, f, offset, count)
+        log(f"Sent bytes {offset}-{offset + count} of {filename} to {session.addr}", command="RANGE",
+            file=filename, bytes=count, duration=round(time.monotonic() - started, 3), peer=session.peer)
+    finally:
+        yield Call(f.close)
+
+# MERKLE name [version=N]: "MERKLE <size> <sha256> <chunk size> <root>" and
+# then the tree's leaves, one hex digest per line, as a multi-line reply
+# (see utils/merkle.py). ERROR if the file does not exist.
+def cmd_merkle(session, args):
+    options = dict(arg.split('=', 1) for arg in args[1:] if '=' in arg)
+    try:
+        filepath = yield Call(version_path, args[0], options.get("version"))
+        if filepath is None:
+            raise FileNotFoundError(args[0])
+        tree = yield Call(merkle_tree, filepath)
+    except (OSError, ValueError):
+        yield from send_error(session)
+        return
+    yield from send_message(session, f"MERKLE {tree.size} {tree.sha256} {tree.chunk_size} {tree.root()}")
+    yield from send_lines(session, [leaf.hex() for leaf in tree.leaves])
+
+# BATCH [compress=1] name|glob ...: many files in one reply, as a tar archive
+# generated while it is sent (see utils/archive.py). Replies
+# "BATCH <files> <bytes> <codec|none>" and then the archive as a block stream,
+# compressed with the negotiated codec if the client asked for it.
+def cmd_batch(session, args):
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    patterns = [arg for arg in args if '=' not in arg]
+    entries = yield Call(batch_entries, patterns)
+    if entries is None:
+        yield from send_error(session)
+        return
+    codec = session.codec if options.get("compress") == "1" else None
+    framer = Compressor(codec) if codec else Framer()
+    started = time.monotonic()
+    yield from send_message(session, f"BATCH {len(entries)} {sum(e.size for e in entries)} {codec or 'none'}")
+
+    # Headers and small files are collected into CHUNK_SIZE blocks, so many
+    # small files cost a few large writes rather than several each
+    pending = bytearray()
+    sent = total = 0
+    for entry in entries:
+        path = stored_path(entry.name)
+        try:
+            f, size = yield Call(open_stored, path)
+        except FileNotFoundError:
+            continue  # Deleted since the index was read
+        try:
+            digest = yield Call(stored_digest, path)
+            pending += member_header(entry.name, size, entry.mtime, digest)
+            remaining = size
+            while remaining > 0:
+                data = yield Call(f.read, min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                pending += data
+                remaining -= len(data)
+                if len(pending) >= CHUNK_SIZE:
+                    yield from send_blocks(session, framer, pending)
+                    pending = bytearray()
+            # A file that shrank while it was read still gets the size its
+            # header promised; the client sees the hash mismatch
+            pending += bytes(remaining) + member_padding(size)
+        finally:
+            yield Call(f.close)
+        sent += 1
+        total += size
+    pending += END_OF_ARCHIVE
+    yield from send_blocks(session, framer, pending, finish=True)
+    log(f"Sent {sent} files as a batch to {session.addr}", command="BATCH", files=sent, bytes=total,
+        duration=round(time.monotonic() - started, 3), peer=session.peer, codec=codec)
+
+# DEDUPSTATS: how much space the chunked backend saves
+def cmd_dedupstats(session, args):
+    stats = yield Call(chunk_store.stats)
+    yield from send_message(session, ' '.join(f"{k}={v}" for k, v in stats.items()))
+
+# IDENT client_id: a stable identity for checkpoints, so they survive reconnects
+def cmd_ident(session, args):
+    if len(args) != 1 or not CLIENT_ID_PATTERN.fullmatch(args[0]):
+        yield from send_error(session)
+        return
+    session.client_id = args[0]
+    apply_qos(session)
+    yield from send_message(session, "OK")
+
+# Makes the connection user's with role, for the rest of it or until LOGOUT
+def sign_in(session, user, role, token):
+    session.user, session.role, session.token = user, role, token
+    apply_qos(session)
+
+# LOGIN user password: checks the password (base64-encoded, as it may
+# contain spaces) and replies "TOKEN <token> <role> <seconds valid>". The
+# token logs in later connections with AUTH, without the password.
+# Addresses with too many recent failures get BUSY until LOGIN_WINDOW is
+# over without their password being checked, and a connection is closed
+# after LOGIN_FAILURES failures.
+def cmd_login(session, args):
+    try:
+        user, password = args[0], base64.b64decode(args[1], validate=True).decode()
+    except (IndexError, ValueError):
+        yield from send_error(session)
+        return
+    wait = login_failures.blocked(session.addr[0])
+    if wait:
+        log(f"Turned away login as '{user}' from {session.addr}: too many failures", peer=session.peer)
+        yield from send_busy(session, "login_failures", max(wait, RETRY_AFTER))
+        return
+    if not (yield from admit(login_slots)):
+        yield from send_busy(session, "logins")
+        return
+    try:
+        result = yield Call(accounts.login, user, password)
+    finally:
+        login_slots.release()
+    if result is None:
+        log(f"Failed login as '{user}' from {session.addr}", peer=session.peer)
+        login_failures.failed(session.addr[0])
+        session.login_failures += 1
+        if session.login_failures >= LOGIN_FAILURES:
+            log(f"Closing {session.addr} after {session.login_failures} failed logins", peer=session.peer)
+            session.closing = True
+        yield from send_error(session)
+        return
+    token, role = result
+    sign_in(session, user, role, token)
+    log(f"{session.addr} logged in as '{user}' ({role})", peer=session.peer)
+    yield from send_message(session, f"TOKEN {token} {role} {accounts.token_ttl:.0f}")
+
+# AUTH token: logs the connection in with a token from LOGIN, replies
+# "OK <user> <role>". Recently checked tokens come from memory, so this only
+# waits on USERS_DB the first time a token is seen for a while.
+def cmd_auth(session, args):
+    if len(args) != 1:
+        yield from send_error(session)
+        return
+    found = accounts.cached(args[0])
+    if found is None:
+        found = yield Call(accounts.check, args[0])
+    if found is None:
+        yield from send_error(session)
+        return
+    sign_in(session, *found, args[0])
+    yield from send_message(session, f"OK {found[0]} {found[1]}")
+
+# LOGOUT: ends the login session; AUTH no longer accepts its token, though
+# other connections already logged in with it stay logged in
+def cmd_logout(session, args):
+    if session.token is not None:
+        yield Call(accounts.logout, session.token)
+        log(f"'{session.user}' logged out from {session.addr}", peer=session.peer)
+    sign_in(session, None, DEFAULT_ROLE, None)
+    yield from send_message(session, "OK")
+
+# CHECKPOINT name bytes: store download progress for this client.
+# CHECKPOINT name: replies with the stored progress (0 if there is none).
+def cmd_checkpoint(session, args):
+    filename = args[0]
+    if len(args) == 1:
+        saved = yield Call(checkpoint_store.get, session.client_id, filename)
+        yield from send_message(session, f"{saved['bytes_received'] if saved else 0}")
+        return
+    bytes_received = int(args[1])
+    yield Call(checkpoint_store.put, session.client_id, filename, {
+        "bytes_received": bytes_received,
+        "timestamp": datetime.now().isoformat()
+    })
+    yield from send_message(session, "OK")
+
+# STATS: request counts, errors, latencies (in ms) and bytes per command,
+# connection counts and transfer throughput (in MB/s), one line each
+# (see utils/metrics.py); admins only
+def cmd_stats(session, args):
+    yield from send_lines(session, metrics.summary())
+
+# PING: lets a client keep an idle connection open and check that it still works
+def cmd_ping(session, args):
+    yield from send_message(session, "PONG")
+
+# DELETE name (admins only, see ADMIN_COMMANDS)
+def cmd_delete(session, args):
+    filename = args[0]
+    try:
+        deleted = yield Call(delete_upload, filename)
+    except ValueError:
+        deleted = False
+    if deleted:
+        yield from send_message(session, "DELETED")
+        log(f"Deleted file '{filename}' for {session.addr}")
+    else:
+        yield from send_error(session)
+        log(f"Failed to delete '{filename}' - file not found")
+
+COMMANDS = {
+    "HELLO": cmd_hello,
+    "IDENT": cmd_ident,
+    "LOGIN": cmd_login,
+    "AUTH": cmd_auth,
+    "LOGOUT": cmd_logout,
+    "COMPRESS": cmd_compress,
+    "LIST": cmd_list,
+    "STAT": cmd_stat,
+    "UPLOAD": cmd_upload,
+    "USESSION": cmd_usession,
+    "UAPPEND": cmd_uappend,
+    "UCOMMIT": cmd_ucommit,
+    "SIGNATURE": cmd_signature,
+    "DELTA": cmd_delta,
+    "VERSIONS": cmd_versions,
+    "DOWNLOAD": cmd_download,
+    "RANGE": cmd_range,
+    "MERKLE": cmd_merkle,
+    "BATCH": cmd_batch,
+    "DEDUPSTATS": cmd_dedupstats,
+    "CHECKPOINT": cmd_checkpoint,
+    "DELETE": cmd_delete,
+    "PING": cmd_ping,
+    "STATS": cmd_stats,
+}
+
+# Runs a transfer command once one of the MAX_TRANSFERS slots is free, BUSY
+# if none frees up within ADMISSION_WAIT
+def run_transfer(session, handler, args):
+    if not (yield from admit(transfer_slots)):
+        yield from send_busy(session, "transfers")
+        return
+    try:
+        yield from handler(session, args)
+    finally:
+        transfer_slots.release()
+
+# Command loop for a single client, shared by both server engines
+def serve(session):
+    log(f"Connected by {session.addr}")
+    metrics.connection_opened()
+    apply_qos(session)
+    transport = session.transport
+    error = False
+
+    try:
+        while True:
+            # The command's own bytes count towards it, the wait for it does not
+            bytes_in, bytes_out = transport.bytes_in, transport.bytes_out
+            # Read the next command (a line in v1, a message frame in v2)
+            data = yield from recv_message(session)
             if data is None:
                 break  # Client disconnected
 
             # Splits the received string into the command vs arguments
             cmd_parts = data.split()
-            command = cmd_parts[0]
-
-            # LIST command
-            if command == "LIST":
-                files = os.listdir(UPLOAD)
-                conn.send(('\n'.join(files) + '\n').encode())
-
-            # UPLOAD
-            elif command == "UPLOAD":
-                filename = cmd_parts[1]
-                size = int(cmd_parts[2])  # Expected size
-                file_dir = UPLOAD
-                original_path = os.path.join(file_dir, filename)
-
-                # Check if file exists
-                if os.path.exists(original_path):
-                    base, ext = os.path.splitext(filename)
-                    archive_dir = os.path.join(file_dir, "VersionHistory")
-                    os.makedirs(archive_dir, exist_ok=True)
-                    version = 1
-                    while os.path.exists(os.path.join(file_dir, f"{base}_v{version}{ext}")):
-                        version += 1
-                    archived_filename = f"{base}_v{version}{ext}"
-                    archive_path = os.path.join(archive_dir, archived_filename)
-                    log(f"Archiving existing file: {original_path} -> {archive_path}")
-                    os.rename(original_path, archive_path)
-                    new_filename = f"{base}_v{version+1}{ext}"
-                    file_path = os.path.join(file_dir, new_filename)
-                else:
-                    file_path = original_path
-
-                # Notify client to start sending file data
-                conn.send("READY\n".encode())
-
-                # Receive file in chunks
-                with open(file_path, 'wb') as f:
-                    bytes_received = 0
-                    while bytes_received < size:
-                        chunk = conn.recv(1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-
-                # Compute hash of received file
-                hasher = hashlib.sha256()
-                with open(file_path, 'rb') as f:
-                    while chunk := f.read(1024):
-                        hasher.update(chunk)
-                received_hash = hasher.hexdigest()
-
-                # Send hash back to client
-                conn.send((received_hash + '\n').encode())
-
-            # DOWNLOAD
-            elif command == "DOWNLOAD":
-                filename = cmd_parts[1]
-                filepath = os.path.join(UPLOAD, filename)
-                if os.path.exists(filepath):
-                    size = os.path.getsize(filepath)
-                    conn.send(f"{size}\n".encode())
-                    
-                    # Wait for client to send "READY" or "RESUME"
-                    ack = recv_line(conn)
-                    if ack.startswith("READY") or ack.startswith("RESUME"):
-                        if ack.startswith("RESUME"):
-                            # Client wants to resume download
-                            bytes_received = int(ack.split()[1])
-                            log(f"Resuming download of {filename} from byte {bytes_received}")
-                        else:
-                            bytes_received = 0
-                        
-                        with open(filepath, 'rb') as f:
-                            f.seek(bytes_received)
-                            while True:
-                                chunk = f.read(1024)
-                                if not chunk:
-                                    break
-                                conn.send(chunk)
-                        
-                        # Send hash of the file
-                        hasher = hashlib.sha256()
-                        with open(filepath, 'rb') as f:
-                            while chunk := f.read(1024):
-                                hasher.update(chunk)
-                        file_hash = hasher.hexdigest()
-                        conn.send((file_hash + '\n').encode())
-                        log(f"Sent {filename} to {addr} with hash {file_hash}")
-                else:
-                    conn.send("ERROR\n".encode())
-
-            elif command == "CHECKPOINT":
-                # Store download progress
-                filename = cmd_parts[1]
-                bytes_received = int(cmd_parts[2])
-                client_id = f"{addr[0]}:{addr[1]}"
-                checkpoints[client_id] = {
-                    "filename": filename,
-                    "bytes_received": bytes_received,
-                    "timestamp": datetime.now().isoformat()
-                }
-                save_checkpoints(checkpoints)
-                conn.send("OK\n".encode())
-                
-            elif command == "DELETE":
-                filename = cmd_parts[1]
-                filepath = os.path.join(UPLOAD, filename)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    conn.send("DELETED\n".encode())
-                    log(f"Deleted file '{filename}' for {addr}")
+            if not cmd_parts:
+                continue
+            read, sent = transport.bytes_in, transport.bytes_out
+            started = time.monotonic()
+            session.failed = False
+            idle, session.idle_since = session.idle_since, None
+            if session.shaper is not None:
+                session.shaper.new_command()
+            handler = COMMANDS.get(cmd_parts[0])
+            command = cmd_parts[0] if handler else "UNKNOWN"
+            denied = denial(session, command) if handler else None
+            try:
+                if handler is None:
+                    # Keeps replies in step with pipelined requests
+                    yield from send_error(session)
+                elif denied:
+                    log(f"Refused {command} to {session.addr} ({session.user or 'not logged in'}): {denied}",
+                        command=command, peer=session.peer)
+                    yield from send_error(session, f"DENIED {denied}")
+                elif command in TRANSFER_COMMANDS:
+                    yield from run_transfer(session, handler, cmd_parts[1:])
                 else:
-                    conn.send("ERROR\n".encode())
-                    log(f"Failed to delete '{filename}' - file not found")
+                    yield from handler(session, cmd_parts[1:])
+            except (IndexError, ValueError) as e:
+                # Missing or malformed arguments, caught before the command read
+                # or sent anything more, get an ERROR like an unknown command
+                if transport.bytes_in != read or transport.bytes_out != sent:
+                    session.failed = True
+                    raise
+                log(f"Bad arguments to {command} from {session.addr}: {e}", command=command, peer=session.peer)
+                yield from send_error(session)
+            except Exception:
+                session.failed = True
+                raise
+            finally:
+                if session.reserved:
+                    upload_budget.release(session.reserved)
+                    session.reserved = 0
+                # Keepalive PINGs do not stop a connection from counting as idle
+                session.idle_since = idle if command == "PING" else time.monotonic()
+                metrics.record(command, time.monotonic() - started, transport.bytes_in - bytes_in,
+                               transport.bytes_out - bytes_out, session.failed)
+            if session.closing:
+                break
     except Exception as e:
-        log(f"Error with {addr}: {e}")
+        error = True
+        log(f"Error with {session.addr}: {e}")
+    metrics.connection_closed(error)
+    qos.close(session.shaper)
+    # Write out this client's coalesced checkpoint updates
+    yield Call(checkpoint_store.flush)
+
+# Admits a new connection under MAX_CONNECTIONS, closing an idle one to
+# make room if need be. close() must end the connection from any thread.
+def admit_connection(session, close):
+    admitted, evicted = connection_table.admit(session, close)
+    if evicted is not None:
+        metrics.reaped("evicted")
+        log(f"Closed idle connection {evicted.addr} to make room for {session.addr}", peer=evicted.peer)
+    if not admitted:
+        metrics.rejected("connections")
+        log(f"Turned away {session.addr}: {len(connection_table)} connections open", peer=session.peer)
+    return admitted
+
+# Closes connections that sat idle too long or stalled in the middle of a command, forever
+def reap_connections():
+    while True:
+        time.sleep(IDLE_CHECK_INTERVAL)
+        for session, reason in connection_table.reap(IDLE_TIMEOUT, SLOW_WINDOW, MIN_TRANSFER_RATE):
+            metrics.reaped(reason)
+            log(f"Closed {reason} connection {session.addr}", peer=session.peer)
+
+# Wakes the thread serving conn, whatever it is blocked on, by ending the connection
+def shutdown_socket(conn):
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # Already closed
+
+# Tells a connection the server is full and closes it, from the accept loop
+def turn_away(conn):
+    try:
+        conn.setblocking(False)
+        conn.send(f"BUSY {RETRY_AFTER}\n".encode())
+        conn.shutdown(socket.SHUT_WR)
+        # Closing with the client's HELLO unread would reset the connection,
+        # which can discard BUSY before the client has read it
+        conn.recv(4096)
+    except OSError:
+        pass
+    conn.close()
+
+# Handles communication with a single client (threaded engine)
+def handle_client(conn, session):
+    try:
+        run_sync(serve(session), session.transport)
     finally:
+        connection_table.remove(session)
         conn.close()
 
-def main():
+# Replies often go out in more than one write (a multi-line reply and its
+# end, a size and then data); Nagle would hold back each later write until
+# the client acknowledges the earlier one, which delayed ACKs make 40ms
+def set_nodelay(conn):
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # Already closed by the client
+
+# Handles communication with a single client (asyncio engine)
+async def handle_client_async(reader, writer, executor):
+    addr = writer.get_extra_info('peername')[:2]
+    # asyncio only sets it on sockets created with IPPROTO_TCP, not on ours
+    set_nodelay(writer.get_extra_info('socket'))
+    stream = AsyncStream(reader, writer, executor, CONN_TIMEOUT)
+    session = Session(addr, stream)
+    loop = asyncio.get_running_loop()
+    if not admit_connection(session, lambda: loop.call_soon_threadsafe(writer.transport.abort)):
+        writer.write(f"BUSY {RETRY_AFTER}\n".encode())
+        writer.close()
+        return
+    try:
+        await run_async(serve(session), stream)
+    finally:
+        connection_table.remove(session)
+        writer.close()
+
+# Lets one process hold as many sockets as the hard limit allows
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:  # Windows has no RLIMIT_NOFILE
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+# Listening socket on HOST:PORT. With reuse_port several processes can each
+# have one, and the kernel spreads new connections over them.
+def create_listener(reuse_port=False):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8192)  # 8KB send buffer
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8192)  # 8KB receive buffer
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Accepted connections inherit these; large buffers are needed to fill fast links
+    if SEND_BUFFER_SIZE:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    if RECV_BUFFER_SIZE:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
     s.bind((HOST, PORT))
-    s.listen()
+    s.listen(BACKLOG)
+    return s
+
+# This process's listening socket: its own, its own share of the port as a
+# worker, or the one the supervisor opened for all workers
+def open_listener():
+    if LISTEN_FD is not None:
+        return socket.socket(fileno=LISTEN_FD)
+    return create_listener(reuse_port=WORKER is not None)
+
+# Raised out of the accept loop by SIGTERM
+class Shutdown(SystemExit):
+    pass
+
+def raise_shutdown(signum, frame):
+    raise Shutdown()
+
+# Lets the commands still running finish, up to DRAIN_TIMEOUT, closing each
+# connection as soon as it is between commands. New connections must no
+# longer be accepted.
+def drain():
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    busy = connection_table.close_idle()
+    if busy:
+        log(f"Shutting down: waiting for {busy} running command(s)")
+    while busy and time.monotonic() < deadline:
+        time.sleep(0.1)
+        busy = connection_table.close_idle()
+    if busy:
+        log(f"Shutting down with {busy} command(s) unfinished")
+
+# Thread-per-connection server
+def main_threaded():
+    s = open_listener()
     print(f"[SERVER STARTED] Listening on {HOST}:{PORT}")
 
-    while True:
-        conn, addr = s.accept()
-        threading.Thread(target=handle_client, args=(conn, addr)).start()
+    # At most MAX_CONNECTIONS threads exist; connections beyond that are
+    # answered straight from here
+    signal.signal(signal.SIGTERM, raise_shutdown)
+    try:
+        while True:
+            conn, addr = s.accept()
+            session = Session(addr, Connection(conn))
+            if not admit_connection(session, lambda conn=conn: shutdown_socket(conn)):
+                turn_away(conn)
+                continue
+            conn.settimeout(CONN_TIMEOUT)
+            set_nodelay(conn)
+            threading.Thread(target=handle_client, args=(conn, session), daemon=True).start()
+    except Shutdown:
+        s.close()
+        drain()
+
+# Single event loop serving every connection, disk work runs in an executor
+async def serve_async():
+    raise_fd_limit()
+    executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="disk")
+    s = open_listener()
+    server = await asyncio.start_server(
+        lambda r, w: handle_client_async(r, w, executor), sock=s)
+    print(f"[SERVER STARTED] Listening on {HOST}:{PORT} (async)")
+    stopping = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    except NotImplementedError:  # Windows: SIGTERM ends the process as set up in main()
+        pass
+    await stopping.wait()
+    server.close()
+    await asyncio.to_thread(drain)
+    # asyncio.run() cancels whatever commands outlasted the drain
+
+# Runs count workers, each this script again with --worker, until SIGTERM
+# or SIGINT, starting any that exit again; then lets them drain and stop.
+# args are the worker's command line arguments.
+def supervise(count, args):
+    shared = None
+    if not REUSEPORT_BALANCES:
+        shared = create_listener()
+        os.set_inheritable(shared.fileno(), True)
+
+    def spawn(index):
+        command = [sys.executable, os.path.abspath(__file__), *args, "--worker", str(index)]
+        if shared is not None:
+            command += ["--listen-fd", str(shared.fileno())]
+        process = subprocess.Popen(command, pass_fds=(shared.fileno(),) if shared is not None else ())
+        log(f"Started worker {index} (pid {process.pid})")
+        return process
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    workers = {index: spawn(index) for index in range(count)}
+    started = {index: time.monotonic() for index in workers}
+    delays = dict.fromkeys(workers, RESTART_DELAY)
+    restart_at = {}
+    print(f"[SERVER STARTED] {count} workers listening on {HOST}:{PORT}")
+
+    while not stopping.wait(0.5):
+        now = time.monotonic()
+        for index, process in workers.items():
+            if process is None:
+                if now >= restart_at[index]:
+                    workers[index], started[index] = spawn(index), now
+                continue
+            code = process.poll()
+            if code is None:
+                continue
+            # A worker that keeps crashing right away is restarted less and less often
+            if now - started[index] >= STABLE_UPTIME:
+                delays[index] = RESTART_DELAY
+            log(f"Worker {index} (pid {process.pid}) exited with status {code}, "
+                f"restarting it in {delays[index]:.0f}s")
+            workers[index], restart_at[index] = None, now + delays[index]
+            delays[index] = min(delays[index] * 2, MAX_RESTART_DELAY)
+
+    running = [process for process in workers.values() if process is not None]
+    log(f"Stopping {len(running)} worker(s)")
+    for process in running:
+        process.terminate()
+    deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+    for process in running:
+        try:
+            process.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            log(f"Worker pid {process.pid} did not stop in time, killing it")
+            process.kill()
+            process.wait()
+
+def main():
+    global HOST, PORT, SEND_BUFFER_SIZE, RECV_BUFFER_SIZE, STORAGE_BACKEND, LOG_FORMAT
+    global KEEP_VERSIONS, MAX_VERSION_AGE, MAX_VERSION_BYTES, METRICS_PORT
+    global MAX_CONNECTIONS, MAX_TRANSFERS, MAX_UPLOAD_BYTES, IDLE_TIMEOUT
+    global CONNECTION_RATE, USER_RATE, ROLE_RATES, SERVER_RATE
+    global WORKERS, WORKER, LISTEN_FD, index_changes
+    global ALLOW_ANONYMOUS, TOKEN_TTL, FILE_CACHE_SIZE
+    parser = argparse.ArgumentParser(description="File sharing server")
+    parser.add_argument("--mode", choices=("threaded", "async"), default=SERVER_MODE,
+                        help="threaded: one thread per client, async: single event loop")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--sndbuf", type=int, default=SEND_BUFFER_SIZE,
+                        help="socket send buffer in bytes (default: kernel autotuning)")
+    parser.add_argument("--rcvbuf", type=int, default=RECV_BUFFER_SIZE,
+                        help="socket receive buffer in bytes (default: kernel autotuning)")
+    parser.add_argument("--storage", choices=("plain", "chunked"), default=STORAGE_BACKEND,
+                        help="plain: full copy per file/version, chunked: deduplicated chunk store")
+    parser.add_argument("--keep-versions", type=int, default=KEEP_VERSIONS,
+                        help="versions kept per file, current one included")
+    parser.add_argument("--max-version-age", type=float, default=MAX_VERSION_AGE,
+                        help="seconds an older version is kept")
+    parser.add_argument("--max-version-bytes", type=int, default=MAX_VERSION_BYTES,
+                        help="bytes of older versions kept per file")
+    parser.add_argument("--log-format", choices=("text", "json"), default=LOG_FORMAT,
+                        help="text: one readable line per record, json: one JSON object per record")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help=f"serve Prometheus metrics at http://{METRICS_HOST}:<port>/metrics")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS or 0,
+                        help="connections served at once, more are answered BUSY (0: no limit)")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS or 0,
+                        help="uploads and downloads running at once (0: no limit)")
+    parser.add_argument("--max-upload-bytes", type=int, default=MAX_UPLOAD_BYTES or 0,
+                        help="upload bytes in flight across all clients (0: no limit)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT or 0,
+                        help="seconds a connection may go without a command (0: forever)")
+    parser.add_argument("--connection-rate", type=parse_rate, default=CONNECTION_RATE,
+                        help="bytes/s of file data per connection, e.g. 512K or 20M")
+    parser.add_argument("--user-rate", type=parse_rate, default=USER_RATE,
+                        help="bytes/s of file data per user, all of their connections together")
+    parser.add_argument("--role-rate", action="append", default=[], metavar="ROLE=RATE",
+                        help="bytes/s of file data shared by every user with ROLE (repeatable)")
+    parser.add_argument("--server-rate", type=parse_rate, default=SERVER_RATE,
+                        help="bytes/s of file data for the whole server")
+    parser.add_argument("--file-cache-size", type=int, default=FILE_CACHE_SIZE,
+                        help="bytes of popular small files served from memory, per worker (0: no cache)")
+    parser.add_argument("--allow-anonymous", action="store_true", default=ALLOW_ANONYMOUS,
+                        help="let clients that do not log in do everything but the admin commands")
+    parser.add_argument("--token-ttl", type=float, default=TOKEN_TTL,
+                        help="seconds a login session token stays valid")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="server processes sharing the port, restarted if they crash (POSIX only); "
+                             "limits and rates apply to each, metrics are served from --metrics-port upwards")
+    parser.add_argument("--worker", type=int, default=WORKER, help=argparse.SUPPRESS)
+    parser.add_argument("--listen-fd", type=int, default=LISTEN_FD, help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+    WORKERS, WORKER, LISTEN_FD = opts.workers, opts.worker, opts.listen_fd
+    if WORKERS > 1 and os.name != 'posix':
+        parser.error("--workers needs a POSIX system")
+    HOST, PORT = opts.host, opts.port
+    SEND_BUFFER_SIZE, RECV_BUFFER_SIZE = opts.sndbuf, opts.rcvbuf
+    STORAGE_BACKEND = opts.storage
+    LOG_FORMAT = logger.fmt = opts.log_format
+    KEEP_VERSIONS, MAX_VERSION_AGE, MAX_VERSION_BYTES = opts.keep_versions, opts.max_version_age, opts.max_version_bytes
+    METRICS_PORT = opts.metrics_port
+    MAX_CONNECTIONS = connection_table.limit = opts.max_connections or None
+    MAX_TRANSFERS = transfer_slots.limit = opts.max_transfers or None
+    MAX_UPLOAD_BYTES = upload_budget.limit = opts.max_upload_bytes or None
+    IDLE_TIMEOUT = opts.idle_timeout or None
+    CONNECTION_RATE, USER_RATE, SERVER_RATE = opts.connection_rate, opts.user_rate, opts.server_rate
+    try:
+        ROLE_RATES = dict(ROLE_RATES, **{role: parse_rate(rate) for role, rate in
+                                        (item.split('=', 1) for item in opts.role_rate)})
+    except ValueError:
+        parser.error("--role-rate takes ROLE=RATE, e.g. user=20M")
+    qos.configure(CONNECTION_RATE, USER_RATE, ROLE_RATES, SERVER_RATE, RATE_BURST, PRIORITY_BYTES)
+    ALLOW_ANONYMOUS = opts.allow_anonymous
+    TOKEN_TTL = accounts.token_ttl = opts.token_ttl
+    FILE_CACHE_SIZE = opts.file_cache_size
+    file_cache.configure(FILE_CACHE_SIZE, FILE_CACHE_MAX_FILE, FILE_CACHE_ADMIT_AFTER)
+
+    if WORKERS > 1 and WORKER is None:
+        supervise(WORKERS, sys.argv[1:])
+        return
+
+    # Exit normally on SIGTERM so queued log records and checkpoints are
+    # written out; once serving, it drains connections first
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if WORKER is not None:
+        # Workers share the supervisor's terminal, whose Ctrl+C is the supervisor's to handle
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        base, ext = os.path.splitext(LOG_FILE)
+        logger.path = f"{base}-worker{WORKER}{ext}"
+        # Another worker may serve the next request, so checkpoints cannot wait in memory
+        checkpoint_store.flush_interval = 0
+        metrics.worker = WORKER
+        if METRICS_PORT:
+            METRICS_PORT += WORKER
+        index_changes = ChangeLog(METADATA_DB)
+
+    if version_catalog.added_chunked:
+        found = migrate_backends()
+        log(f"Recorded the storage backend of catalogued versions ({found} chunk manifest(s))")
+    started = time.monotonic()
+    count = reconcile_index()
+    log(f"Indexed {count} stored file(s) in {time.monotonic() - started:.2f}s")
+    # One process is enough to sweep shared state
+    if WORKER in (None, 0):
+        threading.Thread(target=reap_expired, daemon=True).start()
+    if index_changes is not None:
+        threading.Thread(target=follow_index, daemon=True).start()
+    threading.Thread(target=reap_connections, daemon=True).start()
+    if METRICS_PORT:
+        serve_http(metrics, METRICS_HOST, METRICS_PORT)
+        log(f"Serving metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    if opts.mode == "async":
+        asyncio.run(serve_async())
+    else:
+        main_threaded()
 
 if __name__ == "__main__":
     main()
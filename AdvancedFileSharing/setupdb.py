@@ -1,22 +1,14 @@
 import sqlite3
-import hashlib
+
+from utils.auth import create_tables, hash_password
 
 
 conn = sqlite3.connect('users.db')
 c = conn.cursor()
 
 
-c.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    username TEXT PRIMARY KEY,
-    password_hash TEXT NOT NULL,
-    role TEXT NOT NULL
-)
-''')
-
-
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+# Users, and the login sessions the server hands out (see utils/auth.py)
+create_tables(conn)
 
 
 users = [
@@ -33,4 +25,4 @@ for username, password_hash, role in users:
 conn.commit()
 conn.close()
 
-print("Database and users created successfully!")
\ No newline at end of file
+print("Database and users created successfully!")
@@ -0,0 +1,159 @@
+import threading
+import time
+
+# Admission control for the server. Three limits keep a burst of clients
+# from exhausting threads, file descriptors, memory or disk:
+#
+#   - open connections (ConnectionTable). A new connection beyond the limit
+#     takes the place of the connection that has been idle longest, if one
+#     has been idle long enough; otherwise it is told "BUSY <seconds>" and
+#     closed straight away.
+#   - transfers running at once, and
+#   - upload bytes still to be received (both Limiters). A command that
+#     needs one of these waits briefly for room, then gets "BUSY <seconds>"
+#     instead of its usual reply.
+#
+# Password checks are deliberately slow, so LOGIN has limits of its own: a
+# Limiter on how many run at once, and a FailureCounter that turns away
+# addresses with too many recent failures before their password is checked.
+#
+# BUSY always comes where the client expects a reply line, so clients can
+# treat it as "try again after <seconds>" on any request. The table also
+# reaps connections that have been idle (PING aside) for too long, and those
+# in the middle of a command that have stopped moving data, which is what
+# a slowloris peer does to stay under the socket timeout.
+
+
+class Limiter:
+    """A budget of some resource (transfers, bytes) shared by every connection.
+
+    One request larger than the whole budget is still let through when
+    nothing else holds any of it, so it is slowed down rather than refused
+    forever. A limit of None means no limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, amount=1):
+        with self.lock:
+            if self.limit is not None and self.used and self.used + amount > self.limit:
+                return False
+            self.used += amount
+            return True
+
+    def release(self, amount=1):
+        with self.lock:
+            self.used -= amount
+
+
+class FailureCounter:
+    """Recent failures per key (a peer address), to lock out whoever keeps failing.
+
+    A key with limit failures within window seconds of its first one is
+    blocked until the window is over; then its count starts again. At most
+    max_keys keys are tracked, the oldest being forgotten first.
+    """
+
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.counts = {}  # Key -> [failures, time of the first], oldest first
+
+    # Seconds until key may try again, 0 if it is not blocked
+    def blocked(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.counts.get(key)
+            if entry is None or now - entry[1] >= self.window:
+                return 0
+            return self.window - (now - entry[1]) if entry[0] >= self.limit else 0
+
+    def failed(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.counts.get(key)
+            if entry is None or now - entry[1] >= self.window:
+                self.counts.pop(key, None)
+                entry = self.counts[key] = [0, now]
+            entry[0] += 1
+            while len(self.counts) > self.max_keys:
+                del self.counts[next(iter(self.counts))]
+
+
+class ConnectionTable:
+    """Open connections, by session, with what the reaper needs to know about them.
+
+    A session's idle_since is the time its last command (other than PING)
+    finished, or None while a command runs; its transport counts the bytes
+    it has moved, and its working flag is set while the command is busy on
+    the server's side (e.g. publishing an upload) and moves nothing.
+    """
+
+    def __init__(self, limit, evict_after):
+        self.limit = limit
+        self.evict_after = evict_after  # Seconds idle before a connection may give way to a new one
+        self.lock = threading.Lock()
+        self.sessions = {}  # Session -> [close function, progress mark time, bytes moved at the mark]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # Admits a new connection, closing an idle one to make room if the table
+    # is full. Returns (admitted, evicted session or None).
+    def admit(self, session, close):
+        evicted = None
+        now = time.monotonic()
+        with self.lock:
+            if self.limit is not None and len(self.sessions) >= self.limit:
+                idle = [s for s in self.sessions if s.idle_since is not None
+                        and now - s.idle_since >= self.evict_after]
+                if not idle:
+                    return False, None
+                evicted = min(idle, key=lambda s: s.idle_since)
+                evicted_close = self.sessions.pop(evicted)[0]
+            self.sessions[session] = [close, now, 0]
+        if evicted is not None:
+            evicted_close()
+        return True, evicted
+
+    def remove(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    # Closes every connection that is between commands, for a server that is
+    # shutting down; returns how many are left running one
+    def close_idle(self):
+        with self.lock:
+            idle = [s for s in self.sessions if s.idle_since is not None]
+            closers = [self.sessions.pop(session)[0] for session in idle]
+            busy = len(self.sessions)
+        for close in closers:
+            close()
+        return busy
+
+    # Closes connections idle for longer than idle_timeout, and connections in
+    # the middle of a command that moved fewer than min_rate bytes a second
+    # over the last window seconds. Returns [(session, "idle" or "slow")].
+    def reap(self, idle_timeout, window, min_rate):
+        now = time.monotonic()
+        victims = []
+        with self.lock:
+            for session, state in self.sessions.items():
+                moved = session.transport.bytes_in + session.transport.bytes_out
+                if session.idle_since is not None:
+                    state[1], state[2] = now, moved
+                    if idle_timeout is not None and now - session.idle_since > idle_timeout:
+                        victims.append((session, "idle"))
+                elif now - state[1] >= window:
+                    if moved - state[2] < min_rate * (now - state[1]) and not session.working:
+                        victims.append((session, "slow"))
+                    state[1], state[2] = now, moved
+            closers = [self.sessions.pop(session)[0] for session, _ in victims]
+        for close in closers:
+            close()
+        return victims
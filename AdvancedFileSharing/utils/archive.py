@@ -0,0 +1,62 @@
+import tarfile
+
+# Many files in one reply (BATCH) travel as a tar archive. The server writes
+# the archive itself, a header and then the file's bytes per member, so it is
+# produced while it is sent and never staged on disk. Every member carries the
+# SHA-256 of its content in its pax header under SHA256_KEY, ahead of the data,
+# so the client can verify each file as soon as it has extracted it. On the
+# wire the archive is a block stream as described in utils/compression.py,
+# compressed or not.
+
+SHA256_KEY = "FILESHARE.sha256"
+TAR_BLOCK = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = bytes(2 * TAR_BLOCK)
+
+
+# Header block(s) for a regular file member
+def member_header(name, size, mtime, sha256):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    info.pax_headers = {SHA256_KEY: sha256}
+    return info.tobuf(tarfile.PAX_FORMAT)
+
+
+# Zero bytes that round a member's data up to a whole tar block
+def member_padding(size):
+    return bytes(-size % TAR_BLOCK)
+
+
+class BlockReader:
+    """Read-only file object over a block stream, for tarfile's stream mode.
+
+    Blocks are pulled from conn (a utils.protocol.Connection) only as they
+    are read, and decompressed with decompressor if one is given.
+    """
+
+    def __init__(self, conn, decompressor=None):
+        self.conn = conn
+        self.decompressor = decompressor
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self, n=-1):
+        while not self.eof and (n < 0 or len(self.buffer) < n):
+            block = self.conn.recv_block()
+            if not block:
+                self.eof = True
+                break
+            self.buffer += self.decompressor.decompress(block) if self.decompressor else block
+        if n < 0:
+            n = len(self.buffer)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    # Reads to the end of the stream, so the connection is ready for the next reply
+    def drain(self):
+        while not self.eof:
+            self.buffer.clear()
+            self.read(1)
+        self.buffer.clear()
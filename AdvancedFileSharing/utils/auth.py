@@ -0,0 +1,193 @@
+import contextlib
+import hashlib
+import hmac
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+
+# Accounts and login sessions, kept in users.db and checked by the server.
+#
+# Passwords are stored as salted PBKDF2-SHA256 hashes, which take a good
+# fraction of a second to check on purpose. So a password is only checked
+# once, at LOGIN, which hands out a random session token. Every later
+# connection presents the token with AUTH instead. The server stores only the
+# token's SHA-256 in the sessions table (every worker process can see it) and
+# remembers tokens it has checked in memory for cache_ttl seconds, so a
+# reconnect or a new pooled connection costs a dict lookup and no database
+# query. A logged out or expired token is refused by the database at once;
+# other worker processes may go on accepting it from their caches for up to
+# cache_ttl seconds.
+
+HASH_ITERATIONS = 600000  # PBKDF2 rounds for new password hashes
+SALT_BYTES = 16
+TOKEN_BYTES = 32
+TOKEN_TTL = 24 * 3600  # Seconds a login session lasts
+CACHE_TTL = 60.0  # Seconds a checked token is trusted without asking the database again
+MAX_CACHED = 10000  # Tokens remembered at once
+POOL_SIZE = 4  # Database connections shared by the server's threads
+
+
+# "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>"
+def hash_password(password, iterations=HASH_ITERATIONS):
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+
+# Whether password matches a stored hash, ours or the unsalted SHA-256 hex
+# digests setupdb.py used to write
+def verify_password(password, stored):
+    if stored.startswith("pbkdf2_sha256$"):
+        try:
+            _, iterations, salt, digest = stored.split('$')
+            computed = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), int(iterations))
+        except ValueError:
+            return False
+        return hmac.compare_digest(computed.hex(), digest)
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+# Whether a stored hash should be replaced by a fresh one at the next login
+def needs_rehash(stored):
+    return not stored.startswith(f"pbkdf2_sha256${HASH_ITERATIONS}$")
+
+
+# Checked for unknown users, so a login takes as long whether or not the name exists
+DUMMY_HASH = f"pbkdf2_sha256${HASH_ITERATIONS}${'00' * SALT_BYTES}${'00' * 32}"
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_tables(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            role TEXT NOT NULL
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            role TEXT NOT NULL,
+            expires REAL NOT NULL
+        )
+    ''')
+    db.commit()
+
+
+class DatabasePool:
+    """A fixed number of SQLite connections handed out one thread at a time."""
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            self.connections.put(db)
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self.connections.get()
+        try:
+            yield db
+        except BaseException:
+            db.rollback()
+            raise
+        finally:
+            self.connections.put(db)
+
+
+class Accounts:
+    """Password logins and the session tokens they hand out."""
+
+    def __init__(self, db_path, token_ttl=TOKEN_TTL, cache_ttl=CACHE_TTL, pool_size=POOL_SIZE):
+        self.token_ttl = token_ttl
+        self.cache_ttl = cache_ttl
+        self.pool = DatabasePool(db_path, pool_size)
+        with self.pool.connection() as db:
+            create_tables(db)
+        self.lock = threading.Lock()
+        self.cache = {}  # token hash -> (username, role, trusted until)
+        self.hits = 0
+        self.misses = 0
+
+    # (token, role) for a correct password, None otherwise
+    def login(self, username, password):
+        with self.pool.connection() as db:
+            row = db.execute('SELECT password_hash, role FROM users WHERE username=?', (username,)).fetchone()
+        if row is None:
+            verify_password(password, DUMMY_HASH)
+            return None
+        stored, role = row
+        if not verify_password(password, stored):
+            return None
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        key, expires = token_hash(token), time.time() + self.token_ttl
+        with self.pool.connection() as db:
+            if needs_rehash(stored):
+                db.execute('UPDATE users SET password_hash=? WHERE username=?', (hash_password(password), username))
+            db.execute('INSERT INTO sessions (token_hash, username, role, expires) VALUES (?, ?, ?, ?)',
+                       (key, username, role, expires))
+            db.commit()
+        self._remember(key, username, role, expires)
+        return token, role
+
+    # (username, role) of a token checked within the last cache_ttl seconds;
+    # None means check() has to ask the database
+    def cached(self, token):
+        key = token_hash(token)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[2] > time.time():
+                self.hits += 1
+                return entry[:2]
+        return None
+
+    # (username, role) of a valid token, None if it is unknown, expired or logged out
+    def check(self, token):
+        found = self.cached(token)
+        if found is not None:
+            return found
+        key = token_hash(token)
+        with self.lock:
+            self.misses += 1
+        with self.pool.connection() as db:
+            row = db.execute('SELECT username, role, expires FROM sessions WHERE token_hash=? AND expires>?',
+                             (key, time.time())).fetchone()
+        if row is None:
+            return None
+        self._remember(key, *row)
+        return row[:2]
+
+    def logout(self, token):
+        key = token_hash(token)
+        with self.lock:
+            self.cache.pop(key, None)
+        with self.pool.connection() as db:
+            db.execute('DELETE FROM sessions WHERE token_hash=?', (key,))
+            db.commit()
+
+    # Deletes expired sessions, returns how many
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            self.cache = {key: entry for key, entry in self.cache.items() if entry[2] > now}
+        with self.pool.connection() as db:
+            removed = db.execute('DELETE FROM sessions WHERE expires<=?', (now,)).rowcount
+            db.commit()
+        return removed
+
+    def _remember(self, key, username, role, expires):
+        with self.lock:
+            if len(self.cache) >= MAX_CACHED:
+                now = time.time()
+                self.cache = {k: entry for k, entry in self.cache.items() if entry[2] > now}
+                while len(self.cache) >= MAX_CACHED:
+                    del self.cache[next(iter(self.cache))]  # Oldest first
+            self.cache[key] = (username, role, min(time.time() + self.cache_ttl, expires))
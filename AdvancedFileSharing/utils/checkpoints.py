@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Transfer checkpoints in SQLite (WAL mode), one row per (owner, name). The
+# owner is whoever the progress belongs to: a client identity on the server,
+# the server address on a client. Updates land in an in-memory map first and
+# are written out together at most every flush_interval seconds, so frequent
+# progress updates cost one row upsert each instead of a whole-file rewrite.
+# With flush_interval=0 every update is written straight away, which is what
+# several server processes sharing the database need to see each other's.
+
+
+class CheckpointStore:
+    def __init__(self, db_path, ttl, flush_interval=1.0):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}  # (owner, name) -> JSON state, or None for a delete
+        self.last_flush = time.monotonic()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # Losing the last updates to a power cut is fine
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                owner TEXT NOT NULL,
+                name TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (owner, name)
+            )
+        ''')
+        self.db.commit()
+
+    # Saved state for (owner, name) as a dict, or None
+    def get(self, owner, name):
+        with self.lock:
+            if (owner, name) in self.pending:
+                state = self.pending[(owner, name)]
+            else:
+                row = self.db.execute('SELECT state FROM checkpoints WHERE owner=? AND name=?',
+                                      (owner, name)).fetchone()
+                state = row[0] if row else None
+        return json.loads(state) if state is not None else None
+
+    def put(self, owner, name, state):
+        self._queue(owner, name, json.dumps(state))
+
+    def delete(self, owner, name):
+        self._queue(owner, name, None)
+
+    # Writes every pending update in one transaction
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    # Deletes checkpoints nobody has updated within the TTL, returns how many
+    def expire(self):
+        with self.lock:
+            self._flush_locked()
+            cursor = self.db.execute('DELETE FROM checkpoints WHERE updated < ?', (time.time() - self.ttl,))
+            self.db.commit()
+            return cursor.rowcount
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def _queue(self, owner, name, state):
+        with self.lock:
+            self.pending[(owner, name)] = state
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        now = time.time()
+        puts = [(owner, name, state, now) for (owner, name), state in self.pending.items() if state is not None]
+        deletes = [key for key, state in self.pending.items() if state is None]
+        self.pending = {}
+        with self.db:
+            self.db.executemany('''
+                INSERT INTO checkpoints (owner, name, state, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(owner, name) DO UPDATE SET state=excluded.state, updated=excluded.updated
+            ''', puts)
+            self.db.executemany('DELETE FROM checkpoints WHERE owner=? AND name=?', deletes)
@@ -0,0 +1,283 @@
+import bisect
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+
+# Content-addressed chunk store. Files are cut into content-defined chunks
+# (the bytes around a position pick the boundaries, so an edit only changes
+# the chunks around it) and every distinct chunk is stored once under its SHA-256.
+# A stored file is then a small manifest listing its chunks, which is what
+# sits in uploaded/ (and VersionHistory/) in place of the full copy.
+
+MANIFEST_MAGIC = b"FSCHUNKS1\n"
+CHUNK_HASH = re.compile(r'[0-9a-f]{64}')  # What a chunk's name must be before it goes into a path
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK_BITS = 16  # Chunks run about 2**16 = 64 KB past MIN_CHUNK on average
+MAX_CHUNK = 256 * 1024
+READ_BLOCK = 4 * 1024 * 1024
+
+# Every byte value stands for one pseudo-random bit, and a chunk ends after
+# the first avg_bits bytes in a row whose bits spell _BOUNDARY. Translating
+# a block to its bits and searching it for the pattern both run in C, so
+# finding boundaries costs about as much as hashing the chunks.
+_BITS = bytes(random.Random(0x5EED).getrandbits(1) for _ in range(256))
+_BOUNDARY = bytes([1, 0, 0, 1, 1, 0, 1, 0, 1, 1, 1, 0, 0, 1, 0, 0, 0, 1, 1, 0, 1, 1, 0, 0, 0, 1, 0, 1, 1, 1, 0, 1])
+
+
+# Yields content-defined chunks of the file at path
+def iter_chunks(path, min_size=MIN_CHUNK, avg_bits=AVG_CHUNK_BITS, max_size=MAX_CHUNK):
+    pattern = _BOUNDARY[:avg_bits]
+    buf = bits = b''
+    pos = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while True:
+            if not eof and len(buf) - pos < max_size:
+                block = f.read(READ_BLOCK)
+                if block:
+                    buf = buf[pos:] + block
+                    bits = bits[pos:] + block.translate(_BITS)
+                    pos = 0
+                else:
+                    eof = True
+                continue
+            if pos >= len(buf):
+                return
+            end = min(pos + max_size, len(buf))
+            found = bits.find(pattern, max(pos, pos + min_size - avg_bits), end)
+            cut = found + avg_bits if found >= 0 else end
+            yield buf[pos:cut]
+            pos = cut
+
+
+# Whether a file is a chunk manifest is never decided from its content: the
+# server records which stored files it wrote as manifests (see
+# utils/versions.py). read_manifest() still checks everything it reads.
+
+def read_manifest(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            raise ValueError(f"{path} is not a chunk manifest")
+        try:
+            manifest = json.loads(f.read())
+        except ValueError:
+            raise ValueError(f"{path} is not a valid chunk manifest") from None
+    if not valid_manifest(manifest):
+        raise ValueError(f"{path} is not a valid chunk manifest")
+    return manifest
+
+
+def valid_manifest(manifest):
+    try:
+        chunks = manifest["chunks"]
+        return (isinstance(manifest["size"], int) and isinstance(manifest["sha256"], str)
+                and CHUNK_HASH.fullmatch(manifest["sha256"]) is not None
+                and all(isinstance(h, str) and CHUNK_HASH.fullmatch(h) and isinstance(n, int) and n > 0
+                        for h, n in chunks)
+                and sum(n for _, n in chunks) == manifest["size"])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+class ChunkStore:
+    def __init__(self, root, db_path):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            )
+        ''')
+        self.db.commit()
+
+    def chunk_path(self, chunk_hash):
+        if not isinstance(chunk_hash, str) or not CHUNK_HASH.fullmatch(chunk_hash):
+            raise ValueError(f"bad chunk hash {chunk_hash!r}")
+        return os.path.join(self.root, chunk_hash[:2], chunk_hash[2:])
+
+    # Whether the file at path is a manifest this store wrote: it parses and
+    # every chunk it lists is stored. Only used to sort out catalogs from
+    # before the backend was recorded.
+    def owns(self, path):
+        try:
+            manifest = read_manifest(path)
+        except (OSError, ValueError):
+            return False
+        hashes = {h for h, _ in manifest["chunks"]}
+        with self.lock:
+            known = sum(self.db.execute('SELECT COUNT(*) FROM chunks WHERE hash=?', (h,)).fetchone()[0]
+                        for h in hashes)
+        return known == len(hashes)
+
+    # Splits src_path into chunks, stores the new ones and writes a manifest to
+    # dest_path. New chunk files are written first, then every reference is
+    # taken in one transaction. If that fails, nothing is left referenced.
+    def ingest(self, src_path, dest_path, digest):
+        chunks = []
+        size = 0
+        for data in iter_chunks(src_path):
+            chunk_hash = hashlib.sha256(data).hexdigest()
+            path = self.chunk_path(chunk_hash)
+            if not os.path.exists(path):
+                write_chunk(path, data)
+            chunks.append([chunk_hash, len(data)])
+            size += len(data)
+        manifest = {"size": size, "sha256": digest, "chunks": chunks}
+        self._add_refs(chunks, src_path)
+        try:
+            tmp = dest_path + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(MANIFEST_MAGIC)
+                f.write(json.dumps(manifest).encode())
+            os.replace(tmp, dest_path)
+        except BaseException:
+            self.release(manifest)
+            raise
+        return manifest
+
+    # Drops one reference to every chunk of a manifest, deleting unreferenced
+    # chunks. The files go before the transaction commits, so a concurrent
+    # ingest() (in this or another server process) of the same chunk either
+    # still sees the row or writes the file anew.
+    def release(self, manifest):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for chunk_hash, _ in manifest["chunks"]:
+                    self.db.execute('UPDATE chunks SET refs = refs - 1 WHERE hash=?', (chunk_hash,))
+                dead = [row[0] for row in self.db.execute('SELECT hash FROM chunks WHERE refs <= 0')]
+                self.db.execute('DELETE FROM chunks WHERE refs <= 0')
+                for chunk_hash in dead:
+                    try:
+                        os.remove(self.chunk_path(chunk_hash))
+                    except FileNotFoundError:
+                        pass
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def open(self, manifest_path):
+        return ChunkedFile(self, read_manifest(manifest_path))
+
+    # Logical bytes referenced by manifests vs. bytes actually stored
+    def stats(self):
+        with self.lock:
+            logical, physical, count = self.db.execute(
+                'SELECT COALESCE(SUM(size * refs), 0), COALESCE(SUM(size), 0), COUNT(*) FROM chunks'
+            ).fetchone()
+        ratio = logical / physical if physical else 1.0
+        return {"logical_bytes": logical, "physical_bytes": physical, "chunks": count,
+                "dedup_ratio": round(ratio, 3)}
+
+    # Adds a reference per occurrence in chunks ([hash, size] of src_path in
+    # order). The write transaction keeps other server processes from racing
+    # on the same chunks; a chunk whose file was released since ingest() wrote
+    # or found it is written again from src_path.
+    def _add_refs(self, chunks, src_path):
+        counts = {}
+        offsets = {}
+        pos = 0
+        for chunk_hash, size in chunks:
+            counts[chunk_hash] = counts.get(chunk_hash, 0) + 1
+            offsets.setdefault(chunk_hash, (pos, size))
+            pos += size
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for chunk_hash, count in counts.items():
+                    if self.db.execute('UPDATE chunks SET refs = refs + ? WHERE hash=?',
+                                       (count, chunk_hash)).rowcount:
+                        continue
+                    start, size = offsets[chunk_hash]
+                    path = self.chunk_path(chunk_hash)
+                    if not os.path.exists(path):
+                        with open(src_path, 'rb') as f:
+                            f.seek(start)
+                            data = f.read(size)
+                        if hashlib.sha256(data).hexdigest() != chunk_hash:
+                            raise ValueError(f"{src_path} changed while it was being chunked")
+                        write_chunk(path, data)
+                    self.db.execute('INSERT INTO chunks (hash, size, refs) VALUES (?, ?, ?)',
+                                    (chunk_hash, size, count))
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+
+# Writes a chunk file in one go; several writers of the same chunk each use their own temporary file
+def write_chunk(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ChunkedFile(io.RawIOBase):
+    """Read-only, seekable view of a stored file reassembled from its chunks."""
+
+    mode = 'rb'
+
+    def __init__(self, store, manifest):
+        super().__init__()
+        self.store = store
+        self.size = manifest["size"]
+        self.sha256 = manifest["sha256"]
+        self.hashes = [c[0] for c in manifest["chunks"]]
+        self.offsets = []
+        pos = 0
+        for _, size in manifest["chunks"]:
+            self.offsets.append(pos)
+            pos += size
+        self.pos = 0
+        self.cached_index = -1
+        self.cached = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        written = 0
+        while written < len(view) and self.pos < self.size:
+            index = bisect.bisect_right(self.offsets, self.pos) - 1
+            chunk = self._load(index)
+            start = self.pos - self.offsets[index]
+            n = min(len(chunk) - start, len(view) - written)
+            view[written:written + n] = chunk[start:start + n]
+            written += n
+            self.pos += n
+        return written
+
+    def _load(self, index):
+        if index != self.cached_index:
+            with open(self.store.chunk_path(self.hashes[index]), 'rb') as f:
+                self.cached = f.read()
+            self.cached_index = index
+        return self.cached
@@ -0,0 +1,166 @@
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Streaming compression for file payload. Client and server agree on a codec
+# once per connection (COMPRESS); each transfer then decides for itself,
+# from a sample of the file, whether compressing is worth it. A compressed
+# payload is a stream of blocks on the payload channel:
+#
+#   [length: 4 bytes, big endian][compressed bytes] ... [0]
+#
+# and ends with a zero-length block. Hashes are always taken over the
+# uncompressed bytes, so the SHA-256 check stays end to end. A receiver caps
+# what a block may decompress to at what it still expects, so a small block
+# cannot blow up into gigabytes in its memory.
+
+BLOCK_HEADER = struct.Struct('!I')
+MAX_BLOCK = 16 * 1024 * 1024  # Largest compressed block a receiver accepts
+SAMPLE_SIZE = 64 * 1024  # Bytes compressed to decide whether a file is worth it
+MIN_RATIO = 0.9  # Compress only if the sample shrinks below this fraction
+ZLIB_LEVEL = 1  # Fastest level; text still shrinks several times over
+ZSTD_LEVEL = 3
+
+
+class _Lz4Compressor:
+    def __init__(self):
+        self.obj = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        if self.started:
+            return self.obj.compress(data)
+        self.started = True
+        return self.obj.begin() + self.obj.compress(data)
+
+    def flush(self):
+        if not self.started:
+            self.started = True
+            return self.obj.begin() + self.obj.flush()
+        return self.obj.flush()
+
+
+class _OutputFull(Exception):
+    pass
+
+
+class _CappedOutput:
+    """Where zstandard's stream_writer puts decompressed data, up to a limit."""
+
+    def __init__(self):
+        self.parts = []
+        self.room = -1  # Bytes still accepted, -1 for any number
+
+    def write(self, data):
+        if 0 <= self.room < len(data):
+            self.parts.append(bytes(data[:self.room]))
+            self.room = 0
+            raise _OutputFull()
+        self.parts.append(bytes(data))
+        if self.room >= 0:
+            self.room -= len(data)
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+class _ZstdDecompressor:
+    """zstandard's decompressobj() cannot cap its output; its stream_writer
+    hands the output over a piece at a time, so it can stop early."""
+
+    def __init__(self):
+        self.out = _CappedOutput()
+        self.writer = zstandard.ZstdDecompressor().stream_writer(self.out)
+
+    def decompress(self, data, max_length=-1):
+        self.out.room = max_length
+        try:
+            self.writer.write(data)
+        except _OutputFull:
+            pass
+        return self.out.take()
+
+
+# Codec name -> (compressor factory, decompressor factory), best first
+CODECS = {}
+if zstandard is not None:
+    CODECS["zstd"] = (lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj(), _ZstdDecompressor)
+if lz4 is not None:
+    CODECS["lz4"] = (_Lz4Compressor, lambda: lz4.frame.LZ4FrameDecompressor())
+CODECS["zlib"] = (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj)
+
+
+# First codec in offered (the peer's preference order) that this side supports
+def choose_codec(offered):
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+
+# Whether a sample of the data compresses well enough to bother
+def worth_compressing(sample):
+    if len(sample) < 512:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+
+# Samples an open file at offset and puts the position back where it was
+def sample_file(f, offset=0):
+    position = f.tell()
+    f.seek(offset)
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(position)
+    return worth_compressing(sample)
+
+
+class Compressor:
+    """Compresses a payload into length-prefixed blocks."""
+
+    def __init__(self, codec):
+        self.obj = CODECS[codec][0]()
+
+    # Framed block for data (empty if the codec is still buffering)
+    def compress(self, data):
+        out = self.obj.compress(data)
+        return BLOCK_HEADER.pack(len(out)) + out if out else b''
+
+    # Whatever the codec still buffers, followed by the end-of-stream marker
+    def finish(self):
+        out = self.obj.flush()
+        return (BLOCK_HEADER.pack(len(out)) + out if out else b'') + BLOCK_HEADER.pack(0)
+
+
+class Framer:
+    """Frames data into blocks the way Compressor does, without compressing it."""
+
+    def compress(self, data):
+        return BLOCK_HEADER.pack(len(data)) + bytes(data) if data else b''
+
+    def finish(self):
+        return BLOCK_HEADER.pack(0)
+
+
+class Decompressor:
+    def __init__(self, codec):
+        self.obj = CODECS[codec][1]()
+
+    # What block decompresses to, at most max_length bytes of it. A block
+    # that reaches max_length may not have been decompressed in full, so
+    # that call has to be the stream's last: callers pass one more byte than
+    # they expect and give up on the payload if they get it.
+    def decompress(self, block, max_length=None):
+        if max_length is None:
+            return self.obj.decompress(block)
+        return self.obj.decompress(block, max_length)
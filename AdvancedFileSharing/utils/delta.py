@@ -0,0 +1,178 @@
+import hashlib
+import math
+import mmap
+import struct
+import zlib
+
+# rsync-style delta transfer. The server sends one signature record per block
+# of its current version (a weak rolling checksum plus a strong hash); the
+# client slides a window over its new version and, wherever the window matches
+# a block, sends a reference to it instead of the bytes. The delta is a stream
+# of ops, each with a 9 byte header:
+#
+#   COPY:    [b'C'][first block index][block count]  - copy blocks from the old version
+#   LITERAL: [b'L'][length][0]                       - followed by length new bytes
+#
+# The weak checksum is Adler-32, so whole blocks are checked with zlib at C
+# speed and the byte-by-byte roll only runs where the file has changed.
+
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 128 * 1024
+SIG_RECORD = struct.Struct('!I16s')
+OP_HEADER = struct.Struct('!cII')
+OP_COPY = b'C'
+OP_LITERAL = b'L'
+MAX_LITERAL = 1024 * 1024  # Longest single literal op, keeps receive buffers small
+_MOD = 65521
+
+
+# Roughly sqrt(size), like rsync, as a power of two within bounds
+def block_size_for(size):
+    target = math.isqrt(max(size, 1))
+    return max(MIN_BLOCK, min(MAX_BLOCK, 1 << max(target - 1, 1).bit_length()))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+# Signature records for every block of an open file (last block may be short)
+def signature(f, block_size):
+    records = []
+    while block := f.read(block_size):
+        records.append(SIG_RECORD.pack(zlib.adler32(block), strong_hash(block)))
+    return b''.join(records)
+
+
+def parse_signature(data):
+    return [SIG_RECORD.unpack_from(data, i) for i in range(0, len(data), SIG_RECORD.size)]
+
+
+class _DeltaWriter:
+    def __init__(self, out):
+        self.out = out
+        self.length = 0
+        self.run_start = None
+        self.run_count = 0
+
+    def copy(self, index):
+        if self.run_start is not None and index == self.run_start + self.run_count:
+            self.run_count += 1
+            return
+        self.flush_copy()
+        self.run_start, self.run_count = index, 1
+
+    def literal(self, data):
+        if not len(data):
+            return
+        self.flush_copy()
+        for i in range(0, len(data), MAX_LITERAL):
+            piece = data[i:i + MAX_LITERAL]
+            self._write(OP_HEADER.pack(OP_LITERAL, len(piece), 0))
+            self._write(piece)
+
+    def flush_copy(self):
+        if self.run_start is not None:
+            self._write(OP_HEADER.pack(OP_COPY, self.run_start, self.run_count))
+            self.run_start, self.run_count = None, 0
+
+    def _write(self, data):
+        self.out.write(data)
+        self.length += len(data)
+
+
+# Writes the delta of the file at path against the given signature records to
+# out. Returns (delta length, SHA-256 of the new file). With max_length, gives
+# up as soon as the delta is bound to be longer, returning (None, SHA-256).
+def compute_delta(path, block_size, records, out, max_length=None):
+    table = {}
+    for index, (weak, strong) in enumerate(records):
+        table.setdefault(weak, []).append((index, strong))
+    writer = _DeltaWriter(out)
+
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return 0, hashlib.sha256().hexdigest()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        file_hash = hashlib.sha256(data).hexdigest()
+        n = len(data)
+        if max_length is None:
+            max_length = n + OP_HEADER.size * (n // MAX_LITERAL + 1)  # Enough for an all-literal delta
+
+        def match(weak, start, length):
+            candidates = table.get(weak)
+            if not candidates:
+                return None
+            strong = strong_hash(data[start:start + length])
+            for index, candidate in candidates:
+                if candidate == strong:
+                    return index
+            return None
+
+        p = 0
+        lit_start = 0
+        while p + block_size <= n:
+            weak = zlib.adler32(data[p:p + block_size])
+            index = match(weak, p, block_size)
+            if index is None:
+                # Roll the window one byte at a time until a block matches again,
+                # or until the bytes passed over would make the delta too long
+                stop = min(n - block_size, lit_start + max_length - writer.length)
+                a, b = weak & 0xffff, weak >> 16
+                while p < stop:
+                    out_byte, in_byte = data[p], data[p + block_size]
+                    a = (a - out_byte + in_byte) % _MOD
+                    b = (b - block_size * out_byte - 1 + a) % _MOD
+                    p += 1
+                    weak = (b << 16) | a
+                    if weak in table:
+                        index = match(weak, p, block_size)
+                        if index is not None:
+                            break
+                if index is None:
+                    if p < n - block_size:
+                        return None, file_hash
+                    break
+            writer.literal(data[lit_start:p])
+            if writer.length > max_length:
+                return None, file_hash
+            writer.copy(index)
+            p += block_size
+            lit_start = p
+
+        # The tail may equal the old version's final (possibly short) block
+        tail = n - lit_start
+        if records and 0 < tail <= block_size:
+            weak = zlib.adler32(data[lit_start:n])
+            strong = strong_hash(data[lit_start:n])
+            last_index = len(records) - 1
+            if records[last_index] == (weak, strong):
+                writer.copy(last_index)
+                lit_start = n
+        writer.literal(data[lit_start:n])
+        writer.flush_copy()
+    finally:
+        data.close()
+    if writer.length > max_length:
+        return None, file_hash
+    return writer.length, file_hash
+
+
+# Copies count blocks starting at block index first from the old version into writer
+# (a utils.transfer.HashingWriter). Returns the number of bytes copied.
+def copy_blocks(base, writer, first, count, block_size, base_size):
+    start = first * block_size
+    end = min(base_size, start + count * block_size)
+    if start >= end:
+        return 0
+    base.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        n = base.readinto(writer.space(remaining))
+        if not n:
+            break
+        writer.commit(n)
+        remaining -= n
+    return end - start - remaining
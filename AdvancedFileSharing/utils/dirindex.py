@@ -0,0 +1,218 @@
+import base64
+import bisect
+import fnmatch
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# In-memory index of the stored files, kept up to date by the server as files
+# are published and deleted instead of listing the directory on every LIST.
+# Entries live in sorted lists (by name, by size, by mtime), so a page of a
+# listing is a bisect to the cursor plus the entries on the page, however
+# many files there are. Cursors are opaque tokens holding the sort key of the
+# last entry returned; the client sends them back to get the next page.
+#
+# A server running several worker processes has one index per process. They
+# keep each other current through a ChangeLog of the names each one publishes
+# or deletes.
+
+SORT_KEYS = ("name", "size", "mtime")
+MAX_PAGE = 10000  # Largest page a client may ask for
+GLOB_CHARS = "*?["
+
+
+class Entry:
+    __slots__ = ("name", "size", "mtime", "sha256", "version")
+
+    def __init__(self, name, size, mtime, sha256=None, version=1):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.sha256 = sha256
+        self.version = version
+
+    def line(self):
+        return f"{self.name} {self.size} {int(self.mtime)} {self.sha256 or '-'} {self.version}"
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError:
+        raise ValueError(f"bad cursor {token!r}")
+
+
+# Longest literal start of a glob pattern, usable to narrow a name range
+def glob_prefix(pattern):
+    for i, ch in enumerate(pattern):
+        if ch in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+class DirectoryIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.names = []  # Sorted names
+        self.by_size = []  # Sorted (size, name)
+        self.by_mtime = []  # Sorted (mtime, name)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    # Replaces the whole index, e.g. with the result of a directory scan
+    def load(self, entries):
+        with self.lock:
+            self.entries = {e.name: e for e in entries}
+            self.names = sorted(self.entries)
+            self.by_size = sorted((e.size, e.name) for e in self.entries.values())
+            self.by_mtime = sorted((e.mtime, e.name) for e in self.entries.values())
+
+    # Adds or updates one file
+    def put(self, entry):
+        with self.lock:
+            old = self.entries.get(entry.name)
+            if old is not None:
+                self._unlink(old)
+            else:
+                bisect.insort(self.names, entry.name)
+            self.entries[entry.name] = entry
+            bisect.insort(self.by_size, (entry.size, entry.name))
+            bisect.insort(self.by_mtime, (entry.mtime, entry.name))
+
+    def remove(self, name):
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is None:
+                return False
+            self._unlink(old)
+            del self.names[bisect.bisect_left(self.names, name)]
+            return True
+
+    # One page of the listing: (entries, cursor for the next page or None).
+    # prefix and glob filter by name; sort is one of SORT_KEYS.
+    def page(self, limit, cursor=None, prefix=None, glob=None, sort="name", reverse=False):
+        if sort not in SORT_KEYS:
+            raise ValueError(f"unknown sort key {sort!r}")
+        limit = max(1, min(limit, MAX_PAGE))
+        after = decode_cursor(cursor) if cursor else None
+        literal = prefix or ''
+        if glob:
+            # The literal part of the glob narrows the range like a prefix does
+            start = glob_prefix(glob)
+            if start.startswith(literal):
+                literal = start
+            elif not literal.startswith(start):
+                return [], None
+        with self.lock:
+            if sort == "name":
+                keys = self.names
+                lo = bisect.bisect_left(keys, literal) if literal else 0
+                hi = bisect.bisect_left(keys, literal[:-1] + chr(ord(literal[-1]) + 1)) if literal else len(keys)
+                if after is not None:
+                    if reverse:
+                        hi = min(hi, bisect.bisect_left(keys, after))
+                    else:
+                        lo = max(lo, bisect.bisect_right(keys, after))
+                name_of = lambda k: k
+            else:
+                keys = self.by_size if sort == "size" else self.by_mtime
+                lo, hi = 0, len(keys)
+                if after is not None:
+                    after = tuple(after)
+                    if reverse:
+                        hi = bisect.bisect_left(keys, after)
+                    else:
+                        lo = bisect.bisect_right(keys, after)
+                name_of = lambda k: k[1]
+
+            positions = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+            result = []
+            last = None
+            for i in positions:
+                key = keys[i]
+                name = name_of(key)
+                if literal and not name.startswith(literal):
+                    continue
+                if glob and not fnmatch.fnmatchcase(name, glob):
+                    continue
+                if len(result) == limit:
+                    return result, encode_cursor(last)
+                result.append(self.entries[name])
+                last = key
+            return result, None
+
+    def _unlink(self, entry):
+        for keys, key in ((self.by_size, (entry.size, entry.name)), (self.by_mtime, (entry.mtime, entry.name))):
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+
+class ChangeLog:
+    """Names of files published or deleted, shared by server processes through SQLite.
+
+    Each process appends the names it changes and replays those of the other
+    processes into its own index. Sequence numbers come from AUTOINCREMENT,
+    so a process notices when changes it never saw were trimmed.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS index_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                changed REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+        # Everything before now is on disk already, for the scan that builds the index
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name='index_changes'").fetchone()
+        self.seen = row[0] if row else 0
+
+    def append(self, name):
+        with self.lock:
+            self.db.execute('INSERT INTO index_changes (name, pid, changed) VALUES (?, ?, ?)',
+                            (name, self.pid, time.time()))
+            self.db.commit()
+
+    # Calls refresh(name) for each name other processes changed since the
+    # last replay, in order. Returns False without calling it if some of those
+    # changes were trimmed already, in which case the whole index is stale.
+    def replay(self, refresh):
+        with self.lock:
+            rows = self.db.execute('SELECT seq, name, pid FROM index_changes WHERE seq > ? ORDER BY seq',
+                                   (self.seen,)).fetchall()
+            if not rows:
+                return True
+            complete = rows[0][0] == self.seen + 1
+            self.seen = rows[-1][0]
+            if not complete:
+                return False
+            for name in dict.fromkeys(name for _, name, pid in rows if pid != self.pid):
+                refresh(name)
+            return True
+
+    # Forgets changes older than max_age seconds, returns how many
+    def trim(self, max_age):
+        with self.lock:
+            cursor = self.db.execute('DELETE FROM index_changes WHERE changed < ?', (time.time() - max_age,))
+            self.db.commit()
+            return cursor.rowcount
@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+# Connection handlers in server.py are written once as generators that yield
+# the I/O operations below. The threaded server runs each operation directly on
+# a buffered blocking socket (utils.protocol.Connection); the asyncio server
+# awaits the socket operations on the event loop and pushes disk work (Call)
+# to an executor so it never blocks.
+#
+# Both transports count the bytes that pass through them (bytes_in and
+# bytes_out), which is what the server's metrics are built from.
+
+
+# Receive exactly n bytes (fewer only if the peer disconnects)
+class RecvExact:
+    def __init__(self, n):
+        self.n = n
+
+    def run_sync(self, conn):
+        data = conn.read_exact(self.n)
+        conn.bytes_in += len(data)
+        return data
+
+    async def run_async(self, stream):
+        try:
+            data = await stream.timed(stream.reader.readexactly(self.n))
+        except asyncio.IncompleteReadError as e:
+            data = e.partial
+        stream.bytes_in += len(data)
+        return data
+
+
+# Receive up to len(view) bytes into a writable buffer, returns the count (0 on disconnect)
+class RecvInto:
+    def __init__(self, view):
+        self.view = view
+
+    def run_sync(self, conn):
+        n = conn.read_raw_into(self.view)
+        conn.bytes_in += n
+        return n
+
+    async def run_async(self, stream):
+        data = await stream.timed(stream.reader.read(len(self.view)))
+        self.view[:len(data)] = data
+        stream.bytes_in += len(data)
+        return len(data)
+
+
+# Receive one newline-terminated command line (None on disconnect)
+class RecvLine:
+    def run_sync(self, conn):
+        line = conn.read_raw_line()
+        if line is None:
+            return None
+        conn.bytes_in += len(line) + 1
+        return line.decode().strip()
+
+    async def run_async(self, stream):
+        line = await stream.timed(stream.reader.readline())
+        if not line:
+            return None
+        stream.bytes_in += len(line)
+        return line.decode().strip()
+
+
+# Send all of data
+class Send:
+    def __init__(self, data):
+        self.data = data
+
+    def run_sync(self, conn):
+        conn.write_raw(self.data)
+        conn.bytes_out += len(self.data)
+
+    async def run_async(self, stream):
+        stream.writer.write(self.data)
+        stream.bytes_out += len(self.data)
+        await stream.timed(stream.writer.drain())
+
+
+# Send count bytes of an open file from offset, zero-copy where supported
+class SendFile:
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.count = count
+
+    def run_sync(self, conn):
+        sent = conn.send_raw_file(self.f, self.offset, self.count)
+        conn.bytes_out += sent
+        return sent
+
+    async def run_async(self, stream):
+        if self.count <= 0:
+            return 0
+        loop = asyncio.get_running_loop()
+        await stream.timed(stream.writer.drain())
+        # Falls back to executor reads by itself when sendfile is unavailable
+        sent = await loop.sendfile(stream.writer.transport, self.f, self.offset, self.count)
+        stream.bytes_out += sent
+        return sent
+
+
+# Run a blocking function (disk I/O, hashing) and return its result
+class Call:
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def run_sync(self, conn):
+        return self.fn(*self.args)
+
+    async def run_async(self, stream):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(stream.executor, self.fn, *self.args)
+
+
+# Wait a while without holding up other connections
+class Sleep:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def run_sync(self, conn):
+        time.sleep(self.seconds)
+
+    async def run_async(self, stream):
+        await asyncio.sleep(self.seconds)
+
+
+# Bundles what the async operations need for one connection
+class AsyncStream:
+    def __init__(self, reader, writer, executor, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self.timeout = timeout
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def timed(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+
+# Drives a handler generator on a blocking socket
+def run_sync(gen, conn):
+    result, error = None, None
+    while True:
+        try:
+            op = gen.throw(error) if error else gen.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = op.run_sync(conn), None
+        except Exception as e:
+            result, error = None, e
+
+
+# Drives a handler generator on asyncio streams
+async def run_async(gen, stream):
+    result, error = None, None
+    while True:
+        try:
+            op = gen.throw(error) if error else gen.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await op.run_async(stream), None
+        except Exception as e:
+            result, error = None, e
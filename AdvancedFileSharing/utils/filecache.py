@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from utils.integrity import file_signature
+
+# Small files that are downloaded again and again, kept in memory. A cached
+# file holds its content and SHA-256, so a DOWNLOAD of it neither opens nor
+# hashes anything: it costs one stat() to check that the file still has the
+# size, mtime and inode it had when it was read. Anything else (an upload
+# replacing it, a delete, another worker process or a hand edit) makes it
+# a miss and drops the copy.
+#
+# Files are only cached once they have been asked for admit_after times
+# (among the last TRACKED files that missed), so one pass over many files
+# does not push the popular ones out. The least recently used files go first
+# when the cache outgrows its budget.
+
+MEMORY_BUDGET = 256 * 1024 * 1024  # Bytes of file content kept at most
+MAX_FILE_SIZE = 4 * 1024 * 1024  # Larger files are always read from disk
+ADMIT_AFTER = 2  # Misses of a file before it is cached
+TRACKED = 4096  # Files whose misses are counted at once
+
+
+class CachedFile:
+    """Content and digest of a file as it was when read."""
+
+    def __init__(self, data, sha256, signature):
+        self.data = data
+        self.sha256 = sha256
+        self.signature = signature  # utils.integrity.file_signature() of the file read
+        self.compressible = None  # Whether it is worth compressing, worked out on first use
+
+
+class FileCache:
+    """LRU of small stored files within a memory budget (0 disables it)."""
+
+    def __init__(self, budget=MEMORY_BUDGET, max_file_size=MAX_FILE_SIZE, admit_after=ADMIT_AFTER):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # path -> CachedFile, least recently used first
+        self.recent = OrderedDict()  # path -> misses, for files not cached yet
+        self.size = 0  # Bytes of content cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # Dropped to stay within the budget
+        self.invalidations = 0  # Dropped because the file changed or went away
+        self.configure(budget, max_file_size, admit_after)
+
+    def configure(self, budget=MEMORY_BUDGET, max_file_size=MAX_FILE_SIZE, admit_after=ADMIT_AFTER):
+        with self.lock:
+            self.budget = budget
+            self.max_file_size = min(max_file_size, budget)
+            self.admit_after = admit_after
+            self._evict()
+
+    # (cached copy of the file at path or None, its signature for add()).
+    # OSError if the file does not exist.
+    def get(self, path):
+        if not self.budget:
+            return None, None
+        path = os.path.normpath(path)
+        signature = file_signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if entry.signature == signature:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry, signature
+                self._drop(path)
+                self.invalidations += 1
+            self.misses += 1
+        return None, signature
+
+    # After a miss: caches the file at path from f (opened after get()
+    # returned signature, with size bytes of content) if it has been asked
+    # for often enough and fits. Returns the copy, or None; either way f is
+    # left at its start.
+    def add(self, path, signature, f, size):
+        path = os.path.normpath(path)
+        with self.lock:
+            if signature is None or size > self.max_file_size or path in self.entries:
+                return None
+            misses = self.recent.pop(path, 0) + 1
+            if misses < self.admit_after:
+                self.recent[path] = misses
+                if len(self.recent) > TRACKED:
+                    self.recent.popitem(last=False)
+                return None
+        buf = bytearray(size)
+        view = memoryview(buf)
+        filled = 0
+        f.seek(0)
+        while filled < size:
+            n = f.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        f.seek(0)
+        # A file replaced before or while it was read must not be cached under the old signature
+        if filled < size or file_signature(path) != signature:
+            return None
+        data = bytes(buf)
+        entry = CachedFile(data, hashlib.sha256(data).hexdigest(), signature)
+        with self.lock:
+            if path in self.entries:
+                self._drop(path)
+            self.entries[path] = entry
+            self.size += size
+            self._evict()
+        return entry
+
+    # Drops the copy of a file that was replaced or deleted
+    def invalidate(self, path):
+        with self.lock:
+            if os.path.normpath(path) in self.entries:
+                self._drop(os.path.normpath(path))
+                self.invalidations += 1
+
+    def _drop(self, path):
+        self.size -= len(self.entries.pop(path).data)
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= len(entry.data)
+            self.evictions += 1
+
+    # STATS line: "cache hits= misses= evictions= invalidations= files= bytes= budget="
+    def summary(self):
+        with self.lock:
+            return [f"cache hits={self.hits} misses={self.misses} evictions={self.evictions} "
+                    f"invalidations={self.invalidations} files={len(self.entries)} bytes={self.size} "
+                    f"budget={self.budget}"]
+
+    # Prometheus samples
+    def prometheus(self, prefix):
+        with self.lock:
+            samples = (("file_cache_hits_total", "counter", self.hits),
+                       ("file_cache_misses_total", "counter", self.misses),
+                       ("file_cache_evictions_total", "counter", self.evictions),
+                       ("file_cache_invalidations_total", "counter", self.invalidations),
+                       ("file_cache_files", "gauge", len(self.entries)),
+                       ("file_cache_bytes", "gauge", self.size))
+        lines = []
+        for metric, kind, value in samples:
+            lines += [f"# TYPE {prefix}_{metric} {kind}", f"{prefix}_{metric} {value}"]
+        return lines
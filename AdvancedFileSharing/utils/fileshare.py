@@ -0,0 +1,1114 @@
+import base64
+import contextlib
+import hashlib
+import os
+import random
+import socket
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils.transfer import (HashingReader, HashingWriter, recv_to_file, send_from_file, hash_prefix,
+                            send_compressed_from_file, recv_compressed_to_file, write_at, preallocate,
+                            BUFFER_SIZE)
+from utils.integrity import sha256_file
+from utils.merkle import MerkleTree, ChunkVerifier
+from utils.checkpoints import CheckpointStore
+from utils.logger import get_logger
+from utils.protocol import Connection, ProtocolError, ServerBusy, AccessDenied
+from utils.dirindex import Entry, GLOB_CHARS
+from utils.archive import BlockReader, SHA256_KEY
+from utils.names import split_name, local_path, name_for
+from utils import delta
+from utils.compression import Compressor, Decompressor, sample_file
+
+# Client library shared by the command line client, the GUIs and scripts:
+#
+#   with FileShareClient("localhost", 5002, username="user", password="...") as client:
+#       client.upload("report.pdf")
+#       for entry in client.list("*.pdf"):
+#           client.download(entry.name)
+#
+# A FileShareClient keeps a pool of persistent connections. Every operation
+# borrows one for its whole duration, so threads can share a client without
+# their requests interleaving on a socket. An operation that fails because
+# its connection broke is retried on a new one with exponential backoff, and
+# transfers continue from their checkpoints instead of starting over. When the
+# server is overloaded it answers BUSY with a delay, which is waited out
+# before trying again. Idle connections are pinged so the server does not
+# drop them.
+#
+# A client given a username and password logs in on its first connection
+# and gets a session token, which logs in every connection after that
+# without sending the password again. A client given just a token (e.g.
+# one another client got) uses that.
+#
+# Single and parallel downloads are verified chunk by chunk against the
+# file's Merkle tree (utils/merkle.py) where the server provides one: a
+# partial file is checked before it is resumed, and only chunks that fail
+# are fetched again. The finished file must still match the SHA-256 the
+# client works out from the bytes it wrote.
+
+HOST = 'localhost'
+PORT = 5002
+DOWNLOAD_DIR = 'downloaded'  # Where downloads are saved by default
+LOG_FILE = 'logs/client_log.txt'
+CHECKPOINT_DB = 'logs/client_checkpoints.db'  # SQLite store for transfer progress
+CHECKPOINT_TTL = 30 * 24 * 3600  # Seconds an untouched checkpoint is kept
+CHECKPOINT_STEP = 1024 * 1024  # Download progress is checkpointed every this many bytes
+CLIENT_ID_FILE = 'logs/client_id'  # This client's identity, sent to the server with IDENT
+POOL_SIZE = 4  # Most connections a client has open at once
+CONNECT_TIMEOUT = 10.0  # Seconds to wait for the server to accept a connection
+IO_TIMEOUT = 60.0  # Seconds a connection may wait on the server before it counts as broken
+PUBLISH_RATE = 16 * 1024 * 1024  # Bytes per second an upload is at least published at, on top of IO_TIMEOUT
+KEEPALIVE_INTERVAL = 15.0  # Idle connections are pinged this often (the server drops silent ones after 30s)
+MAX_IDLE = 300.0  # Idle connections unused for this long are closed instead
+RETRIES = 3  # Extra attempts after an operation fails on a broken connection
+BACKOFF = 0.5  # Seconds before the first retry, doubled for every further one
+MAX_BACKOFF = 8.0
+BUSY_RETRIES = 20  # Extra attempts when the server answers BUSY, each after the delay it asks for
+PARALLEL_CONNECTIONS = 4  # Default number of connections for a parallel download
+MIN_RANGE_SIZE = 4 * 1024 * 1024  # Files are never split into ranges smaller than this
+MIN_DELTA_SIZE = 64 * 1024  # Smaller files are always uploaded in full
+MAX_DELTA_SIZE = 32 * 1024 * 1024  # So are larger ones: the delta search over changed bytes runs in Python
+MAX_DELTA_RATIO = 0.5  # A delta is only sent when it is at most this fraction of the file
+LIST_PAGE_SIZE = 1000  # Files fetched per LIST page
+STAT_BATCH = 500  # STAT requests pipelined at a time, so neither side's send buffer fills up
+HASH_WORKERS = min(8, os.cpu_count() or 1)  # Threads hashing local files for a tree upload
+
+# Failures that mean the connection is unusable, not that the request was refused
+RETRYABLE = (ConnectionError, TimeoutError, socket.timeout, ProtocolError)
+
+logger = get_logger(LOG_FILE)
+
+
+def log(message, **fields):
+    logger.log(message, **fields)
+
+
+class FileShareError(Exception):
+    """The server refused a request, or a transfer failed verification."""
+
+
+class NotFoundError(FileShareError):
+    pass
+
+
+class NotAuthorized(FileShareError):
+    """The login failed, or the server requires one (or another role) for a request."""
+
+
+# Stable identity of this client, created on first use
+def client_identity(path=CLIENT_ID_FILE):
+    try:
+        with open(path) as f:
+            client_id = f.read().strip()
+        if client_id:
+            return client_id
+    except FileNotFoundError:
+        pass
+    client_id = uuid.uuid4().hex
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(client_id)
+    return client_id
+
+
+# Local file name for one version of a file: <name>_v<version><ext>
+def versioned_name(filename, version):
+    base, ext = os.path.splitext(filename)
+    return f"{base}_v{version}{ext}"
+
+
+# Lets the kernel notice a dead server on a connection that sits idle
+def enable_keepalive(sock, interval=KEEPALIVE_INTERVAL):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    seconds = max(1, int(interval))
+    for option, value in (("TCP_KEEPIDLE", seconds), ("TCP_KEEPINTVL", seconds), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+# Next reply; a closed connection is an error rather than None
+def recv_reply(conn):
+    reply = conn.recv_line()
+    if reply is None:
+        raise ConnectionResetError("connection closed by server")
+    return reply
+
+
+# Whether conn still answers (servers without PING answer ERROR, which counts)
+def ping(conn):
+    try:
+        conn.send_line("PING")
+        return conn.recv_line() is not None
+    except (OSError, ProtocolError):
+        return False
+
+
+# "name size mtime sha256 version" as sent by LIST long=1
+def parse_entry(line):
+    name, size, mtime, sha256, version = line.rsplit(' ', 4)
+    return Entry(name, int(size), int(mtime), None if sha256 == '-' else sha256, int(version))
+
+
+# SHA-256 of a local file, None if it cannot be read
+def _hash_or_none(path):
+    try:
+        return sha256_file(path)
+    except OSError:
+        return None
+
+
+class ConnectionPool:
+    """Persistent connections to one server, handed out one per operation.
+
+    connection() lends an idle connection, or opens a new one while fewer than
+    size are in use, and waits otherwise. A connection the operation failed on
+    is closed rather than returned, since its stream may be out of step. A
+    background thread pings idle connections every keepalive seconds and
+    closes the ones nobody has used for max_idle seconds.
+    """
+
+    def __init__(self, connect, size=POOL_SIZE, keepalive=KEEPALIVE_INTERVAL, max_idle=MAX_IDLE):
+        self.connect = connect
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []  # [conn, last used, last pinged], most recently returned last
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.closed = threading.Event()
+        if keepalive:
+            threading.Thread(target=self._keepalive, name="fileshare-keepalive", daemon=True).start()
+
+    @contextlib.contextmanager
+    def connection(self):
+        if self.closed.is_set():
+            raise RuntimeError("connection pool is closed")
+        self.slots.acquire()
+        try:
+            conn = self._take() or self.connect()
+            try:
+                yield conn
+            except (FileShareError, AccessDenied):
+                # Raised after a complete reply, so the stream is still in step
+                self._put(conn)
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            self._put(conn)
+        finally:
+            self.slots.release()
+
+    # Closes every idle connection, e.g. after one of them turned out to be dead
+    def discard_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _, _ in idle:
+            conn.close()
+
+    def close(self):
+        self.closed.set()
+        self.discard_idle()
+
+    def _take(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, used, _ = self.idle.pop()
+                if now - used < self.max_idle:
+                    return conn
+                conn.close()
+        return None
+
+    def _put(self, conn, used=None, pinged=None):
+        now = time.monotonic()
+        with self.lock:
+            if not self.closed.is_set():
+                self.idle.append([conn, now if used is None else used, now if pinged is None else pinged])
+                return
+        conn.close()
+
+    def _keepalive(self):
+        while not self.closed.wait(self.keepalive / 3):
+            now = time.monotonic()
+            with self.lock:
+                due = [item for item in self.idle if now - item[2] >= self.keepalive]
+                self.idle = [item for item in self.idle if now - item[2] < self.keepalive]
+            for conn, used, _ in due:
+                if now - used >= self.max_idle or not ping(conn):
+                    conn.close()
+                else:
+                    self._put(conn, used, time.monotonic())
+
+
+class FileShareClient:
+    """Thread-safe client for the file sharing server.
+
+    Progress callbacks are called as progress(bytes done, total bytes) from
+    the thread running the transfer. notify, if given, receives status
+    messages (resumes, deltas, retries) that are also written to the log.
+    """
+
+    def __init__(self, host=HOST, port=PORT, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF,
+                 timeout=IO_TIMEOUT, keepalive=KEEPALIVE_INTERVAL, compress=True, download_dir=DOWNLOAD_DIR,
+                 checkpoint_db=CHECKPOINT_DB, client_id=None, notify=None, username=None, password=None,
+                 token=None):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.compress = compress
+        self.download_dir = download_dir
+        self.client_id = client_id or client_identity()
+        self.notify = notify
+        self.owner = f"{host}:{port}"  # Key for this server's checkpoints
+        self.version = None  # Protocol version of the most recent connection
+        self.username = username
+        self.password = password
+        self.token = token  # Session token from LOGIN, presented by every new connection
+        self.role = None  # Role the server gave the login, None before one
+        self.auth_lock = threading.Lock()  # One login at a time, so connections share its token
+        self.checkpoints = CheckpointStore(checkpoint_db, CHECKPOINT_TTL)
+        self.pool = ConnectionPool(self._connect, pool_size, keepalive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.checkpoints.flush()
+
+    # Opens a connection and negotiates the newest protocol and a compression codec
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        sock.settimeout(self.timeout)
+        # Requests are small writes that wait for a reply; Nagle would hold
+        # each one back until the previous write is acknowledged
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            enable_keepalive(sock, self.keepalive)
+        conn = Connection(sock)
+        try:
+            self.version = conn.negotiate()
+            if self.compress:
+                conn.negotiate_compression()
+            conn.send_line(f"IDENT {self.client_id}")
+            recv_reply(conn)
+            self._authenticate(conn)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    # Logs a new connection in with the session token, or with the password
+    # when there is no token yet or the server no longer accepts it.
+    # Connections without either stay anonymous.
+    def _authenticate(self, conn):
+        with self.auth_lock:
+            if self.token is not None:
+                conn.send_line(f"AUTH {self.token}")
+                reply = recv_reply(conn)
+                if reply.startswith("OK "):
+                    self.role = reply.split()[2]
+                    return
+                self.token = None  # Expired or logged out
+                if self.password is None:
+                    raise NotAuthorized("the server no longer accepts the session token")
+            if self.username is None:
+                return
+            password = base64.b64encode(self.password.encode()).decode()
+            conn.send_line(f"LOGIN {self.username} {password}")
+            reply = recv_reply(conn)
+            if not reply.startswith("TOKEN "):
+                raise NotAuthorized("wrong username or password")
+            _, self.token, self.role, _ = reply.split()
+            log(f"Logged in as '{self.username}' ({self.role})")
+
+    # Runs operation(conn, *args) on a pooled connection, retrying with
+    # exponential backoff while the failure is a broken connection
+    def _run(self, operation, *args):
+        attempt = busy = 0
+        while True:
+            try:
+                with self.pool.connection() as conn:
+                    return operation(conn, *args)
+            except AccessDenied as e:
+                raise NotAuthorized("log in first" if e.reason == "login" else
+                                    f"not allowed for role {self.role or 'anonymous'}") from None
+            except ServerBusy as e:
+                if busy >= BUSY_RETRIES:
+                    raise
+                # Spread out so clients turned away together do not all come back at once
+                delay = e.retry_after * random.uniform(1.0, 1.5)
+                self._note(f"{operation.__name__.strip('_')}: server busy, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                busy += 1
+            except RETRYABLE as e:
+                if attempt >= self.retries:
+                    raise
+                # The other idle connections probably broke the same way (e.g. a server restart)
+                self.pool.discard_idle()
+                delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.0)
+                self._note(f"{operation.__name__.strip('_')} failed ({e or type(e).__name__}), "
+                           f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def _note(self, message):
+        log(message)
+        if self.notify:
+            self.notify(message)
+
+    # Makes sure the server is reachable; returns the negotiated protocol version
+    def connect(self):
+        return self._run(self._ping)
+
+    def _ping(self, conn):
+        if not ping(conn):
+            raise ConnectionResetError("server did not answer PING")
+        return conn.version
+
+    # Logs in as username (NotAuthorized if the password is wrong) and
+    # returns the role; connections opened as someone else are not reused
+    def login(self, username, password):
+        with self.auth_lock:
+            self.username, self.password, self.token, self.role = username, password, None, None
+        self.pool.discard_idle()
+        try:
+            self.connect()
+        except NotAuthorized:
+            with self.auth_lock:
+                self.username = self.password = None
+            raise
+        return self.role
+
+    # Ends the login session on the server; the client is anonymous afterwards
+    def logout(self):
+        if self.token is not None:
+            self._run(self._logout)
+            log(f"Logged out '{self.username}'")
+        with self.auth_lock:
+            self.username, self.password, self.token, self.role = None, None, None, None
+        self.pool.discard_idle()
+
+    def _logout(self, conn):
+        conn.send_line("LOGOUT")
+        recv_reply(conn)
+
+    # --- listing ---
+
+    # Every file matching pattern (a glob, or else a name prefix) as
+    # utils.dirindex.Entry objects, sorted by name, size or mtime
+    def list(self, pattern=None, sort="name", descending=False):
+        options = [f"limit={LIST_PAGE_SIZE}", f"sort={sort}", f"order={'desc' if descending else 'asc'}", "long=1"]
+        if pattern:
+            options.append(f"glob={pattern}" if any(c in pattern for c in "*?[") else f"prefix={pattern}")
+        entries = self._run(self._list, options)
+        log(f"Requested list of files from server ({len(entries)} listed).")
+        return entries
+
+    def _list(self, conn, options):
+        entries, cursor = [], None
+        while True:
+            conn.send_line("LIST " + ' '.join(options + ([f"cursor={cursor}"] if cursor else [])))
+            lines = conn.recv_lines()
+            if not lines or not lines[0].startswith("PAGE "):
+                raise FileShareError("server could not list files")
+            entries.extend(parse_entry(line) for line in lines[1:])
+            cursor = lines[0].split()[1]
+            if cursor == "-":
+                return entries
+
+    # name -> (size, mtime, sha256), or None for files the server does not
+    # have; requested in pipelined batches of STAT_BATCH
+    def stat(self, filenames):
+        filenames = list(filenames)
+        result = {}
+        for i in range(0, len(filenames), STAT_BATCH):
+            result.update(self._run(self._stat, filenames[i:i + STAT_BATCH]))
+        log(f"Requested STAT for {len(result)} file(s).")
+        return result
+
+    def _stat(self, conn, filenames):
+        conn.send_lines([f"STAT {name}" for name in filenames])
+        result = {}
+        for name in filenames:
+            reply = recv_reply(conn)
+            if reply == "ERROR":
+                result[name] = None
+                continue
+            size, mtime, file_hash = reply.split()
+            result[name] = (int(size), int(mtime), file_hash)
+        return result
+
+    # Every version the server keeps of a file, newest first:
+    # (version, size, created, sha256, current)
+    def versions(self, filename):
+        rows = self._run(self._versions, filename)
+        log(f"Requested versions of '{filename}'.")
+        return rows
+
+    def _versions(self, conn, filename):
+        conn.send_line(f"VERSIONS {filename}")
+        rows = []
+        for line in conn.recv_lines():
+            version, size, created, file_hash, state = line.split()
+            rows.append((int(version), int(size), int(created), None if file_hash == '-' else file_hash,
+                         state == "current"))
+        return rows
+
+    # Deletes a file on the server; False if it was not there
+    def delete(self, filename):
+        deleted = self._run(self._delete, filename)
+        log(f"Deleted file '{filename}'" if deleted else f"Failed to delete file '{filename}'")
+        return deleted
+
+    def _delete(self, conn, filename):
+        conn.send_line(f"DELETE {filename}")
+        return recv_reply(conn) == "DELETED"
+
+    # Server metrics from STATS: {"server": {...}, "throughput": {...},
+    # "<command>": {...}}, each a dict of numbers (times in ms, throughput in
+    # MB/s; see utils/metrics.py)
+    def stats(self):
+        return self._run(self._stats)
+
+    def _stats(self, conn):
+        conn.send_line("STATS")
+        lines = conn.recv_lines()
+        if lines == ["ERROR"]:
+            raise FileShareError("server does not report metrics")
+        stats = {}
+        for line in lines:
+            name, *fields = line.split()
+            stats[name] = {key: float(value) for key, value in (field.split('=', 1) for field in fields)}
+        return stats
+
+    # --- uploads ---
+
+    # Uploads the file at path (as name, by default its base name; "dir/name"
+    # puts it in a directory) and returns its SHA-256 once the server has
+    # verified it. An interrupted upload continues where it stopped, and a
+    # changed version of a file the server already has only sends the
+    # differences.
+    def upload(self, path, name=None, progress=None):
+        name = name or os.path.basename(path)
+        split_name(name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return self._run(self._upload, path, name, progress)
+
+    def _upload(self, conn, path, name, progress):
+        size = os.path.getsize(path)
+        key = f"upload:{os.path.abspath(path)}"
+        mtime_ns = os.stat(path).st_mtime_ns
+        saved = self.checkpoints.get(self.owner, key) or {}
+        session_id = saved.get("session") if saved.get("size") == size and saved.get("mtime_ns") == mtime_ns else None
+
+        if session_id is None and MIN_DELTA_SIZE <= size <= MAX_DELTA_SIZE:
+            digest = self._upload_delta(conn, path, name, size, progress)
+            if digest:
+                return digest
+
+        # Open (or reopen) the upload session
+        conn.send_line(f"USESSION {name} {size}" + (f" {session_id}" if session_id else ""))
+        response = recv_reply(conn)
+        if not response.startswith("SESSION"):
+            raise FileShareError("server not ready for upload")
+        _, session_id, offset = response.split()
+        offset = int(offset)
+        self.checkpoints.put(self.owner, key, {"session": session_id, "size": size, "mtime_ns": mtime_ns,
+                                               "timestamp": datetime.now().isoformat()})
+        self.checkpoints.flush()
+
+        # Hash the part the server already has, the rest is hashed while it is sent
+        hasher = hashlib.sha256()
+        if offset > 0:
+            self._note(f"Resuming upload of {name} from byte {offset}")
+            hash_prefix(path, hasher, offset)
+
+        started = time.time()
+        codec = None
+        # Nothing is left to send if an earlier attempt got as far as UCOMMIT and only missed the reply
+        if offset < size:
+            # Compress only if the server can and the data is not already compressed
+            with open(path, 'rb') as f:
+                codec = conn.codec if conn.codec and sample_file(f, offset) else None
+
+            conn.send_line(f"UAPPEND {session_id} {offset}" + (f" {codec}" if codec else ""))
+            response = recv_reply(conn)
+            if response != "READY":
+                if response.startswith("ERROR ") and not response.startswith("ERROR -"):
+                    # The session is alive but moved on since USESSION, because the
+                    # connection of an interrupted attempt was still writing to it
+                    raise ConnectionResetError(f"upload session moved to byte {response.split()[1]}")
+                # The session expired on the server; the next attempt opens a new one
+                self.checkpoints.delete(self.owner, key)
+                raise FileShareError("server not ready for upload")
+
+            on_progress = (lambda sent: progress(offset + sent, size)) if progress else None
+            with open(path, 'rb', buffering=0) as f:
+                f.seek(offset)
+                reader = HashingReader(f, hasher)
+                if codec:
+                    send_compressed_from_file(conn, reader, Compressor(codec), size - offset, on_progress)
+                else:
+                    send_from_file(conn, reader, size - offset, on_progress)
+        sha256_hash = hasher.hexdigest()
+        conn.send_line(f"UCOMMIT {session_id} {sha256_hash}")
+
+        received_hash = self._recv_published(conn, size)
+        if received_hash.startswith("INCOMPLETE"):
+            # Some of the data never arrived; a retry sends the rest
+            raise ConnectionResetError(f"server did not receive the whole file ({received_hash})")
+        self.checkpoints.delete(self.owner, key)
+        if received_hash != sha256_hash:
+            log(f"Hash mismatch for '{name}'. Expected: {sha256_hash}, Received: {received_hash}")
+            raise FileShareError(f"hash mismatch after uploading {name}")
+        log(f"Uploaded file '{name}' ({size} bytes)", command="UPLOAD", file=name,
+            bytes=size - offset, duration=round(time.time() - started, 3), codec=codec)
+        return sha256_hash
+
+    # Reply to UCOMMIT or DELTA, which only comes once the server has
+    # published the file; hashing (and with the chunked backend, chunking) a
+    # large one takes a while
+    def _recv_published(self, conn, size):
+        if self.timeout is None:
+            return recv_reply(conn)
+        conn.settimeout(self.timeout + size / PUBLISH_RATE)
+        try:
+            return recv_reply(conn)
+        finally:
+            conn.settimeout(self.timeout)
+
+    # Uploads only what changed against the server's copy of the file.
+    # Returns the file's hash, or None when a full upload should be done instead.
+    def _upload_delta(self, conn, path, name, size, progress):
+        conn.send_line(f"SIGNATURE {name}")
+        reply = recv_reply(conn)
+        if not reply.startswith("SIG "):
+            return None  # Server has no copy to diff against
+        _, block_size, sig_len, base_hash = reply.split()
+        sig = conn.recv_payload(int(sig_len))
+        if len(sig) < int(sig_len):
+            raise ConnectionResetError("connection closed while receiving signature")
+
+        with tempfile.TemporaryFile() as out:
+            max_len = int(size * MAX_DELTA_RATIO)
+            delta_len, sha256_hash = delta.compute_delta(path, int(block_size), delta.parse_signature(sig), out,
+                                                         max_len)
+            if delta_len is None:
+                log(f"Delta for '{name}' would be over {max_len} bytes, uploading in full")
+                return None
+            self._note(f"Sending delta: {delta_len} of {size} bytes")
+
+            conn.send_line(f"DELTA {name} {size} {sha256_hash} {delta_len} {base_hash}")
+            if recv_reply(conn) != "READY":
+                return None  # Server copy changed since the signature was taken
+            out.seek(0)
+            sent = 0
+            while chunk := out.read(BUFFER_SIZE):
+                conn.sendall(chunk)
+                sent += len(chunk)
+                if progress:
+                    progress(sent, delta_len)
+
+        received_hash = self._recv_published(conn, size)
+        if received_hash != sha256_hash:
+            log(f"Delta upload of '{name}' rejected ({received_hash}), uploading in full")
+            return None
+        log(f"Uploaded file '{name}' ({size} bytes) as a {delta_len} byte delta")
+        return sha256_hash
+
+    # Uploads every file under root (hidden files and directories skipped) as
+    # <prefix>/<path relative to root>; prefix defaults to root's own name and
+    # "" uploads the tree's contents to the top level. Files the server
+    # already has with the same content are skipped: local files are hashed,
+    # hash_workers at a time, only where the server has a file of the same
+    # size. The rest are uploaded by workers threads at once, each on its own
+    # pooled connection (so at most the pool size run in parallel). Returns
+    # name -> "uploaded", "unchanged" or the exception the file failed with;
+    # progress gets (bytes sent, bytes to send) across all files.
+    def upload_tree(self, root, prefix=None, workers=POOL_SIZE, hash_workers=HASH_WORKERS, progress=None):
+        if not os.path.isdir(root):
+            raise NotADirectoryError(root)
+        root = os.path.abspath(root)
+        prefix = (os.path.basename(root) if prefix is None else prefix).strip('/')
+        started = time.time()
+        results = {}
+        files = {}  # name -> (local path, size)
+        for directory, subdirs, filenames in os.walk(root):
+            subdirs[:] = sorted(d for d in subdirs if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(directory, filename)
+                name = f"{prefix}/{name_for(root, path)}" if prefix else name_for(root, path)
+                try:
+                    split_name(name)
+                    files[name] = (path, os.path.getsize(path))
+                except (OSError, ValueError) as e:
+                    results[name] = e
+
+        # Only files whose size matches the server's copy can be unchanged
+        remote = {entry.name: entry for entry in self.list(f"{prefix}/" if prefix else None)}
+        candidates = [name for name, (_, size) in files.items() if name in remote and remote[name].size == size]
+        remote_hashes = {name: remote[name].sha256 for name in candidates}
+        unknown = [name for name in candidates if remote_hashes[name] is None]
+        for name, stat in self.stat(unknown).items():
+            remote_hashes[name] = stat[2] if stat else None
+        with ThreadPoolExecutor(max(1, hash_workers)) as pool:
+            local_hashes = pool.map(lambda name: _hash_or_none(files[name][0]), candidates)
+            for name, digest in zip(candidates, local_hashes):
+                if digest is not None and digest == remote_hashes[name]:
+                    results[name] = "unchanged"
+
+        pending = [name for name in files if name not in results]
+        total = sum(files[name][1] for name in pending)
+        lock = threading.Lock()
+        sent = 0
+        credited = {}  # name -> bytes of it counted in sent
+
+        def report(name, done):
+            nonlocal sent
+            with lock:
+                sent += done - credited.get(name, 0)
+                credited[name] = done
+                progress(sent, total)
+
+        def upload_one(name):
+            path, size = files[name]
+            # A delta upload reports progress through the delta, so progress
+            # is counted as the completed fraction of the file's size
+            on_progress = (lambda done, of: report(name, size * done // of if of else size)) if progress else None
+            try:
+                self.upload(path, name, on_progress)
+            except Exception as e:
+                log(f"Upload of '{name}' from {root} failed: {e}")
+                return e
+            if progress:
+                report(name, size)
+            return "uploaded"
+
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            for name, result in zip(pending, pool.map(upload_one, pending)):
+                results[name] = result
+        if progress and not pending:
+            progress(0, 0)
+
+        uploaded = sum(1 for result in results.values() if result == "uploaded")
+        unchanged = sum(1 for result in results.values() if result == "unchanged")
+        log(f"Uploaded tree {root} as '{prefix or '/'}': {uploaded} uploaded, {unchanged} unchanged, "
+            f"{len(results) - uploaded - unchanged} failed", command="UPLOADDIR", files=len(results),
+            bytes=total, duration=round(time.time() - started, 3))
+        return {name: results[name] for name in sorted(results)}
+
+    # --- downloads ---
+
+    # Downloads a file, or one version of it (saved as <name>_v<version><ext>),
+    # into dest_dir and returns the local path once its hash is verified.
+    def download(self, filename, version=None, dest_dir=None, progress=None):
+        local_name = filename if version is None else versioned_name(filename, version)
+        path = local_path(dest_dir or self.download_dir, local_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return self._run(self._download, filename, version, local_name, path, progress)
+
+    def _download(self, conn, filename, version, local_name, path, progress):
+        resume_from = self._resume_offset(local_name, path)
+        tree = self._merkle(conn, filename, version)
+        bad = []
+        if tree is not None and 0 < resume_from <= tree.size:
+            # Check what is already there before building on it
+            bad = tree.check(lambda: open(path, 'rb', buffering=0), resume_from)
+            if bad:
+                self._note(f"{len(bad)} chunk(s) of the partial {local_name} are corrupt, fetching them again")
+
+        conn.send_line(f"DOWNLOAD {filename}" + (f" version={version}" if version is not None else ""))
+        size_data = recv_reply(conn)
+        if size_data == "ERROR":
+            log(f"Download failed: File '{filename}' not found on server.")
+            raise NotFoundError(f"{filename} not found on server")
+        total_size, *codec = size_data.split()
+        total_size = int(total_size)
+        if resume_from > total_size:
+            resume_from = 0  # The file got smaller on the server, so the partial copy is useless
+        if tree is not None and tree.size != total_size:
+            tree, bad = None, []  # Replaced in between; the whole-file hash decides then
+        conn.send_line(f"RESUME {resume_from}" if resume_from > 0 else "READY")
+        verifier = ChunkVerifier.resume(tree, path, resume_from) if tree is not None else None
+        self._receive(conn, local_name, path, total_size, resume_from, *codec, progress=progress, verifier=verifier)
+        if verifier is not None:
+            bad = sorted(set(bad + verifier.bad))
+            if bad:
+                self._refetch(conn, filename, version, path, tree, bad)
+                local_hash = sha256_file(path)  # The hash taken while receiving predates the refetched chunks
+            else:
+                local_hash = verifier.file_hasher.hexdigest()
+            self.checkpoints.delete(self.owner, local_name)
+            if local_hash != tree.sha256:
+                log(f"Hash mismatch for '{local_name}': local {local_hash}, server {tree.sha256}")
+                raise FileShareError(f"hash mismatch after downloading {filename}")
+        return path
+
+    # Merkle tree of a file on the server (see utils/merkle.py), None if it
+    # does not exist or the server does not build trees
+    def merkle(self, filename, version=None):
+        return self._run(self._merkle, filename, version)
+
+    def _merkle(self, conn, filename, version=None):
+        conn.send_line(f"MERKLE {filename}" + (f" version={version}" if version is not None else ""))
+        reply = recv_reply(conn)
+        if not reply.startswith("MERKLE "):
+            return None
+        _, size, sha256, chunk_size, root = reply.split()
+        tree = MerkleTree(int(size), int(chunk_size), [bytes.fromhex(leaf) for leaf in conn.recv_lines()], sha256)
+        if tree.root() != root:
+            raise ProtocolError(f"Merkle tree of {filename} does not match its root")
+        return tree
+
+    # Fetches the chunks of path listed in bad again with RANGE, a request
+    # per run of adjacent chunks, and verifies them
+    def _refetch(self, conn, filename, version, path, tree, bad):
+        started = time.time()
+        runs = []
+        for index in bad:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        fetched = 0
+        buf = bytearray(BUFFER_SIZE)
+        view = memoryview(buf)
+        with open(path, 'r+b', buffering=0) as f:
+            for first, last in runs:
+                start, end = tree.chunk_range(first)[0], tree.chunk_range(last)[1]
+                conn.send_line(f"RANGE {filename} {start} {end - start}"
+                               + (f" version={version}" if version is not None else ""))
+                reply = recv_reply(conn)
+                if reply == "ERROR" or int(reply) != end - start:
+                    raise FileShareError(f"server refused bytes {start}-{end} of {filename}")
+                verifier = ChunkVerifier(tree, start)
+                pos = start
+                while pos < end:
+                    n = conn.recv_into(view[:min(len(buf), end - pos)])
+                    if not n:
+                        raise ConnectionResetError("connection closed during range transfer")
+                    write_at(f, view[:n], pos)
+                    verifier.update(view[:n])
+                    pos += n
+                if verifier.bad:
+                    log(f"Chunks {verifier.bad} of '{filename}' still fail verification after fetching them again")
+                    raise FileShareError(f"hash mismatch after downloading {filename}")
+                fetched += end - start
+        log(f"Fetched {len(bad)} corrupt chunk(s) of '{filename}' again", command="REFETCH", file=filename,
+            bytes=fetched, duration=round(time.time() - started, 3))
+
+    # Downloads several files, sending every request up front instead of one
+    # round trip each. Returns name -> local path, or the exception for files
+    # that could not be downloaded.
+    def download_many(self, filenames, dest_dir=None, progress=None):
+        dest_dir = dest_dir or self.download_dir
+        results = {}  # Survives retries, so finished files are not fetched again
+        paths = {}
+        for name in filenames:
+            try:
+                paths[name] = local_path(dest_dir, name)
+                os.makedirs(os.path.dirname(paths[name]), exist_ok=True)
+            except (OSError, ValueError) as e:
+                results[name] = e
+        self._run(self._download_many, list(paths), paths, progress, results)
+        return results
+
+    def _download_many(self, conn, filenames, paths, progress, results):
+        pending = [name for name in filenames if name not in results]
+        offsets = [self._resume_offset(name, paths[name]) for name in pending]
+        conn.send_lines([f"DOWNLOAD {name} {offset}" for name, offset in zip(pending, offsets)])
+        for filename, resume_from in zip(pending, offsets):
+            size_data = recv_reply(conn)
+            if size_data == "ERROR":
+                log(f"Download failed: File '{filename}' not found on server.")
+                results[filename] = NotFoundError(f"{filename} not found on server")
+                continue
+            total_size, *codec = size_data.split()
+            try:
+                results[filename] = self._receive(conn, filename, paths[filename], int(total_size), resume_from,
+                                                  *codec, progress=progress)
+            except FileShareError as e:
+                results[filename] = e
+        return results
+
+    # Downloads every file named or matched by a glob in patterns as one tar
+    # stream, extracting and verifying each file as it arrives. Returns
+    # name -> local path, or the exception for files that failed; names
+    # without glob characters the server does not have map to NotFoundError.
+    # progress gets (bytes extracted, total bytes of all files).
+    def download_batch(self, patterns, dest_dir=None, compress=True, progress=None):
+        dest_dir = dest_dir or self.download_dir
+        os.makedirs(dest_dir, exist_ok=True)
+        patterns = list(patterns)
+        results = self._run(self._download_batch, patterns, dest_dir, compress, progress)
+        for pattern in patterns:
+            if pattern not in results and not any(c in pattern for c in GLOB_CHARS):
+                results[pattern] = NotFoundError(f"{pattern} not found on server")
+        return results
+
+    def _download_batch(self, conn, patterns, dest_dir, compress, progress):
+        started = time.time()
+        conn.send_line("BATCH " + ' '.join((["compress=1"] if compress and conn.codec else []) + patterns))
+        reply = recv_reply(conn)
+        if not reply.startswith("BATCH "):
+            raise FileShareError("server refused the batch (too many files?)")
+        _, count, total, codec = reply.split()
+        total = int(total)
+        stream = BlockReader(conn, None if codec == "none" else Decompressor(codec))
+        results = {}
+        done = 0
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                name = member.name
+                # Only files with names the server could have stored are written,
+                # nothing that would land outside dest_dir
+                try:
+                    if not member.isfile():
+                        raise ValueError(name)
+                    path = local_path(dest_dir, name)
+                except ValueError:
+                    results[name] = FileShareError(f"unexpected archive member {name!r}")
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.part"
+                hasher = hashlib.sha256()
+                source = tar.extractfile(member)
+                with open(temp_path, 'wb') as f:
+                    while chunk := source.read(BUFFER_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        done += len(chunk)
+                        if progress:
+                            progress(done, total)
+                if hasher.hexdigest() != member.pax_headers.get(SHA256_KEY):
+                    os.remove(temp_path)
+                    log(f"Hash mismatch for '{name}' in batch download")
+                    results[name] = FileShareError(f"hash mismatch after downloading {name}")
+                    continue
+                os.replace(temp_path, path)
+                os.utime(path, (member.mtime, member.mtime))
+                results[name] = path
+        stream.drain()
+        if progress:
+            progress(total, total)
+        log(f"Downloaded {len(results)} of {count} files as a batch", command="BATCH", files=len(results),
+            bytes=done, duration=round(time.time() - started, 3), codec=None if codec == "none" else codec)
+        return results
+
+    # Byte offset an earlier, interrupted download to path can continue from
+    def _resume_offset(self, key, path):
+        saved = self.checkpoints.get(self.owner, key) or {}
+        if "bytes_received" not in saved or not os.path.exists(path):
+            return 0
+        resume_from = saved["bytes_received"]
+        actual_size = os.path.getsize(path)
+        if actual_size != resume_from:
+            log(f"Partial file size ({actual_size}) of {key} doesn't match checkpoint ({resume_from}). Adjusting.")
+            resume_from = actual_size
+        self._note(f"Resuming download of {key} from byte {resume_from}")
+        return resume_from
+
+    # Receives the body (compressed if codec is given) and hash of a requested
+    # download into path, checkpointing progress under key. With a verifier
+    # (utils.merkle.ChunkVerifier) the data is checked chunk by chunk as well,
+    # and the caller deals with the chunks in verifier.bad, compares the
+    # whole-file hash left in verifier.file_hasher and deletes the checkpoint.
+    def _receive(self, conn, key, path, total_size, resume_from, codec=None, progress=None, verifier=None):
+        start_time = time.time()
+        hasher = hashlib.sha256()
+        if resume_from > 0:
+            # Hash what is already on disk so the rest can be hashed as it arrives
+            hash_prefix(path, hasher, resume_from)
+        if verifier is not None:
+            verifier.file_hasher = hasher
+        next_checkpoint = (resume_from // CHECKPOINT_STEP + 1) * CHECKPOINT_STEP
+
+        with open(path, 'ab' if resume_from > 0 else 'wb') as f:
+            def on_progress(received):
+                nonlocal next_checkpoint
+                bytes_received = resume_from + received
+                if progress:
+                    progress(bytes_received, total_size)
+                if bytes_received >= next_checkpoint:
+                    f.flush()
+                    self.checkpoints.put(self.owner, key, {
+                        "bytes_received": bytes_received,
+                        "timestamp": datetime.now().isoformat()
+                    })
+                    next_checkpoint = (bytes_received // CHECKPOINT_STEP + 1) * CHECKPOINT_STEP
+
+            writer = HashingWriter(f, verifier or hasher)
+            if codec:
+                received = recv_compressed_to_file(conn, writer, Decompressor(codec), total_size - resume_from,
+                                                   on_progress)
+            else:
+                received = recv_to_file(conn, writer, total_size - resume_from, on_progress)
+        if received < total_size - resume_from:
+            raise ConnectionResetError(f"connection closed during download of {key}")
+        if progress and total_size == resume_from:
+            progress(total_size, total_size)
+
+        server_hash = recv_reply(conn)
+        if verifier is not None:
+            # The data came from the version the tree was built from only if these match
+            if server_hash != verifier.tree.sha256:
+                self.checkpoints.delete(self.owner, key)
+                log(f"'{key}' changed on the server during the download")
+                raise FileShareError(f"{key} changed on the server during the download")
+            log(f"Downloaded '{key}' ({total_size} bytes), {len(verifier.bad)} chunk(s) failed verification.",
+                command="DOWNLOAD", file=key, bytes=total_size - resume_from,
+                duration=round(time.time() - start_time, 3), codec=codec)
+            return path
+        local_hash = writer.hexdigest()
+        # Either way the checkpoint is done with: a mismatch has to start over
+        self.checkpoints.delete(self.owner, key)
+        if local_hash != server_hash:
+            log(f"Hash mismatch for '{key}': local {local_hash}, server {server_hash}")
+            raise FileShareError(f"hash mismatch after downloading {key}")
+        log(f"Downloaded '{key}' ({total_size} bytes) with matching hash.", command="DOWNLOAD",
+            file=key, bytes=total_size - resume_from, duration=round(time.time() - start_time, 3), codec=codec)
+        return path
+
+    # Downloads one file over several pooled connections at once; see ParallelDownload
+    def parallel_download(self, filename, connections=PARALLEL_CONNECTIONS, dest_dir=None, progress=None):
+        download = ParallelDownload(self, filename, connections, dest_dir or self.download_dir)
+        os.makedirs(os.path.dirname(download.path), exist_ok=True)
+        return download.run(progress)
+
+
+class ParallelDownload:
+    """Downloads one file over several connections, each filling its own byte range.
+
+    Every range is written in place into a preallocated file and its progress
+    is checkpointed, so an interrupted download only re-fetches missing bytes.
+    The finished file is verified against its Merkle tree, hashing chunks in
+    parallel, and chunks that fail are fetched again before the whole-file
+    hash is checked.
+    """
+
+    def __init__(self, client, filename, connections=PARALLEL_CONNECTIONS, dest_dir=DOWNLOAD_DIR):
+        self.client = client
+        self.filename = filename
+        self.connections = max(1, connections)
+        self.path = local_path(dest_dir, filename)
+        self.lock = threading.Lock()
+        self.state = None  # Checkpointed plan: size, hash and per-range progress
+        self.received = 0
+        self.errors = []
+
+    # Splits [0, size) into contiguous ranges, reusing saved progress when the file is unchanged
+    def plan(self, size, file_hash):
+        saved = self.client.checkpoints.get(self.client.owner, self.filename) or {}
+        if saved.get("sha256") == file_hash and saved.get("size") == size and os.path.exists(self.path):
+            self.client._note(f"Resuming parallel download of {self.filename}")
+            return saved["ranges"]
+        count = max(1, min(self.connections, -(-size // MIN_RANGE_SIZE)))
+        step = -(-size // count) if size else 0
+        return [{"start": i * step, "end": min(size, (i + 1) * step), "done": 0} for i in range(count)]
+
+    # Progress updates are coalesced by the store; force writes them out now
+    def save(self, force=False):
+        with self.lock:
+            self.client.checkpoints.put(self.client.owner, self.filename, self.state)
+        if force:
+            self.client.checkpoints.flush()
+
+    # Fetches the missing part of one range; a retry picks up where it stopped
+    def fetch(self, conn, rng):
+        pos = rng["start"] + rng["done"]
+        remaining = rng["end"] - pos
+        if remaining <= 0:
+            return
+        conn.send_line(f"RANGE {self.filename} {pos} {remaining}")
+        reply = recv_reply(conn)
+        if reply == "ERROR":
+            raise FileShareError(f"server refused range {pos}-{rng['end']}")
+        count = int(reply)
+        buf = bytearray(min(BUFFER_SIZE, count) or 1)
+        view = memoryview(buf)
+        with open(self.path, 'r+b', buffering=0) as f:
+            while count > 0:
+                n = conn.recv_into(view[:min(len(buf), count)])
+                if not n:
+                    raise ConnectionResetError("connection closed during range transfer")
+                write_at(f, view[:n], pos)
+                pos += n
+                count -= n
+                with self.lock:
+                    rng["done"] = pos - rng["start"]
+                    self.received += n
+                self.save()
+
+    def _worker(self, rng):
+        try:
+            self.client._run(self.fetch, rng)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+    # Returns the local path once the whole file is verified
+    def run(self, progress=None):
+        stat = self.client.stat([self.filename])[self.filename]
+        if stat is None:
+            log(f"Parallel download failed: File '{self.filename}' not found on server.")
+            raise NotFoundError(f"{self.filename} not found on server")
+        size, _, file_hash = stat
+        tree = self.client.merkle(self.filename)
+        if tree is not None and tree.sha256 != file_hash:
+            tree = None  # Replaced in between; the whole-file hash decides then
+
+        ranges = self.plan(size, file_hash)
+        preallocate(self.path, size)
+        self.state = {"size": size, "sha256": file_hash, "ranges": ranges,
+                      "timestamp": datetime.now().isoformat()}
+        self.save(force=True)
+        self.received = sum(r["done"] for r in ranges)
+
+        threads = [threading.Thread(target=self._worker, args=(r,), daemon=True) for r in ranges]
+        for t in threads:
+            t.start()
+        while True:
+            running = any(t.is_alive() for t in threads)
+            if progress:
+                progress(self.received, size)
+            if not running:
+                break
+            time.sleep(0.2)
+        self.save(force=True)
+
+        if self.errors:
+            log(f"Parallel download of '{self.filename}' interrupted: {self.errors[0]}")
+            raise self.errors[0]
+
+        if tree is not None:
+            # Only fetches corrupt chunks again; the whole-file hash below still decides
+            bad = tree.check(lambda: open(self.path, 'rb', buffering=0))
+            if bad:
+                self.client._note(f"{len(bad)} chunk(s) of {self.filename} are corrupt, fetching them again")
+                self.client._run(self.client._refetch, self.filename, None, self.path, tree, bad)
+        local_hash = sha256_file(self.path)
+        self.client.checkpoints.delete(self.client.owner, self.filename)
+        if local_hash != file_hash:
+            log(f"Hash mismatch for '{self.filename}': local {local_hash}, server {file_hash}")
+            raise FileShareError(f"hash mismatch after downloading {self.filename}")
+        log(f"Downloaded '{self.filename}' ({size} bytes) over {len(ranges)} connections with matching hash.")
+        return self.path
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+HASH_CHUNK_SIZE = 1024 * 1024  # Read size when a digest has to be computed from disk
+
+
+# Computes the SHA-256 of a file on disk
+def sha256_file(path, chunk_size=HASH_CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(buf):
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+# Identity of the file currently at path; any change to it invalidates a digest
+def file_signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class HashIndex:
+    """Persistent SHA-256 digests keyed by path, size, mtime and inode.
+
+    A digest is only returned while the file still has the size, mtime and
+    inode it had when the digest was stored, so rewrites are detected
+    without re-reading the file.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+
+    # Stored digest for path if the file is unchanged since it was recorded
+    def lookup(self, path):
+        path = os.path.normpath(path)
+        try:
+            signature = file_signature(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return None
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, inode, sha256 FROM file_hashes WHERE path=?',
+                (path,)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[:3]) != signature:
+            self.invalidate(path)
+            return None
+        return row[3]
+
+    # Digest for path, hashing the file only when the index has no valid entry
+    def digest(self, path):
+        cached = self.lookup(path)
+        if cached is not None:
+            return cached
+        path = os.path.normpath(path)
+        before = file_signature(path)
+        digest = sha256_file(path)
+        # Only keep the result if the file did not change while it was hashed
+        if file_signature(path) == before:
+            self._store(path, before, digest)
+        return digest
+
+    # Records a digest computed elsewhere (e.g. while the file was received)
+    def record(self, path, digest):
+        path = os.path.normpath(path)
+        self._store(path, file_signature(path), digest)
+
+    # Follows a rename so the moved file keeps its digest
+    def move(self, old_path, new_path):
+        with self.lock:
+            self.db.execute('DELETE FROM file_hashes WHERE path=?', (os.path.normpath(new_path),))
+            self.db.execute('UPDATE file_hashes SET path=? WHERE path=?',
+                            (os.path.normpath(new_path), os.path.normpath(old_path)))
+            self.db.commit()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM file_hashes WHERE path=?', (os.path.normpath(path),))
+            self.db.commit()
+
+    def _store(self, path, signature, digest):
+        size, mtime_ns, inode = signature
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, inode, sha256, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, inode, digest, time.time()))
+            self.db.commit()
@@ -0,0 +1,62 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only hold within one process
+    fcntl = None
+
+# Locks that also work between the processes of a multi-worker server. They
+# are flock()s on files, so they are released by the kernel when a process
+# dies, and a crashed worker never leaves one held.
+
+NO_FILE = -1  # Handle try_lock() returns where there is no flock()
+
+
+class ProcessLock:
+    """Mutual exclusion across threads and, where flock() exists, processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            except BaseException:
+                self.lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+# Takes an exclusive lock on path without waiting. Returns a handle for
+# unlock(), or None if someone else (another process, or another open of the
+# file in this one) holds it.
+def try_lock(path):
+    if fcntl is None:
+        return NO_FILE
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def unlock(fd):
+    if fd != NO_FILE:
+        os.close(fd)  # Closing the descriptor drops its flock
@@ -0,0 +1,135 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+# Background logging. log() only timestamps the record and puts it on a
+# queue, so a transfer thread (or the event loop) never waits for the disk.
+# A writer thread drains the queue in batches, writes each batch with one
+# write() call and rotates the file by size and age. Records carry optional
+# fields (command, bytes, duration, peer, ...) and are written either as text
+# lines or as JSON lines. Whatever is queued at exit is still written.
+
+MAX_BYTES = 10 * 1024 * 1024  # Rotate once the file grows past this
+ROTATE_INTERVAL = 24 * 3600  # ...or once it is this many seconds old
+BACKUP_COUNT = 5  # Rotated files kept as <path>.1 ... <path>.N
+BATCH_SIZE = 512  # Most records written per write() call
+FLUSH_INTERVAL = 0.5  # Seconds the writer waits for more records before flushing
+
+_STOP = object()
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+class BackgroundLogger:
+    def __init__(self, path, fmt='text', max_bytes=MAX_BYTES, rotate_interval=ROTATE_INTERVAL,
+                 backup_count=BACKUP_COUNT):
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.queue = queue.SimpleQueue()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = None
+        self.opened = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=f"logger:{path}", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Queues one record; never blocks on I/O
+    def log(self, message, **fields):
+        self.queue.put((time.time(), message, fields))
+
+    # Writes everything queued so far and stops the writer thread
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def format(self, record):
+        ts, message, fields = record
+        fields = {k: v for k, v in fields.items() if v is not None}
+        stamp = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        if self.fmt == 'json':
+            return json.dumps({"ts": stamp, "msg": message, **fields}, default=str) + "\n"
+        extra = ''.join(f" {k}={v}" for k, v in fields.items())
+        return f"[{stamp}] {message}{extra}\n"
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [r for r in batch if r is not _STOP]
+                # Anything logged after close() was requested still goes out
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch:
+                self._write(''.join(self.format(r) for r in batch if r is not _STOP))
+        if self.file:
+            self.file.close()
+
+    def _write(self, text):
+        try:
+            if self.file is None:
+                self._open()
+            elif self.file.tell() >= self.max_bytes or time.time() - self.opened >= self.rotate_interval:
+                self._rotate()
+            self.file.write(text)
+            self.file.flush()
+        except (OSError, ValueError):
+            # Logging must not take the process down (e.g. disk full); reopen on the next batch
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+            self.file = None
+
+    def _open(self):
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.opened = time.time()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.opened = time.time()
+
+
+# The logger for path, created on first use so every module logging to the
+# same file shares one writer thread
+def get_logger(path, **options):
+    with _loggers_lock:
+        logger = _loggers.get(path)
+        if logger is None:
+            logger = _loggers[path] = BackgroundLogger(path, **options)
+        return logger
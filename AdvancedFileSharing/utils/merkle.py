@@ -0,0 +1,205 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.integrity import file_signature
+
+# Merkle trees over fixed-size chunks of a file. The leaves are the SHA-256
+# digests of the chunks, in order; each level above hashes pairs of nodes
+# together (an odd one out moves up unchanged) up to a single root. The server
+# builds a file's tree once and caches it (MerkleIndex). A client fetches all
+# the leaves with MERKLE, checks them against the root, and can then verify
+# every chunk on its own: as it arrives, in parallel across cores, or in a
+# partial file before resuming. Only chunks that fail are fetched again.
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Bytes of file per leaf
+READ_SIZE = 1024 * 1024  # Read size while hashing a chunk
+HASH_WORKERS = min(8, os.cpu_count() or 1)  # Threads hashing chunks at once (hashlib releases the GIL)
+
+
+# Root of the tree over leaves, as hex; nodes are prefixed so a node can never pass for a leaf
+def merkle_root(leaves):
+    level = list(leaves)
+    if not level:
+        return hashlib.sha256(b'').hexdigest()
+    while len(level) > 1:
+        parents = [hashlib.sha256(b'\x01' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0].hex()
+
+
+# SHA-256 digest of bytes start..end of a file; opener() returns a new
+# binary file object, so every thread reads through its own
+def hash_range(opener, start, end):
+    hasher = hashlib.sha256()
+    buf = bytearray(min(READ_SIZE, max(end - start, 1)))
+    view = memoryview(buf)
+    with opener() as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            n = f.readinto(view[:min(len(buf), remaining)])
+            if not n:
+                break
+            hasher.update(view[:n])
+            remaining -= n
+    return hasher.digest()
+
+
+# Digests of several (start, end) ranges of a file, hashed in parallel
+def hash_ranges(opener, ranges, workers=HASH_WORKERS):
+    if len(ranges) <= 1 or workers <= 1:
+        return [hash_range(opener, start, end) for start, end in ranges]
+    with ThreadPoolExecutor(min(workers, len(ranges)), thread_name_prefix="merkle") as pool:
+        return list(pool.map(lambda r: hash_range(opener, *r), ranges))
+
+
+class MerkleTree:
+    """Leaf digests of a file of size bytes in chunk_size chunks, and its SHA-256."""
+
+    def __init__(self, size, chunk_size, leaves, sha256=None):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.leaves = leaves  # Raw 32-byte digests, one per chunk
+        self.sha256 = sha256  # Whole-file digest, ties the tree to one version of the file
+
+    @classmethod
+    def build(cls, opener, size, chunk_size=CHUNK_SIZE, sha256=None, workers=HASH_WORKERS):
+        ranges = [(start, min(size, start + chunk_size)) for start in range(0, size, chunk_size)]
+        return cls(size, chunk_size, hash_ranges(opener, ranges, workers), sha256)
+
+    def root(self):
+        return merkle_root(self.leaves)
+
+    def chunk_range(self, index):
+        start = index * self.chunk_size
+        return start, min(self.size, start + self.chunk_size)
+
+    # Indices of the chunks that lie wholly within the first upto bytes and
+    # do not match their leaves in the file opener() reads
+    def check(self, opener, upto=None, workers=HASH_WORKERS):
+        upto = self.size if upto is None else min(upto, self.size)
+        count = len(self.leaves) if upto == self.size else upto // self.chunk_size
+        digests = hash_ranges(opener, [self.chunk_range(i) for i in range(count)], workers)
+        return [i for i, digest in enumerate(digests) if digest != self.leaves[i]]
+
+
+class ChunkVerifier:
+    """Hashes a file's data as it streams in from offset start, chunk by chunk.
+
+    It goes where a hashlib object would (e.g. utils.transfer.HashingWriter)
+    and collects the indices of chunks whose digest is not their leaf's in
+    bad. A start inside a chunk needs that chunk's earlier bytes fed to
+    update() first (see resume()). The leaves come from the server, so a
+    caller that wants the file checked against something it hashed itself
+    sets file_hasher, which is fed everything passed to update() from then on.
+    """
+
+    def __init__(self, tree, start=0):
+        self.tree = tree
+        self.index = start // tree.chunk_size
+        self.filled = 0  # Bytes of the current chunk hashed so far
+        self.hasher = hashlib.sha256()
+        self.file_hasher = None  # Optional hashlib object also fed the data
+        self.bad = []
+
+    # A verifier continuing at offset start of the partial file at path
+    @classmethod
+    def resume(cls, tree, path, start):
+        verifier = cls(tree, start)
+        chunk_start = verifier.index * tree.chunk_size
+        if start > chunk_start:
+            with open(path, 'rb') as f:
+                f.seek(chunk_start)
+                verifier.update(f.read(start - chunk_start))
+        return verifier
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        if self.file_hasher is not None:
+            self.file_hasher.update(view)
+        while view:
+            start, end = self.tree.chunk_range(self.index)
+            if start >= end:
+                raise ValueError("more data than the Merkle tree covers")
+            n = min(len(view), end - start - self.filled)
+            self.hasher.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == end - start:
+                if self.hasher.digest() != self.tree.leaves[self.index]:
+                    self.bad.append(self.index)
+                self.index += 1
+                self.filled = 0
+                self.hasher = hashlib.sha256()
+
+
+class MerkleIndex:
+    """Cached trees of stored files, keyed like utils.integrity.HashIndex.
+
+    A tree is only returned while the file still has the size, mtime and
+    inode it had when the tree was built.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS merkle_trees (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                file_size INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                leaves BLOB NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+
+    # Tree of the file at path in chunk_size chunks. opener() opens its
+    # content and size is its length (a stored file may be a chunked
+    # manifest, see utils/chunkstore.py); digest() gives its SHA-256.
+    def tree(self, path, opener, size, digest, chunk_size=CHUNK_SIZE, workers=HASH_WORKERS):
+        path = os.path.normpath(path)
+        before = file_signature(path)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, inode, file_size, chunk_size, sha256, leaves FROM merkle_trees WHERE path=?',
+                (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == before and row[4] == chunk_size:
+            leaves = bytes(row[6])
+            return MerkleTree(row[3], chunk_size, [leaves[i:i + 32] for i in range(0, len(leaves), 32)], row[5])
+        tree = MerkleTree.build(opener, size, chunk_size, digest(), workers)
+        # Only keep it if the file did not change while it was hashed
+        if file_signature(path) == before:
+            with self.lock:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO merkle_trees '
+                    '(path, size, mtime_ns, inode, file_size, chunk_size, sha256, leaves, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, *before, size, chunk_size, tree.sha256, b''.join(tree.leaves), time.time()))
+                self.db.commit()
+        return tree
+
+    # Follows a rename so the moved file keeps its tree
+    def move(self, old_path, new_path):
+        with self.lock:
+            self.db.execute('DELETE FROM merkle_trees WHERE path=?', (os.path.normpath(new_path),))
+            self.db.execute('UPDATE merkle_trees SET path=? WHERE path=?',
+                            (os.path.normpath(new_path), os.path.normpath(old_path)))
+            self.db.commit()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM merkle_trees WHERE path=?', (os.path.normpath(path),))
+            self.db.commit()
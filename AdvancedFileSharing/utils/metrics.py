@@ -0,0 +1,222 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Server metrics: request counts, errors and latency histograms per command,
+# bytes in and out, throughput of transfers and connection counts. Command
+# handlers never touch these. The engine counts the bytes of every I/O
+# operation on the connection itself (see utils/engine.py), and serve() records
+# each command once when it has finished, so a transfer loop pays one integer
+# addition per operation and nothing is locked while data moves. They are
+# read out by the STATS command and, in Prometheus text format, by an
+# optional local HTTP endpoint. Each worker of a multi-process server keeps
+# its own and serves them on its own port.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)  # Seconds
+THROUGHPUT_BUCKETS = tuple(mb * 1e6 for mb in (0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500,
+                                               1000, 2500))  # Bytes per second
+MIN_TRANSFER = 64 * 1024  # Commands moving fewer bytes are too short to say anything about throughput
+PREFIX = "fileshare"  # Prefix of the Prometheus metric names
+
+
+class Histogram:
+    """Counts of observed values per bucket upper bound, plus their sum and maximum."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Approximate q-quantile: the bound of the bucket it falls in
+    def quantile(self, q):
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    # Prometheus sample lines for the histogram called name
+    def samples(self, name, labels=''):
+        sep = ',' if labels else ''
+        lines, seen = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum:.6f}' if labels else f'{name}_sum {self.sum:.6f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}' if labels else f'{name}_count {self.count}')
+        return lines
+
+
+class CommandStats:
+    def __init__(self):
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+
+class Metrics:
+    """Everything the server counts, shared by all connections."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # Command name -> CommandStats
+        self.throughput = Histogram(THROUGHPUT_BUCKETS)
+        self.connections = 0  # Open right now
+        self.connections_total = 0
+        self.connection_errors = 0  # Connections ended by an error rather than the client
+        self.rejections = {}  # Limit -> requests and connections answered BUSY because of it
+        self.reaps = {}  # Reason -> connections the server closed (idle, slow, evicted)
+        self.gauges = {}  # Name -> function returning its current value
+        self.sources = []  # Other reporters, with summary() lines and prometheus(prefix) samples
+        self.worker = None  # Which process of a multi-worker server these are the metrics of
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self, error=False):
+        with self.lock:
+            self.connections -= 1
+            self.connection_errors += error
+
+    # Reports fn() as the current value of name
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    # Adds source's own lines (e.g. utils.qos.QoS) to STATS and /metrics
+    def add_source(self, source):
+        self.sources.append(source)
+
+    # A connection or request answered BUSY because of limit
+    def rejected(self, limit):
+        with self.lock:
+            self.rejections[limit] = self.rejections.get(limit, 0) + 1
+
+    # A connection the server closed itself
+    def reaped(self, reason):
+        with self.lock:
+            self.reaps[reason] = self.reaps.get(reason, 0) + 1
+
+    # One finished command: how long it took, the bytes its connection
+    # received and sent meanwhile, and whether it failed
+    def record(self, command, seconds, bytes_in, bytes_out, failed=False):
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.latency.observe(seconds)
+            stats.errors += failed
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            moved = max(bytes_in, bytes_out)
+            if moved >= MIN_TRANSFER and seconds > 0:
+                self.throughput.observe(moved / seconds)
+
+    # STATS reply: a "server" line with the totals (and, in a multi-worker
+    # server, which worker answered), an "admission" line, a
+    # "throughput" line, a line per command and then the sources' lines, each
+    # "<name> key=value ...". Times are in milliseconds, throughput in MB/s.
+    def summary(self):
+        gauges = {name: fn() for name, fn in sorted(self.gauges.items())}
+        with self.lock:
+            commands = sorted(self.commands.items())
+            lines = [
+                f"server uptime={time.time() - self.started:.0f} connections={self.connections} "
+                f"connections_total={self.connections_total} connection_errors={self.connection_errors} "
+                f"requests={sum(s.latency.count for _, s in commands)} errors={sum(s.errors for _, s in commands)} "
+                f"bytes_in={sum(s.bytes_in for _, s in commands)} bytes_out={sum(s.bytes_out for _, s in commands)}"
+                + (f" worker={self.worker} pid={os.getpid()}" if self.worker is not None else ""),
+                ' '.join(["admission"] + [f"{name}={value}" for name, value in gauges.items()]
+                         + [f"busy_{limit}={count}" for limit, count in sorted(self.rejections.items())]
+                         + [f"reaped_{reason}={count}" for reason, count in sorted(self.reaps.items())]),
+                f"throughput count={self.throughput.count} mean={self.throughput.mean() / 1e6:.2f} "
+                f"p50={self.throughput.quantile(0.5) / 1e6:.2f} p95={self.throughput.quantile(0.95) / 1e6:.2f} "
+                f"max={self.throughput.max / 1e6:.2f}",
+            ]
+            for name, s in commands:
+                h = s.latency
+                lines.append(f"{name} count={h.count} errors={s.errors} bytes_in={s.bytes_in} "
+                             f"bytes_out={s.bytes_out} mean={h.mean() * 1000:.3f} "
+                             f"p50={h.quantile(0.5) * 1000:.3f} p95={h.quantile(0.95) * 1000:.3f} "
+                             f"p99={h.quantile(0.99) * 1000:.3f} max={h.max * 1000:.3f}")
+        for source in self.sources:
+            lines += source.summary()
+        return lines
+
+    # Prometheus text exposition format
+    def prometheus(self):
+        p = PREFIX
+        gauges = {name: fn() for name, fn in sorted(self.gauges.items())}
+        with self.lock:
+            lines = [
+                f"# TYPE {p}_uptime_seconds gauge", f"{p}_uptime_seconds {time.time() - self.started:.3f}",
+                f"# TYPE {p}_connections gauge", f"{p}_connections {self.connections}",
+                f"# TYPE {p}_connections_total counter", f"{p}_connections_total {self.connections_total}",
+                f"# TYPE {p}_connection_errors_total counter", f"{p}_connection_errors_total {self.connection_errors}",
+            ]
+            for name, value in gauges.items():
+                lines += [f"# TYPE {p}_{name} gauge", f"{p}_{name} {value}"]
+            lines.append(f"# TYPE {p}_busy_total counter")
+            lines += [f'{p}_busy_total{{limit="{limit}"}} {count}' for limit, count in sorted(self.rejections.items())]
+            lines.append(f"# TYPE {p}_reaped_connections_total counter")
+            lines += [f'{p}_reaped_connections_total{{reason="{reason}"}} {count}'
+                      for reason, count in sorted(self.reaps.items())]
+            lines.append(f"# TYPE {p}_requests_total counter")
+            commands = sorted(self.commands.items())
+            lines += [f'{p}_requests_total{{command="{name}"}} {s.latency.count}' for name, s in commands]
+            lines.append(f"# TYPE {p}_request_errors_total counter")
+            lines += [f'{p}_request_errors_total{{command="{name}"}} {s.errors}' for name, s in commands]
+            lines.append(f"# TYPE {p}_received_bytes_total counter")
+            lines += [f'{p}_received_bytes_total{{command="{name}"}} {s.bytes_in}' for name, s in commands]
+            lines.append(f"# TYPE {p}_sent_bytes_total counter")
+            lines += [f'{p}_sent_bytes_total{{command="{name}"}} {s.bytes_out}' for name, s in commands]
+            lines.append(f"# TYPE {p}_request_duration_seconds histogram")
+            for name, s in commands:
+                lines += s.latency.samples(f"{p}_request_duration_seconds", f'command="{name}"')
+            lines.append(f"# TYPE {p}_transfer_throughput_bytes_per_second histogram")
+            lines += self.throughput.samples(f"{p}_transfer_throughput_bytes_per_second")
+        for source in self.sources:
+            lines += source.prometheus(p)
+        return '\n'.join(lines) + '\n'
+
+
+# Serves metrics.prometheus() at /metrics over HTTP from a background thread
+def serve_http(metrics, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would drown the server log
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,36 @@
+import os
+
+# File names in commands are relative paths with '/' between directories
+# ("datasets/2024/part-0001.csv"), so a directory tree keeps its layout on the
+# server and in downloads. Every name is checked before it is turned into a
+# filesystem path on either side: no absolute paths or drive letters, no '.'
+# or '..' components, no hidden components (the server keeps its own state in
+# dot directories) and no whitespace, which separates command arguments.
+
+MAX_NAME = 1024  # Longest name accepted, in characters
+MAX_DEPTH = 32  # Most directory levels in a name
+
+
+# The '/'-separated components of name; ValueError if it is not acceptable
+def split_name(name):
+    if not name or len(name) > MAX_NAME:
+        raise ValueError(f"bad file name {name!r}")
+    if '\\' in name or any(c.isspace() or not c.isprintable() for c in name):
+        raise ValueError(f"file names cannot contain whitespace or backslashes: {name!r}")
+    parts = name.split('/')
+    if len(parts) > MAX_DEPTH:
+        raise ValueError(f"file name is nested too deeply: {name!r}")
+    for part in parts:
+        if not part or part.startswith('.') or os.path.splitdrive(part)[0]:
+            raise ValueError(f"bad file name {name!r}")
+    return parts
+
+
+# Where name lives under root
+def local_path(root, name):
+    return os.path.join(root, *split_name(name))
+
+
+# Name for the file at path, relative to root
+def name_for(root, path):
+    return os.path.relpath(path, root).replace(os.sep, '/')
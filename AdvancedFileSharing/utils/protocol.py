@@ -0,0 +1,453 @@
+import struct
+
+from utils.engine import RecvExact, RecvInto, RecvLine, Send, SendFile, Call, Sleep
+from utils.transfer import send_file
+from utils.compression import BLOCK_HEADER, MAX_BLOCK, CODECS
+
+# Protocol v1 is the original newline-terminated text protocol with raw file
+# bytes in between. A client that sends "HELLO 2" and gets "HELLO 2" back
+# switches the connection to v2, where everything is a length-prefixed frame:
+#
+#   [type: 1 byte][length: 8 bytes, big endian][payload]
+#
+# MESSAGE frames carry one UTF-8 command or reply (what is a line in v1) and
+# DATA frames carry file bytes. Because requests are self-delimiting the
+# client can pipeline them and read the replies back in order.
+
+PROTOCOL_VERSION = 2  # Highest version this code speaks
+FRAME_HEADER = struct.Struct('!BQ')
+FRAME_MESSAGE = 1
+FRAME_DATA = 2
+MAX_LINE = 64 * 1024  # Longest command/reply accepted, in bytes
+RECV_SIZE = 256 * 1024  # Bytes requested from the socket per buffer refill
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ServerBusy(ConnectionError):
+    """The server turned the connection or request away for now ("BUSY <seconds>")."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"server busy, retry after {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+# Raises ServerBusy if a reply is the server's BUSY answer; it can come in
+# place of any reply, and in place of HELLO when the server is full
+def check_busy(reply):
+    if reply.startswith("BUSY "):
+        try:
+            retry_after = float(reply.split()[1])
+        except (IndexError, ValueError):
+            raise ProtocolError(f"bad BUSY reply: {reply!r}") from None
+        raise ServerBusy(retry_after)
+
+
+class AccessDenied(Exception):
+    """The server refused a request because of who sent it ("DENIED <reason>").
+
+    reason is "login" if the connection has to log in first and "role" if
+    the user's role does not allow the request.
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"access denied: {reason}")
+        self.reason = reason
+
+
+def pack_message(text):
+    payload = text.encode()
+    return FRAME_HEADER.pack(FRAME_MESSAGE, len(payload)) + payload
+
+
+def pack_data_header(length):
+    return FRAME_HEADER.pack(FRAME_DATA, length)
+
+
+class Connection:
+    """Buffered socket wrapper used by the clients and the threaded server.
+
+    Bytes read past the end of a line stay in the buffer for the next call,
+    so pipelined commands and replies coalesced with file data are never lost.
+    sendall()/recv_into() carry file payload (DATA frames in v2), while
+    send_line()/recv_line() carry commands and replies.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.version = 1
+        self.buffer = bytearray()
+        self.data_remaining = 0  # Payload bytes left in the current v2 DATA frame
+        self.codec = None  # Compression codec agreed with COMPRESS, if any
+        self.bytes_in = 0  # Counted by the server engine (utils/engine.py)
+        self.bytes_out = 0
+
+    # --- raw buffered reads (no framing) ---
+
+    def _fill(self):
+        data = self.sock.recv(RECV_SIZE)
+        if data:
+            self.buffer += data
+        return len(data)
+
+    # Next newline-terminated line as bytes without the newline, None on disconnect
+    def read_raw_line(self):
+        start = 0
+        while True:
+            pos = self.buffer.find(b'\n', start)
+            if pos >= 0:
+                line = bytes(self.buffer[:pos])
+                del self.buffer[:pos + 1]
+                return line
+            if len(self.buffer) > MAX_LINE:
+                raise ProtocolError("line too long")
+            start = len(self.buffer)
+            if not self._fill():
+                return None
+
+    # Exactly n bytes, or fewer if the peer disconnects first
+    def read_exact(self, n):
+        while len(self.buffer) < n:
+            if not self._fill():
+                break
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    # Up to len(view) raw bytes, served from the buffer before the socket
+    def read_raw_into(self, view):
+        if self.buffer:
+            n = min(len(view), len(self.buffer))
+            view[:n] = self.buffer[:n]
+            del self.buffer[:n]
+            return n
+        return self.sock.recv_into(view)
+
+    def write_raw(self, data):
+        self.sock.sendall(data)
+
+    def send_raw_file(self, f, offset, count):
+        return send_file(self.sock, f, offset, count)
+
+    # --- protocol level ---
+
+    # Asks the server for protocol v2; stays on v1 if the server declines
+    def negotiate(self, version=PROTOCOL_VERSION):
+        if version < 2:
+            return self.version
+        self.write_raw(f"HELLO {version}\n".encode())
+        reply = self.read_raw_line()
+        if reply:
+            check_busy(reply.decode(errors='replace'))
+        if reply and reply.startswith(b"HELLO "):
+            self.version = int(reply.split()[1])
+        return self.version
+
+    # Offers our compression codecs; the server picks one or answers "none"
+    def negotiate_compression(self, codecs=None):
+        self.send_line("COMPRESS " + ' '.join(codecs or CODECS))
+        reply = self.recv_line()
+        if reply and reply.startswith("COMPRESS ") and reply.split()[1] in CODECS:
+            self.codec = reply.split()[1]
+        return self.codec
+
+    def send_line(self, text):
+        if self.version >= 2:
+            self.write_raw(pack_message(text))
+        else:
+            self.write_raw((text + '\n').encode())
+
+    # Sends several requests in one write so they travel without a round trip each
+    def send_lines(self, texts):
+        if self.version >= 2:
+            self.write_raw(b''.join(pack_message(t) for t in texts))
+        else:
+            self.write_raw(''.join(t + '\n' for t in texts).encode())
+
+    # Next reply as text, None on disconnect; ServerBusy if it is BUSY,
+    # AccessDenied if it is DENIED
+    def recv_line(self):
+        text = self._recv_text()
+        if text:
+            check_busy(text)
+            if text.startswith("DENIED"):
+                raise AccessDenied(text[7:] or "unknown")
+        return text
+
+    def _recv_text(self):
+        if self.version < 2:
+            line = self.read_raw_line()
+            return None if line is None else line.decode().strip()
+        header = self.read_exact(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        kind, length = FRAME_HEADER.unpack(header)
+        if kind != FRAME_MESSAGE or length > MAX_LINE:
+            raise ProtocolError(f"expected message frame, got type {kind}")
+        payload = self.read_exact(length)
+        if len(payload) < length:
+            return None
+        return payload.decode()
+
+    # A multi-line reply such as LIST (v1: lines up to a blank line,
+    # v2: messages of newline-separated lines up to an empty message)
+    def recv_lines(self):
+        lines = []
+        while True:
+            text = self.recv_line()
+            if text is None:
+                raise ConnectionResetError("connection closed during a multi-line reply")
+            if not text:
+                return lines
+            lines.extend(text.split('\n') if self.version >= 2 else [text])
+
+    # Sends file payload bytes
+    def sendall(self, data):
+        if self.version >= 2:
+            self.write_raw(pack_data_header(len(data)))
+        self.write_raw(data)
+
+    # Receives file payload bytes into view, returns the count (0 on disconnect)
+    def recv_into(self, view):
+        if self.version < 2:
+            return self.read_raw_into(view)
+        while self.data_remaining == 0:
+            header = self.read_exact(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return 0
+            kind, length = FRAME_HEADER.unpack(header)
+            if kind != FRAME_DATA:
+                raise ProtocolError(f"expected data frame, got type {kind}")
+            self.data_remaining = length
+        n = self.read_raw_into(view[:min(len(view), self.data_remaining)])
+        self.data_remaining -= n
+        return n
+
+    # Exactly n payload bytes, or fewer if the peer disconnects first
+    def recv_payload(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        got = 0
+        while got < n:
+            count = self.recv_into(view[got:])
+            if not count:
+                break
+            got += count
+        return bytes(buf[:got])
+
+    # Next block of a compressed payload, b'' at the end of the stream
+    def recv_block(self):
+        header = self.recv_payload(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            raise ConnectionResetError("connection closed during compressed transfer")
+        length, = BLOCK_HEADER.unpack(header)
+        if length > MAX_BLOCK:
+            raise ProtocolError(f"compressed block of {length} bytes")
+        block = self.recv_payload(length)
+        if len(block) < length:
+            raise ConnectionResetError("connection closed during compressed transfer")
+        return block
+
+    # --- socket passthrough ---
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+
+# The generators below are the server side of the same framing. They yield
+# engine operations (see utils/engine.py) and are used with "yield from" by
+# the command handlers, where session.version holds the negotiated version.
+# File payload is charged to session.shaper, the connection's rate limits
+# (see utils/qos.py), if it has any.
+
+# Charges n payload bytes to the session's rate limits, waiting if they say so
+def shape(session, n):
+    delay = session.shaper.charge(n)
+    if delay > 0:
+        yield Sleep(delay)
+
+def recv_message(session):
+    if session.version < 2:
+        return (yield RecvLine())
+    header = yield RecvExact(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    kind, length = FRAME_HEADER.unpack(header)
+    if kind != FRAME_MESSAGE or length > MAX_LINE:
+        raise ProtocolError(f"expected message frame, got type {kind}")
+    payload = yield RecvExact(length)
+    if len(payload) < length:
+        return None
+    return payload.decode()
+
+
+def send_message(session, text):
+    if session.version < 2:
+        yield Send((text + '\n').encode())
+    else:
+        yield Send(pack_message(text))
+
+
+# Part of a multi-line reply; end_lines() terminates it. v1 sends one line
+# each, v2 as few messages as fit in MAX_LINE, so a long reply can be
+# streamed in pieces.
+def send_lines_part(session, lines):
+    if not lines:
+        return
+    if session.version < 2:
+        yield Send(''.join(line + '\n' for line in lines).encode())
+        return
+    messages, batch, size = [], [], 0
+    for line in lines:
+        length = len(line.encode()) + 1
+        if batch and size + length > MAX_LINE:
+            messages.append(pack_message('\n'.join(batch)))
+            batch, size = [], 0
+        batch.append(line)
+        size += length
+    messages.append(pack_message('\n'.join(batch)))
+    yield Send(b''.join(messages))
+
+
+# End of a multi-line reply (v1: a blank line, v2: an empty message)
+def end_lines(session):
+    yield Send(b'\n' if session.version < 2 else pack_message(''))
+
+
+# Multi-line reply sent in one go
+def send_lines(session, lines):
+    yield from send_lines_part(session, lines)
+    yield from end_lines(session)
+
+
+# File bytes from an open file, zero-copy in both protocol versions. Nothing
+# at all is sent for an empty payload: the receiver reads no payload then, so
+# an empty DATA frame would be left in front of the next message.
+def send_file_payload(session, f, offset, count):
+    if count <= 0:
+        return 0
+    if session.version >= 2:
+        yield Send(pack_data_header(count))
+    if session.shaper is None:
+        return (yield SendFile(f, offset, count))
+    # Rate limited: in slices, so the waits come between them
+    sent = 0
+    while sent < count:
+        n = yield SendFile(f, offset + sent, min(session.shaper.slice, count - sent))
+        if not n:
+            break
+        sent += n
+        yield from shape(session, n)
+    return sent
+
+
+# count bytes of in-memory content from offset, sent like send_file_payload()
+# sends a file's (e.g. a file served from utils.filecache)
+def send_buffer_payload(session, data, offset, count):
+    if count <= 0:
+        return 0
+    view = memoryview(data)[offset:offset + count]
+    if session.version >= 2:
+        yield Send(pack_data_header(count))
+    if session.shaper is None:
+        yield Send(view)
+        return count
+    for start in range(0, count, session.shaper.slice):
+        piece = view[start:start + session.shaper.slice]
+        yield Send(piece)
+        yield from shape(session, len(piece))
+    return count
+
+
+# count bytes of an open file from offset, compressed with compressor
+# (a utils.compression.Compressor) into length-prefixed blocks
+def send_compressed_payload(session, f, offset, count, compressor, chunk_size):
+    yield Call(f.seek, offset)
+    remaining = count
+    while remaining > 0:
+        data = yield Call(f.read, min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        block = yield Call(compressor.compress, data)
+        if block:
+            yield from send_payload(session, block)
+    yield from send_payload(session, compressor.finish())
+    return count - remaining
+
+
+# In-memory payload bytes (e.g. a delta signature)
+def send_payload(session, data):
+    if not data:
+        return
+    if session.version >= 2:
+        yield Send(pack_data_header(len(data)) + data)
+    else:
+        yield Send(data)
+    if session.shaper is not None:
+        yield from shape(session, len(data))
+
+
+# Part of a block stream: data goes through framer (a utils.compression
+# Compressor or Framer); finish=True ends the stream after it
+def send_blocks(session, framer, data, finish=False):
+    block = (yield Call(framer.compress, data)) if data else b''
+    if finish:
+        block += framer.finish()
+    if block:
+        yield from send_payload(session, block)
+
+
+# File bytes sent by the client, received into view; returns the count (0 on disconnect)
+def recv_payload_into(session, view):
+    if session.version < 2:
+        n = yield RecvInto(view)
+    else:
+        while session.data_remaining == 0:
+            header = yield RecvExact(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return 0
+            kind, length = FRAME_HEADER.unpack(header)
+            if kind != FRAME_DATA:
+                raise ProtocolError(f"expected data frame, got type {kind}")
+            session.data_remaining = length
+        n = yield RecvInto(view[:min(len(view), session.data_remaining)])
+        session.data_remaining -= n
+    if session.shaper is not None and n:
+        # Not reading meanwhile lets TCP flow control slow the client down
+        yield from shape(session, n)
+    return n
+
+
+# Exactly n payload bytes, or fewer if the client disconnects first
+def recv_payload_exact(session, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        count = yield from recv_payload_into(session, view[got:])
+        if not count:
+            break
+        got += count
+    return bytes(buf[:got])
+
+
+# Next block of a compressed payload from the client, b'' at the end of the
+# stream or None if the client disconnects
+def recv_block(session):
+    header = yield from recv_payload_exact(session, BLOCK_HEADER.size)
+    if len(header) < BLOCK_HEADER.size:
+        return None
+    length, = BLOCK_HEADER.unpack(header)
+    if length > MAX_BLOCK:
+        raise ProtocolError(f"compressed block of {length} bytes")
+    block = yield from recv_payload_exact(session, length)
+    return block if len(block) == length else None
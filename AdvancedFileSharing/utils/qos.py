@@ -0,0 +1,208 @@
+import threading
+import time
+
+# Bandwidth shaping with token buckets. A connection's file payload (what
+# goes through the payload helpers in utils/protocol.py) is charged to every
+# bucket that applies to it: its own, its user's, its role's and the
+# server's. A bucket refills at its rate up to a burst, and a charge may take
+# it below zero; the deficit is how long the charging transfer then waits.
+#
+# There are two priority classes. Bytes count as interactive up to
+# priority_bytes into a command, as long as the connection has not used up
+# its interactive allowance: priority_bytes per PRIORITY_WINDOW, however
+# many commands they are spread over. They are charged like any others, but
+# they never wait, so a LIST, a STAT or a small download goes straight
+# through while bulk transfers sharing its buckets slow down to pay for it.
+# Interactive bytes never take a bucket below -burst worth of tokens, which
+# bounds how long they can hold up everybody else. Bytes past either limit
+# are bulk and wait out any deficit.
+#
+# Connections without any limit get no Shaper at all, which leaves the
+# transfer paths exactly as they are without QoS.
+
+RATE_WINDOW = 1.0  # Seconds over which a bucket's current rate is measured
+PRIORITY_WINDOW = 1.0  # Seconds in which a connection's interactive allowance refills
+MIN_SLICE = 64 * 1024  # Smallest piece a shaped file send is split into
+MAX_SLICE = 8 * 1024 * 1024
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+# "512K", "20M", "1G" or a plain number of bytes per second
+def parse_rate(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    rate = float(text[:len(text) - len(unit)]) * UNITS[unit]
+    if rate <= 0:
+        raise ValueError(f"rate must be positive: {text}")
+    return rate
+
+
+class TokenBucket:
+    """rate bytes per second, saving up at most burst seconds' worth."""
+
+    def __init__(self, scope, name, rate, burst):
+        self.scope = scope  # "connection", "user", "role" or "server"
+        self.name = name
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.bytes = 0  # Charged in total
+        self.throttled = 0.0  # Seconds of waiting handed out in total
+        self.waits = 0
+        self.window_start = self.stamp
+        self.window_bytes = 0
+        self.current = 0.0  # Bytes per second over the last full RATE_WINDOW
+
+    # Takes n bytes; returns how long to wait before moving more (0 for
+    # interactive bytes, which never wait and never take the bucket below
+    # -capacity; waiting bytes pay for themselves, so they may)
+    def charge(self, n, wait=True):
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.tokens = tokens - n if wait else max(tokens - n, min(tokens, -self.capacity))
+            self.stamp = now
+            self.bytes += n
+            self.window_bytes += n
+            if now - self.window_start >= RATE_WINDOW:
+                self.current = self.window_bytes / (now - self.window_start)
+                self.window_start, self.window_bytes = now, 0
+            if not wait or self.tokens >= 0:
+                return 0.0
+            delay = -self.tokens / self.rate
+            self.throttled += delay
+            self.waits += 1
+            return delay
+
+    # Current rate in bytes per second, falling off once charges stop
+    def current_rate(self):
+        with self.lock:
+            idle = time.monotonic() - self.window_start
+            if idle >= 2 * RATE_WINDOW:
+                return self.window_bytes / idle
+            return self.current
+
+
+class Shaper:
+    """The buckets one connection is charged to."""
+
+    def __init__(self, buckets, priority_bytes, priority_window=PRIORITY_WINDOW):
+        self.buckets = buckets
+        self.priority_bytes = priority_bytes
+        self.priority_rate = priority_bytes / priority_window
+        self.allowance = priority_bytes  # Interactive bytes left to this connection
+        self.stamp = time.monotonic()
+        self.moved = 0  # Payload bytes of the current command
+        # Shaped file sends go out in pieces of about an eighth of a second
+        self.slice = int(max(MIN_SLICE, min(MAX_SLICE, min(b.rate for b in buckets) / 8)))
+
+    def new_command(self):
+        self.moved = 0
+
+    # Charges n payload bytes; returns the seconds to wait before the next ones
+    def charge(self, n):
+        self.moved += n
+        now = time.monotonic()
+        self.allowance = min(self.priority_bytes, self.allowance + (now - self.stamp) * self.priority_rate)
+        self.stamp = now
+        bulk = self.moved > self.priority_bytes or n > self.allowance
+        if not bulk:
+            self.allowance -= n
+        return max(bucket.charge(n, bulk) for bucket in self.buckets)
+
+
+class QoS:
+    """Rate limits and the buckets shared between connections.
+
+    connection_rate and user_rate apply to each connection and each user on
+    their own, role_rates maps a role to the rate all its users share, and
+    server_rate caps everything together. Any of them may be None (or
+    missing from role_rates) for no limit.
+    """
+
+    def __init__(self, connection_rate=None, user_rate=None, role_rates=None, server_rate=None,
+                 burst=1.0, priority_bytes=1024 * 1024):
+        self.lock = threading.Lock()
+        self.configure(connection_rate, user_rate, role_rates, server_rate, burst, priority_bytes)
+
+    def configure(self, connection_rate=None, user_rate=None, role_rates=None, server_rate=None,
+                  burst=1.0, priority_bytes=1024 * 1024):
+        self.connection_rate = connection_rate
+        self.user_rate = user_rate
+        self.role_rates = dict(role_rates or {})
+        self.burst = burst
+        self.priority_bytes = priority_bytes
+        self.server = TokenBucket("server", "all", server_rate, burst) if server_rate else None
+        self.shared = {}  # (scope, name) -> [TokenBucket, connections using it]
+        self.connections = set()  # Per-connection buckets in use
+
+    # Shaper for a connection of user with role, None when nothing limits it.
+    # Every shaper handed out must be given back with close().
+    def open(self, peer, user, role):
+        buckets = []
+        with self.lock:
+            if self.connection_rate:
+                bucket = TokenBucket("connection", peer, self.connection_rate, self.burst)
+                self.connections.add(bucket)
+                buckets.append(bucket)
+            if self.user_rate:
+                buckets.append(self._share("user", user, self.user_rate))
+            if self.role_rates.get(role):
+                buckets.append(self._share("role", role, self.role_rates[role]))
+            if self.server:
+                buckets.append(self.server)
+        return Shaper(buckets, self.priority_bytes) if buckets else None
+
+    def _share(self, scope, name, rate):
+        entry = self.shared.get((scope, name))
+        if entry is None:
+            entry = self.shared[(scope, name)] = [TokenBucket(scope, name, rate, self.burst), 0]
+        entry[1] += 1
+        return entry[0]
+
+    # Gives back a shaper from open(); buckets nobody uses any more are dropped
+    def close(self, shaper):
+        if shaper is None:
+            return
+        with self.lock:
+            for bucket in shaper.buckets:
+                if bucket.scope == "connection":
+                    self.connections.discard(bucket)
+                elif bucket.scope != "server":
+                    entry = self.shared[(bucket.scope, bucket.name)]
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.shared[(bucket.scope, bucket.name)]
+
+    def buckets(self):
+        with self.lock:
+            shared = [entry[0] for _, entry in sorted(self.shared.items())]
+            return ([self.server] if self.server else []) + shared, list(self.connections)
+
+    # STATS lines: one per shared bucket, "qos:<scope>:<name> limit= rate=
+    # bytes= throttled= waits=" (rates in bytes per second, throttled in
+    # seconds), and one summing up the per-connection buckets
+    def summary(self):
+        shared, connections = self.buckets()
+        lines = [f"qos:{b.scope}:{b.name} limit={b.rate:.0f} rate={b.current_rate():.0f} bytes={b.bytes} "
+                 f"throttled={b.throttled:.3f} waits={b.waits}" for b in shared]
+        if self.connection_rate:
+            lines.append(f"qos:connection:* limit={self.connection_rate:.0f} connections={len(connections)} "
+                         f"rate={sum(b.current_rate() for b in connections):.0f} "
+                         f"throttled={sum(b.throttled for b in connections):.3f} "
+                         f"waits={sum(b.waits for b in connections)}")
+        return lines
+
+    # Prometheus samples for the shared buckets
+    def prometheus(self, prefix):
+        shared, _ = self.buckets()
+        lines = []
+        for metric, kind, value in (("qos_limit_bytes_per_second", "gauge", lambda b: f"{b.rate:.0f}"),
+                                    ("qos_rate_bytes_per_second", "gauge", lambda b: f"{b.current_rate():.0f}"),
+                                    ("qos_bytes_total", "counter", lambda b: b.bytes),
+                                    ("qos_throttled_seconds_total", "counter", lambda b: f"{b.throttled:.3f}")):
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            lines += [f'{prefix}_{metric}{{scope="{b.scope}",name="{b.name}"}} {value(b)}' for b in shared]
+        return lines
@@ -0,0 +1,205 @@
+import hashlib
+import os
+
+BUFFER_SIZE = 1024 * 1024  # Size of the reusable buffer each transfer streams through
+
+
+class HashingWriter:
+    """Streams incoming data to a file once, hashing each chunk on the way.
+
+    Data is received straight into a preallocated buffer (see space()) and
+    commit(n) writes and hashes it, so the file is never read back to verify it.
+    """
+
+    def __init__(self, f, hasher=None, buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.hasher = hasher or hashlib.sha256()
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.bytes_written = 0
+
+    # Region of the buffer to receive up to limit bytes into
+    def space(self, limit=None):
+        if limit is None or limit > len(self.buffer):
+            return self.view
+        return self.view[:limit]
+
+    # Writes and hashes the first n bytes of the buffer
+    def commit(self, n):
+        chunk = self.view[:n]
+        self.f.write(chunk)
+        self.hasher.update(chunk)
+        self.bytes_written += n
+
+    # Writes and hashes bytes that arrived some other way (e.g. decompressed)
+    def write(self, data):
+        self.f.write(data)
+        self.hasher.update(data)
+        self.bytes_written += len(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+class HashingReader:
+    """Reads a file once for sending, hashing each chunk on the way."""
+
+    def __init__(self, f, hasher=None, buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.hasher = hasher or hashlib.sha256()
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.bytes_read = 0
+
+    # Next chunk of at most limit bytes as a view into the shared buffer (empty at EOF)
+    def read_chunk(self, limit=None):
+        target = self.view if limit is None or limit > len(self.buffer) else self.view[:limit]
+        n = self.f.readinto(target) or 0
+        chunk = self.view[:n]
+        self.hasher.update(chunk)
+        self.bytes_read += n
+        return chunk
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+# Receives up to size bytes from sock into writer; progress(total) is called per chunk.
+# Returns the number of bytes received, which is short if the peer disconnects.
+def recv_to_file(sock, writer, size, progress=None):
+    received = 0
+    while received < size:
+        n = sock.recv_into(writer.space(size - received))
+        if not n:
+            break
+        writer.commit(n)
+        received += n
+        if progress:
+            progress(received)
+    return received
+
+
+# Sends up to size bytes from reader to sock; progress(total) is called per chunk.
+def send_from_file(sock, reader, size, progress=None):
+    sent = 0
+    while sent < size:
+        chunk = reader.read_chunk(size - sent)
+        if not chunk:
+            break
+        sock.sendall(chunk)
+        sent += len(chunk)
+        if progress:
+            progress(sent)
+    return sent
+
+
+# Like send_from_file, but each chunk goes through compressor (a
+# utils.compression.Compressor) and the stream is finished off at the end.
+# Returns the number of uncompressed bytes sent.
+def send_compressed_from_file(conn, reader, compressor, size, progress=None):
+    sent = 0
+    while sent < size:
+        chunk = reader.read_chunk(size - sent)
+        if not chunk:
+            break
+        block = compressor.compress(chunk)
+        if block:
+            conn.sendall(block)
+        sent += len(chunk)
+        if progress:
+            progress(sent)
+    conn.sendall(compressor.finish())
+    return sent
+
+
+# Receives a compressed payload of size uncompressed bytes from conn (a
+# utils.protocol.Connection) into writer. Returns the number of bytes written,
+# which is short if the peer disconnects.
+def recv_compressed_to_file(conn, writer, decompressor, size, progress=None):
+    while True:
+        block = conn.recv_block()
+        if not block:
+            break
+        data = decompressor.decompress(block, size - writer.bytes_written + 1)
+        if writer.bytes_written + len(data) > size:
+            raise ValueError("compressed payload is longer than announced")
+        writer.write(data)
+        if progress and data:
+            progress(writer.bytes_written)
+    return writer.bytes_written
+
+
+# Writes data at a fixed offset without moving a shared file position, so
+# several threads can fill different parts of one preallocated file
+def write_at(f, data, offset):
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            n = os.pwrite(f.fileno(), view, offset)
+            view = view[n:]
+            offset += n
+    else:
+        f.seek(offset)
+        f.write(view)
+
+
+# Creates or resizes path to size bytes, reserving the disk space where supported
+def preallocate(path, size):
+    with open(path, 'ab'):
+        pass
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                pass  # Not supported by this filesystem, truncate is enough
+
+
+# Feeds the first length bytes of an existing file to hasher (used before resuming)
+def hash_prefix(path, hasher, length, buffer_size=BUFFER_SIZE):
+    buf = bytearray(min(buffer_size, max(length, 1)))
+    view = memoryview(buf)
+    remaining = length
+    with open(path, 'rb', buffering=0) as f:
+        while remaining > 0:
+            n = f.readinto(view[:min(len(buf), remaining)])
+            if not n:
+                break
+            hasher.update(view[:n])
+            remaining -= n
+    return length - remaining
+
+
+# Sends count bytes of an open file starting at offset. Uses the kernel's
+# sendfile (no copy through userspace) when the platform and file support it,
+# otherwise falls back to large buffered reads. Returns the bytes sent.
+def send_file(sock, f, offset, count):
+    if count <= 0:
+        return 0
+    if hasattr(os, 'sendfile') and _has_fileno(f):
+        return sock.sendfile(f, offset, count)
+    return send_file_buffered(sock, f, offset, count)
+
+
+# Portable fallback: one preallocated buffer reused for every read
+def send_file_buffered(sock, f, offset, count, buffer_size=BUFFER_SIZE):
+    f.seek(offset)
+    buf = bytearray(min(buffer_size, count))
+    view = memoryview(buf)
+    sent = 0
+    while sent < count:
+        n = f.readinto(view[:min(len(buf), count - sent)])
+        if not n:
+            break
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def _has_fileno(f):
+    try:
+        f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
@@ -0,0 +1,199 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from utils.locking import try_lock, unlock
+
+# Upload sessions: an upload is written to <partial_dir>/<id>.part and the
+# committed offset (bytes known to be flushed to disk) is kept in <id>.json.
+# A client that loses its connection asks for the session again and continues
+# from the committed offset; the file is only published once it is complete.
+# Only one connection at a time may append to a session: the connection of an
+# interrupted attempt can still be writing when the client is back, possibly
+# in another server process. A claim is a lock on <id>.lock, taken by
+# UAPPEND and UCOMMIT alike. A published session leaves <id>.done behind for
+# the TTL, so a client that missed the reply to its UCOMMIT can commit again
+# and get the same answer instead of uploading the file anew.
+#
+# Session ids come from clients, so every path is built through _path(),
+# which only accepts ids of the form this module hands out.
+
+SESSION_ID = re.compile(r'[0-9a-f]{32}')  # uuid4().hex
+
+
+def valid_session_id(session_id):
+    return isinstance(session_id, str) and SESSION_ID.fullmatch(session_id) is not None
+
+
+class UploadSessions:
+    def __init__(self, partial_dir, ttl):
+        self.partial_dir = partial_dir
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.active = {}  # Session being appended to by a connection of this process -> its lock
+        os.makedirs(partial_dir, exist_ok=True)
+
+    # ValueError for anything but an id from open()
+    def _path(self, session_id, ext):
+        if not valid_session_id(session_id):
+            raise ValueError(f"bad upload session id {session_id!r}")
+        return os.path.join(self.partial_dir, f"{session_id}.{ext}")
+
+    def part_path(self, session_id):
+        return self._path(session_id, "part")
+
+    def _lock_path(self, session_id):
+        return self._path(session_id, "lock")
+
+    def _meta_path(self, session_id):
+        return self._path(session_id, "json")
+
+    def _done_path(self, session_id):
+        return self._path(session_id, "done")
+
+    def get(self, session_id):
+        if not valid_session_id(session_id):
+            return None
+        try:
+            with open(self._meta_path(session_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # {"filename", "size", "sha256"} of a session that was published, None otherwise
+    def published(self, session_id):
+        if not valid_session_id(session_id):
+            return None
+        try:
+            with open(self._done_path(session_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # Existing session for (filename, size) if the client still has one, else a
+    # new one. A session that was already published comes back fully committed.
+    def open(self, filename, size, session_id=None):
+        meta = self.get(session_id) or self.published(session_id)
+        if meta and "sha256" in meta:
+            if meta["filename"] == filename and meta["size"] == size:
+                return session_id, dict(meta, committed=size)
+            meta = None
+        if meta and meta["filename"] == filename and meta["size"] == size:
+            if self.is_active(session_id):
+                return session_id, meta  # Its writer still owns the part file
+            committed = self._sync_part(session_id, meta["committed"])
+            if committed != meta["committed"]:
+                meta["committed"] = committed
+                self._write_meta(session_id, meta)
+            return session_id, meta
+        session_id = uuid.uuid4().hex
+        meta = {"filename": filename, "size": size, "committed": 0, "created": time.time()}
+        open(self.part_path(session_id), 'wb').close()
+        self._write_meta(session_id, meta)
+        return session_id, meta
+
+    # Marks an existing session (see get()) as being appended to; False if
+    # another connection already is, or the session is gone
+    def claim(self, session_id):
+        with self.lock:
+            if session_id in self.active:
+                return False
+            fd = try_lock(self._lock_path(session_id))
+            if fd is None:
+                return False
+            # Published or expired since the caller looked it up: leave no lock behind
+            if not os.path.exists(self._meta_path(session_id)):
+                self._drop_lock(session_id, fd)
+                return False
+            self.active[session_id] = fd
+            return True
+
+    def _drop_lock(self, session_id, fd):
+        try:
+            os.remove(self._lock_path(session_id))
+        except FileNotFoundError:
+            pass
+        unlock(fd)
+
+    def release(self, session_id):
+        with self.lock:
+            fd = self.active.pop(session_id, None)
+        if fd is not None:
+            unlock(fd)
+
+    def is_active(self, session_id):
+        if not valid_session_id(session_id):
+            return False
+        with self.lock:
+            if session_id in self.active:
+                return True
+        fd = try_lock(self._lock_path(session_id))
+        if fd is None:
+            return True
+        unlock(fd)
+        return False
+
+    # Flushes the partial file to disk and records how much of it is durable
+    def commit(self, session_id, f):
+        f.flush()
+        os.fsync(f.fileno())
+        meta = self.get(session_id)
+        if meta is not None:
+            meta["committed"] = f.tell()
+            self._write_meta(session_id, meta)
+        return f.tell()
+
+    # Drops the bookkeeping of a published session, remembering its digest
+    def finish(self, session_id, digest):
+        meta = self.get(session_id)
+        if meta is not None:
+            record = {"filename": meta["filename"], "size": meta["size"], "sha256": digest}
+            tmp = self._done_path(session_id) + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(record, f)
+            os.replace(tmp, self._done_path(session_id))
+        self.remove(session_id)
+
+    # Drops the bookkeeping once the partial file has been published or abandoned
+    def remove(self, session_id):
+        for path in (self.part_path(session_id), self._meta_path(session_id), self._lock_path(session_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Anything in the partial directory untouched for longer than the TTL
+    def cleanup(self):
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for entry in os.scandir(self.partial_dir):
+            try:
+                if entry.name.endswith(".lock") and self.is_active(entry.name[:-5]):
+                    continue  # A long upload still holds it
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    # Bytes past the committed offset may not have reached the disk, so drop them
+    def _sync_part(self, session_id, committed):
+        path = self.part_path(session_id)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+            return 0
+        actual = os.path.getsize(path)
+        if actual > committed:
+            os.truncate(path, committed)
+        return min(actual, committed)
+
+    def _write_meta(self, session_id, meta):
+        meta["updated"] = time.time()
+        tmp = self._meta_path(session_id) + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path(session_id))
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class VersionCatalog:
+    """Every stored version of every logical file, in SQLite.
+
+    Version numbers come from a per-name counter that is bumped inside an
+    IMMEDIATE transaction, so allocating one is a single indexed update no
+    matter how many versions exist, and numbers are never handed out twice.
+    The current version of a file is the one whose path is in the upload
+    directory; older ones point into the version history directory.
+
+    Each version also records whether it is stored as a chunk manifest
+    (utils/chunkstore.py). Nothing else decides that, so an uploaded file
+    that happens to look like a manifest is always served as it is.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS version_counters (
+                name TEXT PRIMARY KEY,
+                last INTEGER NOT NULL
+            )
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS versions (
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT,
+                created REAL NOT NULL,
+                current INTEGER NOT NULL DEFAULT 0,
+                chunked INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (name, version)
+            )
+        ''')
+        # Catalogs from before the chunked column; the server works out the
+        # existing versions' backend once (see chunked_unknown())
+        self.added_chunked = False
+        try:
+            self.db.execute('ALTER TABLE versions ADD COLUMN chunked INTEGER')
+            self.added_chunked = True
+        except sqlite3.OperationalError:
+            pass  # Already there
+        self.db.execute('CREATE INDEX IF NOT EXISTS versions_current ON versions (current, name)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS versions_path ON versions (path)')
+
+    # Next version number for name
+    def allocate(self, name):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                version = self.db.execute('''
+                    INSERT INTO version_counters (name, last) VALUES (?, 1)
+                    ON CONFLICT(name) DO UPDATE SET last = last + 1
+                    RETURNING last
+                ''', (name,)).fetchone()[0]
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            return version
+
+    # Records a version; a current one replaces the previous current version,
+    # which moves to archived_path (the caller has already moved the file)
+    def add(self, name, version, path, size, sha256, created=None, archived_path=None, chunked=False):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if archived_path is not None:
+                    self.db.execute('UPDATE versions SET current = 0, path = ? WHERE name = ? AND current = 1',
+                                    (archived_path, name))
+                self.db.execute('''
+                    INSERT OR REPLACE INTO versions (name, version, path, size, sha256, created, current, chunked)
+                    VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                ''', (name, version, path, size, sha256, created or time.time(), int(chunked)))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    # (version, path, size, sha256, created) of the current version, or None
+    def current(self, name):
+        with self.lock:
+            return self.db.execute('''
+                SELECT version, path, size, sha256, created FROM versions WHERE name = ? AND current = 1
+            ''', (name,)).fetchone()
+
+    # name -> current version number, for every file
+    def current_versions(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT name, version FROM versions WHERE current = 1'))
+
+    # Every version of name, newest first: (version, path, size, sha256, created, current)
+    def list(self, name):
+        with self.lock:
+            return self.db.execute('''
+                SELECT version, path, size, sha256, created, current FROM versions
+                WHERE name = ? ORDER BY version DESC
+            ''', (name,)).fetchall()
+
+    # Path of one version, or None
+    def path(self, name, version):
+        with self.lock:
+            row = self.db.execute('SELECT path FROM versions WHERE name = ? AND version = ?',
+                                  (name, version)).fetchone()
+        return row[0] if row else None
+
+    # Whether the stored file at path is a chunk manifest; files the catalog
+    # does not know are plain
+    def is_chunked(self, path):
+        with self.lock:
+            row = self.db.execute('SELECT chunked FROM versions WHERE path = ?', (path,)).fetchone()
+        return bool(row and row[0])
+
+    # Paths of versions whose backend is not recorded yet
+    def chunked_unknown(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT path FROM versions WHERE chunked IS NULL')]
+
+    def set_chunked(self, path, chunked):
+        with self.lock:
+            self.db.execute('UPDATE versions SET chunked = ? WHERE path = ?', (int(chunked), path))
+
+    def remove(self, name, version):
+        with self.lock:
+            self.db.execute('DELETE FROM versions WHERE name = ? AND version = ?', (name, version))
+
+    # Drops the current version of name (the file itself was deleted)
+    def remove_current(self, name):
+        with self.lock:
+            self.db.execute('DELETE FROM versions WHERE name = ? AND current = 1', (name,))
+
+    # Archived versions that break the retention policy:
+    # beyond the newest keep_last versions (the current one included), older
+    # than max_age seconds, or past max_bytes of archived data per file.
+    # Returns (name, version, path) tuples; the current version is never pruned.
+    def expired(self, keep_last=None, max_age=None, max_bytes=None):
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute('''
+                SELECT name, version, path, size, created, current FROM versions
+                ORDER BY name, version DESC
+            ''').fetchall()
+        doomed = []
+        name, rank, archived_bytes = None, 0, 0
+        for row_name, version, path, size, created, current in rows:
+            if row_name != name:
+                name, rank, archived_bytes = row_name, 0, 0
+            rank += 1
+            if current:
+                continue
+            archived_bytes += size
+            if ((keep_last is not None and rank > keep_last)
+                    or (max_age is not None and now - created > max_age)
+                    or (max_bytes is not None and archived_bytes > max_bytes)):
+                doomed.append((row_name, version, path))
+        return doomed
+
+    # Archived versions whose file has disappeared from disk
+    def missing(self):
+        with self.lock:
+            rows = self.db.execute('SELECT name, version, path FROM versions WHERE current = 0').fetchall()
+        return [row for row in rows if not os.path.exists(row[2])]